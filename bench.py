@@ -0,0 +1,386 @@
+"""Offline micro-benchmarks for the message hot path.
+
+Usage:
+    python bench.py [--messages 5000] [--rounds 3] [--leads]
+
+Runs against a synthetic corpus shaped like traffic in the monitored groups
+(classifieds, job posts, partner ads, questions, lawyer searches, spam) and
+prints messages/sec. No Telegram or OpenAI access is needed.
+
+--leads measures AI input compaction on the lead history of the configured
+DATA_DIR / STORAGE_BACKEND instead of the synthetic corpus, read without
+writing. The bot itself always runs on a fresh temporary DATA_DIR.
+"""
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+# the configured state, read by --leads only
+STATE_DIR = os.getenv("DATA_DIR", "/data" if os.path.isdir("/data") else ".").strip() or "."
+STATE_SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(STATE_DIR, "bot.sqlite3"))
+
+_TMP = tempfile.mkdtemp(prefix="bench_")
+os.environ["DATA_DIR"] = _TMP
+os.environ["LOG_PATH"] = os.path.join(_TMP, "bot.log")
+os.environ["SQLITE_PATH"] = os.path.join(_TMP, "bot.sqlite3")
+
+import bot  # noqa: E402
+
+
+# =============================================================================
+# CORPUS
+# =============================================================================
+
+CORPUS_TEMPLATES = [
+    # classifieds / chatter (the bulk of traffic)
+    "Продам диван в хорошем состоянии, самовывоз из {city}. Цена договорная, пишите в личку.",
+    "Віддам дитячі речі на хлопчика 2-3 роки, {city}, забирати сьогодні.",
+    "Шукаю кімнату в {city} з 1 числа, бюджет до 500 євро, без тварин 🙏",
+    "Кто едет завтра из {city} в Киев? Возьмите посылку, оплачу 🙏🙏",
+    "Biete Mitfahrgelegenheit {city} - Berlin am Samstag, 2 Plätze frei.",
+    "Работа на складе в {city}, зарплата от 14 евро/час, звоните +49 170 {num}",
+    "Доброго дня всім! Де в {city} можна купити українські продукти?",
+    "Маникюр, педикюр, наращивание ресниц 💅💅 {city} центр, запись @{user}",
+    "Перевозки Украина - Германия - Украина, посылки, документы. Viber +380 67 {num}",
+    # partner-adjacent services
+    "Страхование авто, Kfz-Versicherung, Haftpflicht. Консультант по {city}, тел +49 152 {num}",
+    "Steuererklärung und Übersetzung von Dokumenten, schnell und günstig. WhatsApp +49 160 {num}",
+    "Финансовый консультант: ипотека, Baufinanzierung, кредиты. Пишите @{user}",
+    # legal questions
+    "Подскажите, что делать если Jobcenter отказал в выплатах? Писать Widerspruch?",
+    "Підкажіть, як продовжити §24 якщо Ausländerbehörde не відповідає?",
+    "Wie lange dauert eine Klage beim Sozialgericht? Hat jemand Erfahrung?",
+    "Меня незаконно уволили, куда обращаться? Arbeitsvertrag был на год.",
+    # explicit lawyer search
+    "Ищу адвоката по семейным делам в {city}, развод и опека над ребенком.",
+    "Потрібен юрист, який говорить українською, в районі {city}.",
+    "Kann jemand einen Anwalt empfehlen? Rechtsanwalt gesucht für Mietrecht.",
+    "Looking for a lawyer in {city} who speaks Russian.",
+    # competitors / spam
+    "Адвокат Украины, свидоцтво адвоката №123, консультации онлайн, пишите @{user}",
+    "Лучшее казино онлайн 🎰 промокод BONUS100 для новых игроков!",
+    "Продажа аккаунтов и ЛК банков, обнал, пишите в лс",
+]
+
+CITIES = ["Essen", "Köln", "Düsseldorf", "Berlin", "Hamburg", "München", "Wuppertal", "Bochum"]
+
+
+def build_corpus(size: int, seed: int = 7):
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(size):
+        tpl = rnd.choice(CORPUS_TEMPLATES)
+        text = tpl.format(
+            city=rnd.choice(CITIES),
+            num=rnd.randint(1000000, 9999999),
+            user=f"user{rnd.randint(1000, 99999)}",
+        )
+        # cross-posted ads are often padded with extra lines and emoji
+        if rnd.random() < 0.3:
+            text = text + "\n" + "🔥" * rnd.randint(1, 8) + "\n" + text
+        out.append(text)
+    return out
+
+
+# =============================================================================
+# LEGACY REFERENCE
+# =============================================================================
+
+def legacy_phone_or_contact_present(text: str) -> bool:
+    t = text or ""
+    return bool(
+        re.search(r"(?:\+?\d[\d\s().-]{7,}\d)", t)
+        or re.search(r"@\w{4,}", t)
+        or re.search(r"(?:whatsapp|viber|telegram|tg|instagram|insta|email|e-mail|webseite|site|сайт|личные сообщения|в личку|пишите в лс|пишіть у приват)", t, re.I)
+        or re.search(r"https?://", t, re.I)
+    )
+
+
+def legacy_normalize(text: str) -> str:
+    text = (text or "").lower()
+    text = re.sub(r"https?://\S+", " ", text)
+    text = re.sub(r"[^\w\s@§/+.-]", " ", text, flags=re.UNICODE)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text
+
+
+def legacy_classify_message(text: str):
+    """classify_message as it was before the precompiled matchers."""
+    t = legacy_normalize(text)
+    if not t or len(t) < 3:
+        return ("ignore", "empty_or_short")
+    for pat in bot.SPAM_PATTERNS:
+        if re.search(pat, t, re.I):
+            return ("reject_spam", f"spam:{pat}")
+    for pat in bot.LEAD_SEARCH_PATTERNS:
+        if re.search(pat, t, re.I):
+            return ("lead_search", f"lead_search:{pat}")
+    has_contact = legacy_phone_or_contact_present(text)
+    has_partner_hint = any(h in t for h in bot.PARTNER_SERVICE_HINTS)
+    is_likely_competitor_lawyer = any(h in t for h in bot.LAWYER_COMPETITOR_HINTS)
+    if has_contact and has_partner_hint and not is_likely_competitor_lawyer:
+        return ("partner_services", "partner_services:contact+adjacent_service")
+    if bot.QUESTION_RE.search(text or "") and any(h in t for h in bot.LEGAL_HINTS):
+        return ("lead_question", "lead_question:question+legal_hint")
+    if has_contact and is_likely_competitor_lawyer:
+        return ("ignore", "other_lawyer_or_legal_promo")
+    return ("ignore", "no_match")
+
+
+def legacy_detect_language(text: str) -> str:
+    t = text or ""
+    cyr = len(re.findall(r"[А-Яа-яЁёІіЇїЄєҐґ]", t))
+    lat = len(re.findall(r"[A-Za-zÄÖÜäöüß]", t))
+    if cyr >= lat:
+        if re.search(r"[ІіЇїЄєҐґ]", t):
+            return "uk"
+        return "ru"
+    if re.search(r"\b(der|die|das|und|nicht|mit|für|anwalt|recht|versicherung)\b", t.lower()):
+        return "de"
+    return "en"
+
+
+def legacy_hash_fingerprint(sender_username: str, text: str) -> str:
+    return f"{(sender_username or '').lower().strip()}|{legacy_normalize(text)[:300]}"
+
+
+class LegacySeen(dict):
+    """SEEN as a plain dict, purged by a full scan on every candidate."""
+
+    def purge(self, now: float, hours: int = 72):
+        stale = [k for k, ts in self.items() if now - float(ts) > hours * 3600]
+        for k in stale:
+            self.pop(k, None)
+
+
+def legacy_message_pass(text: str):
+    """Text work handle_candidate_message did per message before MessageAnalysis."""
+    category, reason = legacy_classify_message(text)
+    fp = f"user|{legacy_normalize(text)[:300]}"
+    return category, reason, fp, legacy_detect_language(text)
+
+
+def analysis_message_pass(text: str):
+    analysis = bot.MessageAnalysis(text, "user")
+    category, reason = bot.classify_message(text, analysis)
+    return category, reason, analysis.fingerprint, analysis.language
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+def measure(fn, corpus, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - started)
+    return len(corpus) / best if best else float("inf")
+
+
+def report(name: str, rate: float, baseline: float = 0.0):
+    extra = f"  x{rate / baseline:.2f}" if baseline else ""
+    print(f"{name:<32} {rate:>12,.0f} msg/s{extra}")
+
+
+def bench_classify(corpus, rounds: int):
+    mismatches = sum(1 for t in corpus if legacy_classify_message(t) != bot.classify_message(t))
+    if mismatches:
+        print(f"!! classify_message differs from legacy on {mismatches} messages")
+
+    before = measure(legacy_classify_message, corpus, rounds)
+    after = measure(bot.classify_message, corpus, rounds)
+    report("classify_message (legacy)", before)
+    report("classify_message", after, before)
+
+
+def bench_message_pass(corpus, rounds: int):
+    mismatches = sum(1 for t in corpus if legacy_message_pass(t) != analysis_message_pass(t))
+    if mismatches:
+        print(f"!! MessageAnalysis pass differs from legacy on {mismatches} messages")
+
+    before = measure(legacy_message_pass, corpus, rounds)
+    after = measure(analysis_message_pass, corpus, rounds)
+    report("message pass (legacy)", before)
+    report("message pass (analysis)", after, before)
+
+
+def bench_text_helpers(corpus, rounds: int):
+    checks = (
+        ("normalize", legacy_normalize, bot.normalize),
+        ("detect_language", legacy_detect_language, bot.detect_language),
+        ("hash_fingerprint", lambda t: legacy_hash_fingerprint("user", t), lambda t: bot.hash_fingerprint("user", t)),
+    )
+    for name, legacy, current in checks:
+        mismatches = sum(1 for t in corpus if legacy(t) != current(t))
+        if mismatches:
+            print(f"!! {name} differs from legacy on {mismatches} messages")
+        before = measure(legacy, corpus, rounds)
+        report(f"{name} (legacy)", before)
+        report(name, measure(current, corpus, rounds), before)
+
+
+def bench_dedup(corpus, rounds: int, history: int = 5000):
+    """SEEN purge + lookup + insert per candidate, with `history` keys already stored.
+
+    Message keys are spaced so the stored history spans the full 72h TTL and
+    a steady trickle expires while the corpus is replayed.
+    """
+    step = 72 * 3600 / history
+    start = 1_700_000_000.0
+    prefill = {f"msg:-1001:{i}": start + i * step for i in range(history)}
+    fingerprints = [legacy_hash_fingerprint("user", t) for t in corpus]
+    t0 = start + 72 * 3600
+
+    def run(seen, purge, fresh):
+        dupes = 0
+        for i, fp in enumerate(fingerprints):
+            now = t0 + i
+            purge(seen, now)
+            event_key, dup_key = f"msg:-1002:{i}", f"fp:{fp}"
+            if event_key in seen or fresh(seen, dup_key, now):
+                dupes += 1
+                continue
+            seen[event_key] = now
+            seen[dup_key] = now
+        return dupes
+
+    def legacy_fresh(seen, key, now):
+        return now - float(seen.get(key, 0.0) or 0.0) < 72 * 3600
+
+    def rate(make, purge, fresh):
+        best = float("inf")
+        dupes = 0
+        for _ in range(rounds):
+            seen = make()
+            started = time.perf_counter()
+            dupes = run(seen, purge, fresh)
+            best = min(best, time.perf_counter() - started)
+        return len(fingerprints) / best, dupes
+
+    before, legacy_dupes = rate(lambda: LegacySeen(prefill), LegacySeen.purge, legacy_fresh)
+    after, dupes = rate(
+        lambda: bot.SeenIndex(prefill, now=start),
+        lambda seen, now: seen.expire(now),
+        lambda seen, key, now: seen.is_fresh(key, now),
+    )
+    if dupes != legacy_dupes:
+        print(f"!! dedup found {dupes} duplicates, legacy {legacy_dupes}")
+    report(f"dedup, {history} keys (legacy)", before)
+    report(f"dedup, {history} keys", after, before)
+    print(f"{'duplicates in corpus':<32} {dupes:>12,}")
+
+
+def bench_compaction(corpus, rounds: int):
+    before = sum(bot.estimate_tokens(t) for t in corpus)
+    after = sum(bot.estimate_tokens(bot.compact_for_ai(t)) for t in corpus)
+    saved = (before - after) / before * 100.0 if before else 0.0
+    report("compact_for_ai", measure(bot.compact_for_ai, corpus, rounds))
+    print(f"{'AI input tokens (est.)':<32} {before:>12,} -> {after:,} ({saved:.1f}% saved)")
+
+
+class FakeEvent:
+    """Just enough of a Telethon NewMessage event for the dispatch path."""
+
+    def __init__(self, chat_id: int, text: str, is_private: bool = False, out: bool = False):
+        self.chat_id = chat_id
+        self.raw_text = text
+        self.is_private = is_private
+        self.out = out
+        self.is_reply = False
+        self.sender_fetches = 0
+
+    async def get_sender(self):
+        self.sender_fetches += 1
+        return None
+
+
+async def legacy_dispatch(config, monitored_ids, event):
+    """The three NewMessage handlers run_client_forever used to register."""
+    if not event.out and event.chat_id in monitored_ids:
+        await bot.handle_candidate_message(None, config, event)
+    if not event.out:
+        await bot.handle_private_inbound(None, config, event)
+    await bot.handle_command(None, config, event)
+
+
+def bench_dispatch(corpus, rounds: int):
+    """Per-update overhead for group traffic from chats the session does not monitor."""
+    config = {"session_name": "bench"}
+    events = [FakeEvent(-1000000000000 - i % 50, text) for i, text in enumerate(corpus)]
+
+    async def run(dispatch):
+        for event in events:
+            await dispatch(config, set(), event)
+
+    def rate(dispatch):
+        best = float("inf")
+        for _ in range(rounds):
+            started = time.perf_counter()
+            asyncio.run(run(dispatch))
+            best = min(best, time.perf_counter() - started)
+        return len(events) / best
+
+    cells = bot.event_cells(config["session_name"])
+
+    async def single(config, monitored_ids, event):
+        await bot.dispatch_message(None, config, monitored_ids, event, cells)
+
+    before = rate(legacy_dispatch)
+    after = rate(single)
+    report("dispatch (3 handlers)", before)
+    report("dispatch (single)", after, before)
+
+
+def load_lead_history():
+    if bot.STORAGE_BACKEND == "sqlite":
+        if not os.path.exists(STATE_SQLITE_PATH):
+            return {}
+        conn = sqlite3.connect(f"file:{STATE_SQLITE_PATH}?mode=ro", uri=True)
+        try:
+            return {lead_id: json.loads(data) for lead_id, data in conn.execute("SELECT id, data FROM leads")}
+        finally:
+            conn.close()
+    journal = bot.LeadJournal(
+        os.path.join(STATE_DIR, "leads.json"), os.path.join(STATE_DIR, "leads.journal.jsonl"), 1,
+    )
+    return journal.load()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--leads", action="store_true", help="measure compaction on stored leads")
+    args = parser.parse_args(argv)
+
+    if args.leads:
+        texts = [lead["text"] for lead in load_lead_history().values() if lead.get("text")]
+        print(f"lead history: {len(texts)} leads")
+        if texts:
+            bench_compaction(texts, args.rounds)
+        return 0
+
+    corpus = build_corpus(args.messages)
+    print(f"corpus: {len(corpus)} messages, best of {args.rounds} rounds")
+    bench_classify(corpus, args.rounds)
+    bench_text_helpers(corpus, args.rounds)
+    bench_message_pass(corpus, args.rounds)
+    bench_dedup(corpus, args.rounds)
+    bench_compaction(corpus, args.rounds)
+    bench_dispatch(corpus, args.rounds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
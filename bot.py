@@ -4,11 +4,24 @@ import re
 import json
 import time
 import asyncio
+import atexit
+import contextlib
+import copy
+import hashlib
+import heapq
+import itertools
 import logging
+import math
+import queue
+import sqlite3
+import threading
 import traceback
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
-from typing import Dict, Any, Tuple, List
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Any, Tuple, List, Optional
 
 import telethon
 from telethon import TelegramClient, events
@@ -21,7 +34,8 @@ from telethon.errors import (
     RPCError,
 )
 from telethon.tl.functions.channels import InviteToChannelRequest
-from telethon.tl.types import InputPeerUser
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+from telethon.utils import get_input_peer, get_peer_id
 
 try:
     from openai import AsyncOpenAI
@@ -38,9 +52,99 @@ log_dir = os.path.dirname(LOG_PATH)
 if log_dir:
     os.makedirs(log_dir, exist_ok=True)
 
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1").strip() == "1"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_SKIP_EVERY_SEC = float(os.getenv("LOG_SKIP_EVERY_SEC", "60"))
+
+_SESSION_PREFIX_RE = re.compile(r"^\[([^\]]+)\]")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line; session/chat_id/lead_id come from `extra=`
+    (session falls back to the "[session] ..." message prefix)."""
+
+    FIELDS = ("session", "chat_id", "lead_id", "skip", "suppressed")
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        out = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "msg": message,
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                out[field] = value
+        if "session" not in out:
+            m = _SESSION_PREFIX_RE.match(message)
+            if m:
+                out["session"] = m.group(1)
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """The plain "asctime - level - message" line, plus SkipRateFilter's count."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        suppressed = getattr(record, "suppressed", None)
+        return f"{line} (+{suppressed} suppressed)" if suppressed else line
+
+
+class LogQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stdlib prepare() runs the handler's formatter on the calling thread
+    and drops exc_info. Here only msg % args is merged (args may be mutated
+    after the call returns); exc_info stays on the record for the listener's
+    formatter.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class SkipRateFilter(logging.Filter):
+    """Lets one record per (skip reason, session) through every `interval`
+    seconds; the next one that passes carries the number suppressed in
+    `record.suppressed`. Records without a `skip` attribute are untouched."""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self.state: Dict[Tuple[str, Any], List[float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        reason = getattr(record, "skip", None)
+        if reason is None or self.interval <= 0:
+            return True
+        key = (reason, getattr(record, "session", None))
+        now = record.created
+        state = self.state.get(key)
+        if state is not None and now - state[0] < self.interval:
+            state[1] += 1
+            return False
+        suppressed = int(state[1]) if state is not None else 0
+        self.state[key] = [now, 0]
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)
-_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+_formatter = (
+    JsonLinesFormatter() if LOG_FORMAT == "json"
+    else TextFormatter("%(asctime)s - %(levelname)s - %(message)s")
+)
 
 fh = RotatingFileHandler(LOG_PATH, maxBytes=5_000_000, backupCount=3, encoding="utf-8")
 fh.setFormatter(_formatter)
@@ -48,7 +152,19 @@ fh.setFormatter(_formatter)
 sh = logging.StreamHandler(sys.stdout)
 sh.setFormatter(_formatter)
 
-root_logger.handlers = [fh, sh]
+# With LOG_QUEUE the event loop only enqueues records; a listener thread
+# does the formatting, disk writes and rotation.
+LOG_LISTENER = None
+if LOG_QUEUE:
+    _log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root_logger.handlers = [LogQueueHandler(_log_queue)]
+    LOG_LISTENER = QueueListener(_log_queue, fh, sh, respect_handler_level=True)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop)
+else:
+    root_logger.handlers = [fh, sh]
+# the skip lines are logged on the root logger, so the filter sits there
+root_logger.addFilter(SkipRateFilter(LOG_SKIP_EVERY_SEC))
 
 
 def excepthook(exc_type, exc, tb):
@@ -108,20 +224,51 @@ GROUPS_TO_MONITOR = sorted(set(
     [g.strip() for g in raw_groups.split(",") if g.strip()] if raw_groups else DEFAULT_GROUPS
 ))
 
-ACCOUNTS = [
-    {
-        "api_id": int(os.getenv("TG_API_ID_1", "0") or "0"),
-        "api_hash": os.getenv("TG_API_HASH_1", "").strip(),
-        "session_name": os.getenv("TG_SESSION_1", "session1").strip(),
-        "your_username": os.getenv("TG_ME_USERNAME_1", "Andrii_Bilytskyi").strip().lstrip("@"),
-    },
-    {
-        "api_id": int(os.getenv("TG_API_ID_2", "0") or "0"),
-        "api_hash": os.getenv("TG_API_HASH_2", "").strip(),
-        "session_name": os.getenv("TG_SESSION_2", "session2").strip(),
-        "your_username": os.getenv("TG_ME_USERNAME_2", "Anwalt_Bilytskyi").strip().lstrip("@"),
-    },
-]
+DEFAULT_ACCOUNT_USERNAMES = {1: "Andrii_Bilytskyi", 2: "Anwalt_Bilytskyi"}
+
+
+def _account_from_env(index: int) -> Dict[str, Any]:
+    return {
+        "api_id": int(os.getenv(f"TG_API_ID_{index}", "0") or "0"),
+        "api_hash": os.getenv(f"TG_API_HASH_{index}", "").strip(),
+        "session_name": os.getenv(f"TG_SESSION_{index}", f"session{index}").strip(),
+        "your_username": os.getenv(
+            f"TG_ME_USERNAME_{index}", DEFAULT_ACCOUNT_USERNAMES.get(index, "")
+        ).strip().lstrip("@"),
+        "weight": float(os.getenv(f"TG_WEIGHT_{index}", "1") or "1"),
+    }
+
+
+def load_accounts() -> List[Dict[str, Any]]:
+    """Accounts from ACCOUNTS_FILE (a JSON list) or TG_API_ID_<n>/TG_API_HASH_<n>/... env vars.
+
+    Env accounts are read for n = 1, 2, ... until the first n > 2 without
+    TG_API_ID_<n>; sessions 1 and 2 keep their historical defaults.
+    """
+    path = os.getenv("ACCOUNTS_FILE", "").strip()
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        accounts = []
+        for i, item in enumerate(raw, start=1):
+            accounts.append({
+                "api_id": int(item.get("api_id") or 0),
+                "api_hash": str(item.get("api_hash") or "").strip(),
+                "session_name": str(item.get("session_name") or f"session{i}").strip(),
+                "your_username": str(item.get("your_username") or "").strip().lstrip("@"),
+                "weight": float(1.0 if item.get("weight") is None else item["weight"]),
+            })
+        return accounts
+
+    accounts = []
+    for index in itertools.count(1):
+        if index > 2 and not os.getenv(f"TG_API_ID_{index}"):
+            break
+        accounts.append(_account_from_env(index))
+    return accounts
+
+
+ACCOUNTS = load_accounts()
 
 ADMIN_NOTIFY_USERNAME = os.getenv("ADMIN_NOTIFY_USERNAME", "Andrii_Bilytskyi").strip().lstrip("@")
 TARGET_INVITE_GROUP = os.getenv("TARGET_INVITE_GROUP", "@advocate_ua_1").strip()
@@ -133,17 +280,53 @@ AUTO_INVITE_AFTER_DM = os.getenv("AUTO_INVITE_AFTER_DM", "0").strip() == "1"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5-mini").strip()
 OPENAI_TIMEOUT_SEC = int(os.getenv("OPENAI_TIMEOUT_SEC", "45"))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "").strip() or None
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+AI_BREAKER_WINDOW_SEC = float(os.getenv("AI_BREAKER_WINDOW_SEC", "120"))
+AI_BREAKER_MIN_CALLS = int(os.getenv("AI_BREAKER_MIN_CALLS", "6"))
+AI_BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", "0.5"))
+AI_BREAKER_COOLDOWN_SEC = float(os.getenv("AI_BREAKER_COOLDOWN_SEC", "60"))
+AI_JSON_MODE_RETRY_SEC = float(os.getenv("AI_JSON_MODE_RETRY_SEC", "600"))
+AI_HEDGE = os.getenv("AI_HEDGE", "1").strip() == "1"
+AI_HEDGE_AFTER_SEC = float(os.getenv("AI_HEDGE_AFTER_SEC", "15"))
+AI_HEDGE_MIN_SEC = float(os.getenv("AI_HEDGE_MIN_SEC", "3"))
 MAX_AI_INPUT_CHARS = int(os.getenv("MAX_AI_INPUT_CHARS", "2400"))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "2000"))
+AI_CACHE_TTL_HOURS = float(os.getenv("AI_CACHE_TTL_HOURS", "24"))
+AI_CACHE_SNAPSHOT_SEC = int(os.getenv("AI_CACHE_SNAPSHOT_SEC", "300"))
+AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
+AI_QUEUE_MAX = int(os.getenv("AI_QUEUE_MAX", "200"))
+AI_BATCH = os.getenv("AI_BATCH", "0").strip() == "1"
+AI_REPLY_ASSEMBLY = os.getenv("AI_REPLY_ASSEMBLY", "1").strip() == "1"
+AI_BATCH_WINDOW_SEC = float(os.getenv("AI_BATCH_WINDOW_SEC", "3"))
+AI_BATCH_MAX = int(os.getenv("AI_BATCH_MAX", "8"))
+PRESCORER_THRESHOLD = float(os.getenv("PRESCORER_THRESHOLD", "0"))
+AI_INPUT_TOKEN_BUDGET = int(os.getenv("AI_INPUT_TOKEN_BUDGET", "600"))
 
 DEFAULT_DATA_DIR = "/data" if os.path.isdir("/data") else "."
 DATA_DIR = os.getenv("DATA_DIR", DEFAULT_DATA_DIR).strip() or "."
 CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(DATA_DIR, "group_cache"))
+ENTITY_TTL_HOURS = float(os.getenv("ENTITY_TTL_HOURS", "24"))
+ENTITY_RESOLVE_CONCURRENCY = int(os.getenv("ENTITY_RESOLVE_CONCURRENCY", "4"))
+ENTITY_FLOOD_MAX_WAIT_SEC = int(os.getenv("ENTITY_FLOOD_MAX_WAIT_SEC", "300"))
 SESSION_DIR = os.getenv("SESSION_DIR", os.path.join(DATA_DIR, "sessions"))
 SEEN_FILE = os.path.join(DATA_DIR, "seen_messages.json")
 LEADS_FILE = os.path.join(DATA_DIR, "leads.json")
 ANALYTICS_FILE = os.path.join(DATA_DIR, "analytics.json")
 FAVORITES_FILE = os.path.join(DATA_DIR, "favorites.json")
 OUTBOUND_FILE = os.path.join(DATA_DIR, "outbound_stats.json")
+AI_CACHE_FILE = os.path.join(DATA_DIR, "ai_cache.json")
+GROUP_ACTIVITY_FILE = os.path.join(DATA_DIR, "group_activity.json")
+OUTBOUND_QUEUE_FILE = os.path.join(DATA_DIR, "outbound_queue.json")
+PRESCORER_FILE = os.getenv("PRESCORER_FILE", os.path.join(DATA_DIR, "prescorer.json"))
+LEADS_JOURNAL_FILE = os.path.join(DATA_DIR, "leads.journal.jsonl")
+LEADS_COMPACT_EVERY = int(os.getenv("LEADS_COMPACT_EVERY", "500"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower() or "json"
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, "bot.sqlite3"))
+PERSIST_FLUSH_SEC = float(os.getenv("PERSIST_FLUSH_SEC", "2"))
+PERSIST_FLUSH_DIRTY = int(os.getenv("PERSIST_FLUSH_DIRTY", "100"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or "0")
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(CACHE_DIR, exist_ok=True)
@@ -153,6 +336,14 @@ OUTBOUND_DM_PER_DAY = int(os.getenv("OUTBOUND_DM_PER_DAY", "25"))
 OUTBOUND_DM_PER_HOUR = int(os.getenv("OUTBOUND_DM_PER_HOUR", "8"))
 INVITE_PER_DAY = int(os.getenv("INVITE_PER_DAY", "20"))
 MIN_SECONDS_BETWEEN_DMS = int(os.getenv("MIN_SECONDS_BETWEEN_DMS", "180"))
+OUTBOUND_ROLLUP_DAYS = int(os.getenv("OUTBOUND_ROLLUP_DAYS", "30"))
+OUTBOUND_SPILL = os.getenv("OUTBOUND_SPILL", "1").strip() == "1"
+PEER_FLOOD_PAUSE_SEC = int(os.getenv("PEER_FLOOD_PAUSE_SEC", "21600"))
+OUTBOUND_JOB_MAX_AGE_HOURS = float(os.getenv("OUTBOUND_JOB_MAX_AGE_HOURS", "72"))
+SESSION_HEALTH_WINDOW_SEC = int(os.getenv("SESSION_HEALTH_WINDOW_SEC", "86400"))
+SESSION_FLOOD_HALF_WEIGHT_SEC = int(os.getenv("SESSION_FLOOD_HALF_WEIGHT_SEC", "3600"))
+
+GROUP_SHARDING = os.getenv("GROUP_SHARDING", "1").strip() == "1"
 
 LAWYER_SITE = "https://www.andriibilytskyi.com"
 LAWYER_ANWALT = "https://www.anwalt.de/andrii-bilytskyi"
@@ -184,11 +375,216 @@ INFO_BLOCK = (
 
 CLIENTS: Dict[str, TelegramClient] = {}
 ME_IDS: Dict[str, int] = {}
+ME_ID_SET: set = set()
 PERSIST_LOCK = asyncio.Lock()
 OUTBOUND_LOCK = asyncio.Lock()
 shutdown = asyncio.Event()
 
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if (AsyncOpenAI and OPENAI_API_KEY) else None
+openai_client = (
+    AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=OPENAI_MAX_RETRIES)
+    if (AsyncOpenAI and OPENAI_API_KEY) else None
+)
+
+
+# =============================================================================
+# METRICS
+# =============================================================================
+
+class _Metric:
+    """Metrics are updated from the event loop without locking; pass
+    threadsafe=True for the ones also updated from the persist thread."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), threadsafe: bool = False):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock() if threadsafe else None
+
+    def _guard(self):
+        return self._lock or contextlib.nullcontext()
+
+    def _label_str(self, values: Tuple, extra: str = "") -> str:
+        pairs = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterCell:
+    """One series of a MetricCounter, bound once: `cell.value += 1` on hot paths."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+class MetricCounter(_Metric):
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), threadsafe: bool = False):
+        super().__init__(name, help_text, labels, threadsafe)
+        self.values: Dict[Tuple, float] = {}
+        self.cells: Dict[Tuple, CounterCell] = {}
+
+    def cell(self, *label_values) -> CounterCell:
+        cell = self.cells.get(label_values)
+        if cell is None:
+            cell = self.cells[label_values] = CounterCell()
+        return cell
+
+    def inc(self, *label_values, amount: float = 1.0):
+        if self._lock is None:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+            return
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._guard():
+            totals = dict(self.values)
+        for key, cell in list(self.cells.items()):
+            totals[key] = totals.get(key, 0.0) + cell.value
+        items = totals.items()
+        lines += [f"{self.name}{self._label_str(k)} {v:g}" for k, v in sorted(items)]
+        return lines
+
+
+class MetricHistogram(_Metric):
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(
+        self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS, threadsafe: bool = False,
+    ):
+        super().__init__(name, help_text, labels, threadsafe)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *label_values):
+        with self._guard():
+            series = self.series.get(label_values)
+            if series is None:
+                # per-bucket counts, then sum and count
+                series = self.series[label_values] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._guard():
+            items = [(k, list(v)) for k, v in self.series.items()]
+        for key, series in sorted(items):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = self._label_str(key, 'le="%g"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative:g}")
+            le = self._label_str(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {series[-1]:g}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {series[-1]:g}")
+        return lines
+
+
+METRICS: List[_Metric] = []
+
+
+def _register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+M_EVENTS = _register(MetricCounter("bot_events_total", "NewMessage updates received", ("session", "kind")))
+EVENT_KINDS = ("private", "other", "monitored")
+M_CLASSIFY = _register(MetricCounter("bot_classify_total", "classify_message outcomes", ("category", "reason")))
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+M_CLASSIFY_SEC = _register(MetricHistogram("bot_classify_seconds", "classify_message time", buckets=FAST_BUCKETS))
+M_GET_SENDER_SEC = _register(MetricHistogram("bot_get_sender_seconds", "event.get_sender() time on sender cache misses"))
+M_AI_SEC = _register(MetricHistogram("bot_ai_request_seconds", "OpenAI request latency", ("mode", "outcome")))
+M_AI_FAILURES = _register(MetricCounter("bot_ai_failures_total", "Failed OpenAI requests", ("mode",)))
+# save_json also runs on the persist thread
+M_SAVE_SEC = _register(MetricHistogram("bot_save_json_seconds", "save_json duration", ("file",), threadsafe=True))
+M_SAVE_BYTES = _register(MetricCounter(
+    "bot_save_json_bytes_total", "Bytes written by save_json", ("file",), threadsafe=True,
+))
+M_LOCK_WAIT_SEC = _register(MetricHistogram(
+    "bot_persist_lock_wait_seconds", "Time spent waiting for PERSIST_LOCK", buckets=FAST_BUCKETS,
+))
+M_ADMIN_NOTICE_SEC = _register(MetricHistogram("bot_admin_notice_seconds", "send_admin_notice latency", ("outcome",)))
+M_OUTBOUND = _register(MetricCounter("bot_outbound_results_total", "DM/invite attempts by result", ("kind", "result")))
+
+
+def event_cells(session_name: str) -> List[CounterCell]:
+    """M_EVENTS cells of one session in EVENT_KINDS order, bound once per client."""
+    return [M_EVENTS.cell(session_name, kind) for kind in EVENT_KINDS]
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class timed_lock:
+    """`async with timed_lock(PERSIST_LOCK):` — acquires the lock and records the wait."""
+
+    def __init__(self, lock: asyncio.Lock, histogram: MetricHistogram = None):
+        self.lock = lock
+        self.histogram = histogram or M_LOCK_WAIT_SEC
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        await self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - started)
+        return self.lock
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+        return False
+
+
+METRICS_HEADER_TIMEOUT_SEC = 5.0
+
+
+async def _read_request_line(reader: asyncio.StreamReader) -> bytes:
+    request_line = await reader.readline()
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    return request_line
+
+
+async def _metrics_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(_read_request_line(reader), METRICS_HEADER_TIMEOUT_SEC)
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    """Prometheus text endpoint at http://METRICS_HOST:METRICS_PORT/metrics (off when the port is 0)."""
+    if METRICS_PORT <= 0:
+        return None
+    server = await asyncio.start_server(_metrics_client, METRICS_HOST, METRICS_PORT)
+    logging.info("Metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
 
 
 # =============================================================================
@@ -205,18 +601,485 @@ def load_json(path: str, default):
     return default
 
 
-def save_json(path: str, data):
+def save_json(path: str, data, compact: bool = False):
+    started = time.perf_counter()
     tmp = f"{path}.tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        if compact:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        size = f.tell()
     os.replace(tmp, path)
+    name = os.path.basename(path)
+    M_SAVE_SEC.observe(time.perf_counter() - started, name)
+    M_SAVE_BYTES.inc(name, amount=size)
+
+
+class LeadJournal:
+    """Lead store as a JSON snapshot plus an append-only JSONL upsert log.
+
+    Each update appends one line instead of rewriting the whole snapshot. On
+    startup the log is replayed over the snapshot; once it holds
+    `compact_every` records they are folded into a fresh snapshot and the log
+    is truncated. Replay is idempotent, so a crash between the two steps only
+    means some records are applied twice.
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str, compact_every: int):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = max(1, compact_every)
+        self.pending = 0
+        self._fh = None
+
+    def load(self) -> Dict[str, Any]:
+        leads = load_json(self.snapshot_path, {})
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        lead = json.loads(line)
+                        lead_id = lead["id"]
+                    except Exception:
+                        logging.warning("Skipping broken lead journal line in %s", self.journal_path)
+                        continue
+                    leads[lead_id] = lead
+                    self.pending += 1
+        return leads
+
+    def append(self, lead: Dict[str, Any]):
+        if self._fh is None:
+            self._fh = open(self.journal_path, "a", encoding="utf-8")
+        self._fh.write(json.dumps(lead, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._fh.flush()
+        self.pending += 1
+
+    def should_compact(self) -> bool:
+        return self.pending >= self.compact_every
+
+    def compact(self, leads: Dict[str, Any]):
+        save_json(self.snapshot_path, leads)
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        open(self.journal_path, "w", encoding="utf-8").close()
+        self.pending = 0
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+SEEN_TTL_BY_PREFIX = {
+    "msg:": int(float(os.getenv("SEEN_MSG_TTL_HOURS", "72")) * 3600),
+    "fp:": int(float(os.getenv("SEEN_FP_TTL_HOURS", "12")) * 3600),
+}
+SEEN_DEFAULT_TTL_SEC = 72 * 3600
+
+
+def seen_ttl(key: str) -> int:
+    for prefix, ttl in SEEN_TTL_BY_PREFIX.items():
+        if key.startswith(prefix):
+            return ttl
+    return SEEN_DEFAULT_TTL_SEC
+
+
+class SeenIndex(dict):
+    """SEEN dict (key -> insert ts) with a min-heap of expiry times.
+
+    expire() pops only what has actually expired, so dedup no longer walks
+    every key per message. Each key type gets its own TTL via seen_ttl().
+    Overwritten or removed keys leave stale heap entries behind; they are
+    skipped when they reach the top.
+    """
+
+    def __init__(self, data: Dict[str, Any] = None, now: float = None):
+        super().__init__()
+        self._heap: List[Tuple[float, str, float]] = []
+        now = time.time() if now is None else now
+        for key, ts in (data or {}).items():
+            ts = float(ts)
+            if ts + seen_ttl(key) > now:
+                self[key] = ts
+
+    def __setitem__(self, key: str, ts: float):
+        ts = float(ts)
+        super().__setitem__(key, ts)
+        heapq.heappush(self._heap, (ts + seen_ttl(key), key, ts))
+
+    def expire(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, key, ts = heapq.heappop(heap)
+            if self.get(key) == ts:
+                super().pop(key, None)
+                removed += 1
+        return removed
+
+    def is_fresh(self, key: str, now: float = None) -> bool:
+        ts = self.get(key)
+        if ts is None:
+            return False
+        now = time.time() if now is None else now
+        return now - ts < seen_ttl(key)
+
+# Every disk write happens on this single thread, which keeps writes ordered
+# and owns the SQLite connection when that backend is active.
+PERSIST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+
+
+def _snapshot(data):
+    """Deep copy of plain JSON data, cheap enough to take on the event loop."""
+    if isinstance(data, dict):
+        return {k: _snapshot(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_snapshot(v) for v in data]
+    return data
+
+
+class JsonStorage:
+    """One JSON document per store, as the bot always kept them; leads are journaled.
+
+    Backends work in two steps: snapshot() copies what a flush needs from the
+    live dicts on the event loop, and write() persists a batch of snapshots on
+    PERSIST_EXECUTOR.
+    """
+
+    name = "json"
+
+    FILES = {
+        "seen": SEEN_FILE,
+        "analytics": ANALYTICS_FILE,
+        "favorites": FAVORITES_FILE,
+        "outbound": OUTBOUND_FILE,
+    }
+
+    def __init__(self):
+        self.lead_journal = LeadJournal(LEADS_FILE, LEADS_JOURNAL_FILE, LEADS_COMPACT_EVERY)
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            "seen": load_json(SEEN_FILE, {}),
+            "leads": self.lead_journal.load(),
+            "analytics": load_json(ANALYTICS_FILE, {}),
+            "favorites": load_json(FAVORITES_FILE, {}),
+            "outbound": load_json(OUTBOUND_FILE, {}),
+        }
+
+    def snapshot(self, store: str, data: Dict[str, Any], keys) -> Any:
+        if store == "leads":
+            records = [_snapshot(data[k]) for k in keys if k in data]
+            compact = self.lead_journal.pending + len(records) >= self.lead_journal.compact_every
+            return {"records": records, "full": _snapshot(data) if compact else None}
+        return _snapshot(data)
+
+    def write(self, batch: List[Tuple[str, Any]]):
+        for store, payload in batch:
+            if store == "leads":
+                for lead in payload["records"]:
+                    self.lead_journal.append(lead)
+                if payload["full"] is not None:
+                    self.lead_journal.compact(payload["full"])
+            else:
+                save_json(self.FILES[store], payload)
+
+    def close(self, leads: Dict[str, Any]):
+        if self.lead_journal.pending:
+            self.lead_journal.compact(leads)
+        self.lead_journal.close()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS leads (
+    id TEXT PRIMARY KEY,
+    status TEXT,
+    session_name TEXT,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leads_status ON leads (status);
+CREATE INDEX IF NOT EXISTS leads_session ON leads (session_name);
+CREATE INDEX IF NOT EXISTS leads_created ON leads (created_at);
+CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, ts REAL NOT NULL, expires_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS seen_expires ON seen (expires_at);
+CREATE TABLE IF NOT EXISTS analytics (group_title TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS favorites (lead_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS outbound (
+    session_name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (session_name, kind, bucket)
+);
+"""
+
+# Outbound rows: "last_dm_ts", "win:<window>" (bucket = position in the
+# sliding log) and "rollup:<action>" (bucket = day). Pre-limiter rows used
+# the window names as kind with an hour/day bucket; they are read once and
+# replaced on the next write.
+OUTBOUND_LEGACY_KINDS = ("dm_day", "dm_hour", "invite_day")
+
+
+def _compact_json(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
 
+class SqliteStorage:
+    """SQLite (WAL) backend with per-record upserts.
 
-SEEN = load_json(SEEN_FILE, {})
-LEADS = load_json(LEADS_FILE, {})
-ANALYTICS = load_json(ANALYTICS_FILE, {})
-FAVORITES = load_json(FAVORITES_FILE, {})
-OUTBOUND_STATS = load_json(OUTBOUND_FILE, {})
+    The connection is only ever touched from PERSIST_EXECUTOR, so queries
+    never run on the event loop.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        return conn
+
+    def _execute(self, statements: List[Tuple[str, List[tuple]]]):
+        self.conn.execute("BEGIN")
+        try:
+            for sql, rows in statements:
+                self.conn.executemany(sql, rows)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # --- rows ---------------------------------------------------------------
+
+    @staticmethod
+    def _leads_rows(leads: Dict[str, Any]) -> Tuple[str, List[tuple]]:
+        rows = [
+            (
+                lead_id, lead.get("status"), lead.get("session_name"),
+                lead.get("created_at"), _compact_json(lead),
+            )
+            for lead_id, lead in leads.items()
+        ]
+        return ("INSERT OR REPLACE INTO leads (id, status, session_name, created_at, data) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _seen_rows(seen: Dict[str, Any]) -> Tuple[str, List[tuple]]:
+        rows = [(key, float(ts), float(ts) + seen_ttl(key)) for key, ts in seen.items()]
+        return ("INSERT OR REPLACE INTO seen (key, ts, expires_at) VALUES (?, ?, ?)", rows)
+
+    @staticmethod
+    def _analytics_rows(analytics: Dict[str, Any]) -> Tuple[str, List[tuple]]:
+        rows = [(g, _compact_json(data)) for g, data in analytics.items()]
+        return ("INSERT OR REPLACE INTO analytics (group_title, data) VALUES (?, ?)", rows)
+
+    @staticmethod
+    def _favorites_rows(favorites: Dict[str, Any]) -> Tuple[str, List[tuple]]:
+        rows = [(i, _compact_json(data)) for i, data in favorites.items()]
+        return ("INSERT OR REPLACE INTO favorites (lead_id, data) VALUES (?, ?)", rows)
+
+    @staticmethod
+    def _outbound_rows(outbound: Dict[str, Any]) -> Tuple[str, List[tuple]]:
+        rows = []
+        for session_name, s in outbound.items():
+            for kind in OUTBOUND_LEGACY_KINDS:
+                for bucket, count in (s.get(kind) or {}).items():
+                    rows.append((session_name, kind, bucket, float(count)))
+            for name, stamps in (s.get("windows") or {}).items():
+                for i, ts in enumerate(stamps):
+                    rows.append((session_name, f"win:{name}", str(i), float(ts)))
+            for action, days in (s.get("rollup") or {}).items():
+                for day, count in days.items():
+                    rows.append((session_name, f"rollup:{action}", day, float(count)))
+            rows.append((session_name, "last_dm_ts", "", float(s.get("last_dm_ts", 0.0) or 0.0)))
+        return ("INSERT OR REPLACE INTO outbound (session_name, kind, bucket, value) "
+                "VALUES (?, ?, ?, ?)", rows)
+
+    # --- load / migration ---------------------------------------------------
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        return PERSIST_EXECUTOR.submit(self._load).result()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        self.conn = self._connect()
+        if not self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+            self._migrate_from_json()
+
+        state = {"seen": {}, "leads": {}, "analytics": {}, "favorites": {}, "outbound": {}}
+        cutoff = time.time()
+        for key, ts in self.conn.execute("SELECT key, ts FROM seen WHERE expires_at >= ?", (cutoff,)):
+            state["seen"][key] = ts
+        for lead_id, data in self.conn.execute("SELECT id, data FROM leads"):
+            state["leads"][lead_id] = json.loads(data)
+        for group_title, data in self.conn.execute("SELECT group_title, data FROM analytics"):
+            state["analytics"][group_title] = json.loads(data)
+        for lead_id, data in self.conn.execute("SELECT lead_id, data FROM favorites"):
+            state["favorites"][lead_id] = json.loads(data)
+        for session_name, kind, bucket, value in self.conn.execute(
+            "SELECT session_name, kind, bucket, value FROM outbound"
+        ):
+            s = state["outbound"].setdefault(session_name, {})
+            if kind == "last_dm_ts":
+                s["last_dm_ts"] = value
+            elif kind.startswith("win:"):
+                s.setdefault("windows", {}).setdefault(kind[4:], []).append((int(bucket), value))
+            elif kind.startswith("rollup:"):
+                s.setdefault("rollup", {}).setdefault(kind[7:], {})[bucket] = int(value)
+            else:
+                s.setdefault(kind, {})[bucket] = int(value)
+        for s in state["outbound"].values():
+            for name, stamps in (s.get("windows") or {}).items():
+                s["windows"][name] = [ts for _, ts in sorted(stamps)]
+        return state
+
+    def _migrate_from_json(self):
+        """One-shot import of the JSON files; they are left in place untouched."""
+        state = JsonStorage().load()
+        statements = [getattr(self, f"_{store}_rows")(data) for store, data in state.items()]
+        statements.append((
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [("migrated_from_json", datetime.now().isoformat(timespec="seconds"))],
+        ))
+        self._execute(statements)
+        logging.info(
+            "Migrated JSON state into %s: %s leads, %s seen keys",
+            self.path, len(state["leads"]), len(state["seen"]),
+        )
+
+    # --- flush --------------------------------------------------------------
+
+    def snapshot(self, store: str, data: Dict[str, Any], keys) -> Any:
+        return {k: _snapshot(data[k]) for k in keys if k in data}
+
+    def write(self, batch: List[Tuple[str, Any]]):
+        statements = []
+        for store, payload in batch:
+            if store == "outbound":
+                # per-session state is rewritten whole; it is bounded by the limits
+                statements.append(("DELETE FROM outbound WHERE session_name = ?", [(k,) for k in payload]))
+            statements.append(getattr(self, f"_{store}_rows")(payload))
+        if any(store == "seen" for store, _ in batch):
+            statements.append(("DELETE FROM seen WHERE expires_at < ?", [(time.time(),)]))
+        self._execute(statements)
+
+    def close(self, leads: Dict[str, Any]):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def make_storage(backend: str):
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    if backend != "json":
+        logging.error("Unknown STORAGE_BACKEND=%s, using json", backend)
+    return JsonStorage()
+
+
+class PersistScheduler:
+    """Write-behind persistence: stores are marked dirty, flushes are coalesced.
+
+    A flush runs every `interval` seconds, or sooner once `max_dirty` marks
+    have piled up. The dirty records are snapshotted on the loop and written
+    by the storage backend on PERSIST_EXECUTOR.
+
+    Sidecars are state files kept outside the storage backend (caches,
+    queues). They expose a `dirty` flag, snapshot() and write(payload), and
+    are flushed on the same schedule and thread.
+    """
+
+    def __init__(self, storage, stores: Dict[str, Dict[str, Any]], interval: float, max_dirty: int):
+        self.storage = storage
+        self.stores = stores
+        self.interval = max(0.1, interval)
+        self.max_dirty = max(1, max_dirty)
+        self.dirty: Dict[str, set] = {}
+        self.sidecars: List[Any] = []
+        self.marks = 0
+        self.flushes = 0
+        self._pending = 0
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def register_sidecar(self, sidecar):
+        self.sidecars.append(sidecar)
+
+    def mark(self, store: str, *keys):
+        self.dirty.setdefault(store, set()).update(keys)
+        self.marks += 1
+        self._pending += 1
+        if self._pending >= self.max_dirty:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            loop = asyncio.get_running_loop()
+            if self.dirty:
+                dirty, self.dirty, self._pending = self.dirty, {}, 0
+                batch = [
+                    (store, self.storage.snapshot(store, self.stores[store], keys))
+                    for store, keys in dirty.items()
+                ]
+                try:
+                    await loop.run_in_executor(PERSIST_EXECUTOR, self.storage.write, batch)
+                except Exception:
+                    for store, keys in dirty.items():
+                        self.dirty.setdefault(store, set()).update(keys)
+                    raise
+                self.flushes += 1
+
+            for sidecar in self.sidecars:
+                if not sidecar.dirty:
+                    continue
+                sidecar.dirty = False
+                payload = sidecar.snapshot()
+                try:
+                    await loop.run_in_executor(PERSIST_EXECUTOR, sidecar.write, payload)
+                except Exception:
+                    sidecar.dirty = True
+                    raise
+
+    async def run(self):
+        while not shutdown.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Persist flush failed, will retry")
+
+    async def close(self):
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(PERSIST_EXECUTOR, self.storage.close, _snapshot(self.stores["leads"]))
+
+
+STORAGE = make_storage(STORAGE_BACKEND)
+_STATE = STORAGE.load()
+
+SEEN = _STATE["seen"] = SeenIndex(_STATE["seen"])
+LEADS = _STATE["leads"]
+ANALYTICS = _STATE["analytics"]
+FAVORITES = _STATE["favorites"]
+OUTBOUND_STATS = _STATE["outbound"]
+
+PERSIST = PersistScheduler(STORAGE, _STATE, PERSIST_FLUSH_SEC, PERSIST_FLUSH_DIRTY)
 
 INFLIGHT = set()
 
@@ -229,8 +1092,9 @@ REPLY_ACTIONS = {"lead_search_reply", "lead_question_reply", "partner_pitch"}
 
 DISCUSSION_WINDOW_SEC = int(os.getenv("DISCUSSION_WINDOW_SEC", "900"))
 MAX_GROUP_ACTIVITY_RECORDS = int(os.getenv("MAX_GROUP_ACTIVITY_RECORDS", "300"))
-
-GROUP_ACTIVITY: Dict[str, List[Tuple[float, str]]] = {}
+SENDER_CACHE_SIZE = int(os.getenv("SENDER_CACHE_SIZE", "5000"))
+SENDER_CACHE_TTL_SEC = int(os.getenv("SENDER_CACHE_TTL_SEC", "3600"))
+GROUP_ACTIVITY_SNAPSHOT_SEC = int(os.getenv("GROUP_ACTIVITY_SNAPSHOT_SEC", "60"))
 
 INVALID_USERNAME_VALUES = {
     "", "unknown", "none", "null", "n/a", "na", "-", "_"
@@ -247,6 +1111,7 @@ SERVICE_PREFIXES = (
     "🤖 AUTO_SEND ",
     "🤖 AUTO_INVITE ",
     "⭐ FAVORITE ",
+    "📬 OUTBOUND ",
 )
 
 SERVICE_USERNAMES = {
@@ -259,11 +1124,16 @@ SERVICE_USERNAMES = {
 }
 
 
+_URL_RE = re.compile(r"https?://\S+")
+_NON_WORD_RE = re.compile(r"[^\w\s@§/+.-]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
 def normalize(text: str) -> str:
     text = (text or "").lower()
-    text = re.sub(r"https?://\S+", " ", text)
-    text = re.sub(r"[^\w\s@§/+.-]", " ", text, flags=re.UNICODE)
-    text = re.sub(r"\s+", " ", text).strip()
+    text = _URL_RE.sub(" ", text)
+    text = _NON_WORD_RE.sub(" ", text)
+    text = _SPACE_RE.sub(" ", text).strip()
     return text
 
 
@@ -276,19 +1146,27 @@ def now_iso() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
 
-def detect_language(text: str) -> str:
-    t = text or ""
-    cyr = len(re.findall(r"[А-Яа-яЁёІіЇїЄєҐґ]", t))
-    lat = len(re.findall(r"[A-Za-zÄÖÜäöüß]", t))
+_CYR_RE = re.compile(r"[А-Яа-яЁёІіЇїЄєҐґ]")
+_LAT_RE = re.compile(r"[A-Za-zÄÖÜäöüß]")
+_UK_LETTERS_RE = re.compile(r"[ІіЇїЄєҐґ]")
+_DE_WORDS_RE = re.compile(r"\b(der|die|das|und|nicht|mit|für|anwalt|recht|versicherung)\b")
+
+
+def _language_from_counts(text: str, lowered: str, cyr: int, lat: int) -> str:
     if cyr >= lat:
-        if re.search(r"[ІіЇїЄєҐґ]", t):
+        if _UK_LETTERS_RE.search(text):
             return "uk"
         return "ru"
-    if re.search(r"\b(der|die|das|und|nicht|mit|für|anwalt|recht|versicherung)\b", t.lower()):
+    if _DE_WORDS_RE.search(lowered):
         return "de"
     return "en"
 
 
+def detect_language(text: str) -> str:
+    t = text or ""
+    return _language_from_counts(t, t.lower(), len(_CYR_RE.findall(t)), len(_LAT_RE.findall(t)))
+
+
 def localized_intro(language: str) -> str:
     language = (language or "").lower()
     if language == "uk":
@@ -300,14 +1178,39 @@ def localized_intro(language: str) -> str:
     return "Я - Юстин, помощник адвоката Андрея Билицкого."
 
 
+INTRO_LANGUAGES = ("ru", "uk", "de", "en")
+
+
+def assemble_reply(language: str, body: str) -> str:
+    """Intro + personalized body + INFO_BLOCK, the layout every DM uses.
+
+    A body that still carries the intro or the start of the info block (the
+    model sometimes repeats them) is trimmed first, so both appear once.
+    """
+    body = (body or "").strip()
+    for lang in INTRO_LANGUAGES:
+        intro = localized_intro(lang)
+        if body.startswith(intro):
+            body = body[len(intro):].strip()
+            break
+    info_head = INFO_BLOCK.split("\n", 1)[0].rstrip(" -")
+    cut = body.find(info_head)
+    if cut != -1:
+        body = body[:cut].rstrip()
+    return f"{localized_intro(language)}\n{body}\n\n{INFO_BLOCK}"
+
+
+# Matched against lowercased text: re.IGNORECASE disables sre's prefix scan.
+CONTACT_RE = re.compile(
+    r"(?:\+?\d[\d\s().-]{7,}\d)"
+    r"|@\w{4,}"
+    r"|(?:whatsapp|viber|telegram|tg|instagram|insta|email|e-mail|webseite|site|сайт|личные сообщения|в личку|пишите в лс|пишіть у приват)"
+    r"|https?://"
+)
+
+
 def phone_or_contact_present(text: str) -> bool:
-    t = text or ""
-    return bool(
-        re.search(r"(?:\+?\d[\d\s().-]{7,}\d)", t)
-        or re.search(r"@\w{4,}", t)
-        or re.search(r"(?:whatsapp|viber|telegram|tg|instagram|insta|email|e-mail|webseite|site|сайт|личные сообщения|в личку|пишите в лс|пишіть у приват)", t, re.I)
-        or re.search(r"https?://", t, re.I)
-    )
+    return CONTACT_RE.search((text or "").lower()) is not None
 
 
 def build_message_link(chat, message_id: int) -> str:
@@ -346,17 +1249,58 @@ def update_analytics_bucket(group_title: str, category: str):
     ANALYTICS[group_title] = group_data
 
 
-def hash_fingerprint(sender_username: str, text: str) -> str:
+def hash_fingerprint(sender_username: str, text: str, analysis: "MessageAnalysis" = None) -> str:
     sender_key = (sender_username or "").lower().strip()
-    base = normalize(text)[:300]
+    base = (analysis.normalized if analysis is not None else normalize(text))[:300]
     return f"{sender_key}|{base}"
 
 
-def purge_seen(hours: int = 72):
-    now = time.time()
-    stale = [k for k, ts in SEEN.items() if now - float(ts) > hours * 3600]
-    for k in stale:
-        SEEN.pop(k, None)
+class MessageAnalysis:
+    """Per-message text features, computed once and shared by the pipeline.
+
+    Script counts and language are only needed for messages that reach the AI
+    step, so they are filled in on first access.
+    """
+
+    __slots__ = (
+        "text", "lowered", "normalized", "has_contact", "fingerprint",
+        "_script_counts", "_language", "_compact", "prompted",
+    )
+
+    def __init__(self, text: str, sender_username: str = ""):
+        self.text = text or ""
+        self.lowered = self.text.lower()
+        self.normalized = normalize(self.text)
+        self.has_contact = CONTACT_RE.search(self.lowered) is not None
+        self.fingerprint = hash_fingerprint(sender_username, self.text, self)
+        self._script_counts = None
+        self._language = None
+        self._compact = None
+        # set once the text has gone into an OpenAI prompt
+        self.prompted = False
+
+    @property
+    def script_counts(self) -> Tuple[int, int]:
+        if self._script_counts is None:
+            self._script_counts = (len(_CYR_RE.findall(self.text)), len(_LAT_RE.findall(self.text)))
+        return self._script_counts
+
+    @property
+    def language(self) -> str:
+        if self._language is None:
+            cyr, lat = self.script_counts
+            self._language = _language_from_counts(self.text, self.lowered, cyr, lat)
+        return self._language
+
+    @property
+    def compact_text(self) -> str:
+        if self._compact is None:
+            self._compact = compact_for_ai(self.text)
+        return self._compact
+
+
+def purge_seen() -> int:
+    return SEEN.expire()
 
 
 def is_service_message_text(text: str) -> bool:
@@ -369,7 +1313,7 @@ def known_internal_sender(sender) -> bool:
         return False
     sender_id = getattr(sender, "id", None)
     sender_username = (getattr(sender, "username", "") or "").lower()
-    if sender_id and sender_id in set(ME_IDS.values()):
+    if sender_id and sender_id in ME_ID_SET:
         return True
     if sender_username and sender_username in SERVICE_USERNAMES:
         return True
@@ -416,30 +1360,202 @@ def make_sender_activity_key(sender) -> str:
     return f"name:{display_name}"
 
 
+class SenderProfile:
+    """A sender with the filter decisions handle_candidate_message needs."""
+
+    __slots__ = (
+        "sender", "id", "username", "display_name", "internal", "active_username", "bot",
+        "activity_key", "cached_at",
+    )
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.id = getattr(sender, "id", None)
+        self.username = getattr(sender, "username", None)
+        self.display_name = sender_display_name(sender)
+        self.internal = known_internal_sender(sender)
+        self.active_username = has_active_username(sender)
+        self.bot = bool(getattr(sender, "bot", False))
+        self.activity_key = make_sender_activity_key(sender)
+        self.cached_at = time.time()
+
+
+class SenderCache:
+    """LRU of SenderProfile by sender id, so repeat posters skip get_sender.
+
+    A profile is reused for SENDER_CACHE_TTL_SEC unless the sender entity
+    that came with the update (no network) shows a different username.
+    Cleared when ME_ID_SET changes, since `internal` depends on it.
+    """
+
+    def __init__(self, max_size: int, ttl_sec: float):
+        self.max_size = max(1, max_size)
+        self.ttl_sec = ttl_sec
+        self.entries: "OrderedDict[int, SenderProfile]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def profile(self, event, sender=None) -> SenderProfile:
+        sender_id = getattr(event, "sender_id", None)
+        if sender is None:
+            sender = getattr(event, "sender", None)
+
+        cached = self.entries.get(sender_id) if sender_id is not None else None
+        if (
+            cached is not None
+            and time.time() - cached.cached_at <= self.ttl_sec
+            and (sender is None or getattr(sender, "username", None) == cached.username)
+        ):
+            self.entries.move_to_end(sender_id)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        if sender is None:
+            started = time.perf_counter()
+            sender = await event.get_sender()
+            M_GET_SENDER_SEC.observe(time.perf_counter() - started)
+        profile = SenderProfile(sender)
+        if profile.id is not None:
+            self.entries[profile.id] = profile
+            self.entries.move_to_end(profile.id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return profile
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100.0) if total else 0.0
+        return f"Sender cache: {self.hits} hits / {self.misses} misses ({rate:.0f}%), {len(self.entries)} entries"
+
+
+SENDER_CACHE = SenderCache(SENDER_CACHE_SIZE, SENDER_CACHE_TTL_SEC)
+
+
+class ActivityRing:
+    """Recent (ts, sender_key) records of one chat with running per-sender counts.
+
+    Records leave from the left once older than DISCUSSION_WINDOW_SEC or
+    beyond MAX_GROUP_ACTIVITY_RECORDS, and the Counter is kept in step, so
+    the discussion check needs no scan.
+    """
+
+    __slots__ = ("records", "counts")
+
+    def __init__(self):
+        self.records: deque = deque()
+        self.counts: Counter = Counter()
+
+    def _drop_left(self):
+        _, sender_key = self.records.popleft()
+        left = self.counts[sender_key] - 1
+        if left:
+            self.counts[sender_key] = left
+        else:
+            del self.counts[sender_key]
+
+    def expire(self, now: float):
+        cutoff = now - DISCUSSION_WINDOW_SEC
+        while self.records and self.records[0][0] < cutoff:
+            self._drop_left()
+
+    def push(self, ts: float, sender_key: str):
+        self.records.append((ts, sender_key))
+        self.counts[sender_key] += 1
+        while len(self.records) > MAX_GROUP_ACTIVITY_RECORDS:
+            self._drop_left()
+
+
+class GroupActivityTracker:
+    """ActivityRing per chat, snapshotted as a PERSIST sidecar.
+
+    The snapshot is written at most every GROUP_ACTIVITY_SNAPSHOT_SEC
+    (0 disables it), so discussion context survives a restart without
+    rewriting the file on every group message. Rings of chats that have
+    gone quiet are dropped at most every DISCUSSION_WINDOW_SEC, with or
+    without snapshots.
+    """
+
+    def __init__(self, path: str, snapshot_every: float):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.rings: Dict[str, ActivityRing] = {}
+        self._changed = False
+        self._written_at = 0.0
+        self._swept_at = 0.0
+
+    @property
+    def dirty(self) -> bool:
+        return (
+            self.snapshot_every > 0
+            and self._changed
+            and time.time() - self._written_at >= self.snapshot_every
+        )
+
+    @dirty.setter
+    def dirty(self, value: bool):
+        self._changed = value
+        if not value:
+            self._written_at = time.time()
+
+    def _sweep(self, now: float):
+        for key, ring in list(self.rings.items()):
+            ring.expire(now)
+            if not ring.records:
+                del self.rings[key]
+        self._swept_at = now
+
+    def ring(self, chat_id: int) -> ActivityRing:
+        now = time.time()
+        if now - self._swept_at >= DISCUSSION_WINDOW_SEC:
+            self._sweep(now)
+        key = str(chat_id)
+        ring = self.rings.get(key)
+        if ring is None:
+            ring = self.rings[key] = ActivityRing()
+        ring.expire(now)
+        return ring
+
+    def load(self):
+        if self.snapshot_every <= 0:
+            return
+        now = time.time()
+        for key, records in load_json(self.path, {}).items():
+            ring = ActivityRing()
+            for ts, sender_key in records:
+                if now - ts <= DISCUSSION_WINDOW_SEC:
+                    ring.push(ts, sender_key)
+            if ring.records:
+                self.rings[key] = ring
+
+    def snapshot(self):
+        self._sweep(time.time())
+        return {key: [list(r) for r in ring.records] for key, ring in self.rings.items()}
+
+    def write(self, payload):
+        save_json(self.path, payload)
+
+
+GROUP_ACTIVITY = GroupActivityTracker(GROUP_ACTIVITY_FILE, GROUP_ACTIVITY_SNAPSHOT_SEC)
+GROUP_ACTIVITY.load()
+PERSIST.register_sidecar(GROUP_ACTIVITY)
+
+
 def prune_group_activity(chat_id: int):
-    key = str(chat_id)
-    now = time.time()
-    items = GROUP_ACTIVITY.get(key, [])
-    items = [(ts, skey) for ts, skey in items if now - ts <= DISCUSSION_WINDOW_SEC]
-    GROUP_ACTIVITY[key] = items[-MAX_GROUP_ACTIVITY_RECORDS:]
+    GROUP_ACTIVITY.ring(chat_id)
 
 
 def remember_group_activity(chat_id: int, sender_key: str):
-    key = str(chat_id)
-    prune_group_activity(chat_id)
-    items = GROUP_ACTIVITY.get(key, [])
-    items.append((time.time(), sender_key))
-    GROUP_ACTIVITY[key] = items[-MAX_GROUP_ACTIVITY_RECORDS:]
+    GROUP_ACTIVITY.ring(chat_id).push(time.time(), sender_key)
+    GROUP_ACTIVITY.dirty = True
 
 
 def sender_is_in_group_discussion(chat_id: int, sender_key: str) -> bool:
-    prune_group_activity(chat_id)
-    items = GROUP_ACTIVITY.get(str(chat_id), [])
-
-    distinct_senders = {k for _, k in items}
-    own_count = sum(1 for _, k in items if k == sender_key)
-
-    return len(distinct_senders) >= 2 and own_count >= 1
+    counts = GROUP_ACTIVITY.ring(chat_id).counts
+    return len(counts) >= 2 and sender_key in counts
 
 
 # =============================================================================
@@ -496,27 +1612,84 @@ QUESTION_RE = re.compile(
 )
 
 
-def classify_message(text: str) -> Tuple[str, str]:
-    t = normalize(text)
+_NON_CAPTURING_RE = re.compile(r"(?<!\\)\((?!\?)")
+
+
+class PatternFamily:
+    """Ordered rule patterns behind one precompiled alternation.
+
+    The combined regex has no capturing groups, which keeps sre's prefix
+    scanning intact, so the common no-match case costs a single search. On a
+    hit the member patterns are checked in list order, so the reported pattern
+    is the same one a sequential re.search loop would return.
+    """
+
+    __slots__ = ("patterns", "compiled", "combined")
+
+    def __init__(self, patterns: List[str], flags: int = 0):
+        self.patterns = list(patterns)
+        self.compiled = [re.compile(p, flags) for p in self.patterns]
+        self.combined = re.compile(
+            "(?:" + "|".join(_NON_CAPTURING_RE.sub("(?:", p) for p in self.patterns) + ")",
+            flags,
+        )
+
+    def first_match(self, text: str):
+        if not self.combined.search(text):
+            return None
+        for pat, rx in zip(self.patterns, self.compiled):
+            if rx.search(text):
+                return pat
+        return None
+
+
+class HintSet:
+    """Substring hint list, deduplicated and frozen once at startup."""
+
+    __slots__ = ("hints",)
+
+    def __init__(self, hints: List[str]):
+        self.hints = tuple(dict.fromkeys(h.lower() for h in hints if h))
+
+    def present(self, text: str) -> bool:
+        for h in self.hints:
+            if h in text:
+                return True
+        return False
+
+
+# classify_message matches these against normalize() output, which is already
+# lowercase, so the families are compiled without re.IGNORECASE.
+SPAM_MATCHER = PatternFamily(SPAM_PATTERNS)
+LEAD_SEARCH_MATCHER = PatternFamily(LEAD_SEARCH_PATTERNS)
+LEGAL_HINT_SET = HintSet(LEGAL_HINTS)
+PARTNER_HINT_SET = HintSet(PARTNER_SERVICE_HINTS)
+COMPETITOR_HINT_SET = HintSet(LAWYER_COMPETITOR_HINTS)
+
+
+def classify_message(text: str, analysis: MessageAnalysis = None) -> Tuple[str, str]:
+    if analysis is None:
+        analysis = MessageAnalysis(text)
+    t = analysis.normalized
     if not t or len(t) < 3:
         return ("ignore", "empty_or_short")
 
-    for pat in SPAM_PATTERNS:
-        if re.search(pat, t, re.I):
-            return ("reject_spam", f"spam:{pat}")
+    pat = SPAM_MATCHER.first_match(t)
+    if pat is not None:
+        return ("reject_spam", f"spam:{pat}")
 
-    for pat in LEAD_SEARCH_PATTERNS:
-        if re.search(pat, t, re.I):
-            return ("lead_search", f"lead_search:{pat}")
+    pat = LEAD_SEARCH_MATCHER.first_match(t)
+    if pat is not None:
+        return ("lead_search", f"lead_search:{pat}")
 
-    has_contact = phone_or_contact_present(text)
-    has_partner_hint = any(h in t for h in PARTNER_SERVICE_HINTS)
-    is_likely_competitor_lawyer = any(h in t for h in LAWYER_COMPETITOR_HINTS)
+    # Hint scans only run when their result can change the outcome.
+    has_contact = analysis.has_contact
+    is_likely_competitor_lawyer = has_contact and COMPETITOR_HINT_SET.present(t)
 
-    if has_contact and has_partner_hint and not is_likely_competitor_lawyer:
+    if has_contact and not is_likely_competitor_lawyer and PARTNER_HINT_SET.present(t):
         return ("partner_services", "partner_services:contact+adjacent_service")
 
-    if QUESTION_RE.search(text or "") and any(h in t for h in LEGAL_HINTS):
+    if LEGAL_HINT_SET.present(t) and QUESTION_RE.search(analysis.text):
         return ("lead_question", "lead_question:question+legal_hint")
 
     if has_contact and is_likely_competitor_lawyer:
@@ -525,6 +1698,197 @@ def classify_message(text: str) -> Tuple[str, str]:
     return ("ignore", "no_match")
 
 
+# =============================================================================
+# PRE-SCORER
+# =============================================================================
+
+class PreScorer:
+    """Hashed n-gram logistic regression that predicts whether AI would reply.
+
+    Trained offline from lead history by train_prescorer.py. Candidates that
+    score below PRESCORER_THRESHOLD skip the OpenAI call; with the default
+    threshold of 0 the score is only recorded on the lead.
+    """
+
+    def __init__(self, weights: Dict[int, float], bias: float, buckets: int, meta: Dict[str, Any] = None):
+        self.weights = weights
+        self.bias = bias
+        self.buckets = buckets
+        self.meta = meta or {}
+
+    @staticmethod
+    def features(normalized_text: str, category: str, buckets: int) -> List[int]:
+        tokens = normalized_text.split()
+        grams = [f"c:{category}"]
+        grams.extend(f"u:{tok}" for tok in tokens)
+        grams.extend(f"b:{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        return list({zlib.crc32(g.encode("utf-8")) % buckets for g in grams})
+
+    def raw_score(self, feats: List[int]) -> float:
+        w = self.weights
+        z = self.bias + sum(w.get(f, 0.0) for f in feats)
+        z = max(-30.0, min(30.0, z))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def score(self, normalized_text: str, category: str) -> float:
+        return self.raw_score(self.features(normalized_text, category, self.buckets))
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "buckets": self.buckets,
+            "bias": self.bias,
+            "weights": {str(k): round(v, 6) for k, v in self.weights.items() if abs(v) > 1e-6},
+            "meta": self.meta,
+        }
+
+    @classmethod
+    def load(cls, path: str) -> Optional["PreScorer"]:
+        data = load_json(path, None)
+        if not data:
+            return None
+        try:
+            weights = {int(k): float(v) for k, v in data["weights"].items()}
+            return cls(weights, float(data["bias"]), int(data["buckets"]), data.get("meta"))
+        except Exception:
+            logging.error("Invalid pre-scorer model in %s", path)
+            return None
+
+
+PRESCORER = PreScorer.load(PRESCORER_FILE)
+if PRESCORER:
+    logging.info("Pre-scorer loaded from %s (threshold %.2f)", PRESCORER_FILE, PRESCORER_THRESHOLD)
+
+
+# =============================================================================
+# AI INPUT COMPACTION
+# =============================================================================
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+# A leading "+" or at least 9 digits, so year and price ranges stay text.
+_PHONE_RE = re.compile(r"\+\d[\d\s().-]{7,}\d|(?<![\w+])(?:\d[\s().-]?){8,}\d(?!\w)")
+_HANDLE_RE = re.compile(r"(?<![\w@])@\w{4,}")
+_EMOJI_RUN_RE = re.compile("([\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF])[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200d]+")
+_HASHTAG_RE = re.compile(r"#\w+")
+_MARKER_RUN_RE = re.compile(r"(<(?:link|contact)>)(?:[\s,;|/]*<(?:link|contact)>)+")
+_BOILERPLATE_LINE_RE = re.compile(r"^[\W_]*(?:<(?:link|contact)>[\W_]*)+$")
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough tokenizer-free estimate: ~4 UTF-8 bytes per token for ru/uk/de/en."""
+    return (len((text or "").encode("utf-8")) + 3) // 4
+
+
+def _sentence_rank(sentence: str) -> int:
+    """0 = lead search / legal question, 1 = partner hint, 2 = everything else."""
+    t = normalize(sentence)
+    if LEAD_SEARCH_MATCHER.combined.search(t) or LEGAL_HINT_SET.present(t):
+        return 0
+    if PARTNER_HINT_SET.present(t):
+        return 1
+    return 2
+
+
+def compact_for_ai(text: str, budget_tokens: int = None) -> str:
+    """Strip cross-posting noise before a message goes to OpenAI.
+
+    Drops repeated lines and hashtags, replaces links and contact details
+    with <link>/<contact> markers (keeping one line that only holds
+    markers), and collapses emoji runs. If the result is still above the
+    token budget, sentences matching the lead/legal rules are kept first,
+    then partner-service sentences, then the rest, in original order.
+    """
+    budget_tokens = AI_INPUT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+
+    lines = []
+    seen_lines = set()
+    seen_tags = set()
+    kept_marker_line = False
+    for raw in (text or "").splitlines():
+        line = _URL_RE.sub("<link>", raw)
+        line = _EMAIL_RE.sub("<contact>", line)
+        line = _PHONE_RE.sub("<contact>", line)
+        line = _HANDLE_RE.sub("<contact>", line)
+        line = _MARKER_RUN_RE.sub(r"\1", line)
+        line = _EMOJI_RUN_RE.sub(r"\1", line)
+
+        def _tag(m):
+            tag = m.group(0).lower()
+            if tag in seen_tags:
+                return ""
+            seen_tags.add(tag)
+            return m.group(0)
+
+        line = _HASHTAG_RE.sub(_tag, line)
+        line = _SPACE_RE.sub(" ", line).strip()
+        if not line:
+            continue
+
+        key = normalize(line)
+        if key in seen_lines:
+            continue
+        seen_lines.add(key)
+
+        if _BOILERPLATE_LINE_RE.match(line):
+            if kept_marker_line:
+                continue
+            kept_marker_line = True
+        lines.append(line)
+
+    compact = "\n".join(lines)
+    if budget_tokens <= 0 or estimate_tokens(compact) <= budget_tokens:
+        return compact
+
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(compact) if s and s.strip()]
+    ranks = [_sentence_rank(sentence) for sentence in sentences]
+    chosen = set()
+    used = 0
+    for rank in (0, 1, 2):
+        for i, sentence in enumerate(sentences):
+            if ranks[i] != rank:
+                continue
+            cost = estimate_tokens(sentence) + 1
+            if used + cost > budget_tokens:
+                continue
+            chosen.add(i)
+            used += cost
+    return "\n".join(sentences[i] for i in sorted(chosen))
+
+
+class AIInputStats:
+    """Running totals of AI input size before and after compaction."""
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def record(self, before: str, after: str):
+        self.calls += 1
+        self.tokens_before += estimate_tokens(before)
+        self.tokens_after += estimate_tokens(after)
+
+    def stats_line(self) -> str:
+        saved = self.tokens_before - self.tokens_after
+        pct = (saved / self.tokens_before * 100.0) if self.tokens_before else 0.0
+        return (
+            f"AI input: {self.calls} calls, ~{self.tokens_before} -> ~{self.tokens_after} "
+            f"message tokens ({pct:.0f}% saved)"
+        )
+
+
+AI_INPUT_STATS = AIInputStats()
+
+
+def ai_input_sizes(analysis: "MessageAnalysis") -> Dict[str, int]:
+    return {
+        "chars": len(analysis.text),
+        "compact_chars": len(analysis.compact_text),
+        "tokens_est": estimate_tokens(analysis.text),
+        "compact_tokens_est": estimate_tokens(analysis.compact_text),
+    }
+
+
 # =============================================================================
 # OPENAI
 # =============================================================================
@@ -537,7 +1901,7 @@ AI_JSON_FALLBACK = {
     "reply_text": "",
 }
 
-AI_SYSTEM = f"""
+AI_SYSTEM_FULL = f"""
 Ты — Юстин, цифровой помощник адвоката Андрія Білицького.
 Твоя задача — подготовить КОРОТКИЙ и ПРАВДОПОДОБНЫЙ текст личного сообщения в Telegram.
 
@@ -583,7 +1947,51 @@ AI_SYSTEM = f"""
 """
 
 
-def _normalize_ai_payload(message_text: str, parsed: Dict[str, Any]) -> Dict[str, Any]:
+AI_SYSTEM_BODY = f"""
+Ты — Юстин, цифровой помощник адвоката Андрія Білицького.
+Твоя задача — подготовить КОРОТКУЮ персональную часть личного сообщения в Telegram.
+
+О юристе:
+- {LAWYER_BRIEF}
+- Сайт: {LAWYER_SITE}
+- Профиль: {LAWYER_ANWALT}
+- Telegram-группа: {LAWYER_GROUP}
+
+Правила:
+1. Пиши на языке исходного сообщения.
+2. Не придумывай фактов и не обещай результат.
+3. Не пиши как массовая реклама.
+4. Тон: живой, вежливый, короткий, персональный.
+5. reply_text — только 1-3 предложения по сути сообщения.
+   Не представляйся и не добавляй контакты, адреса или инфоблок:
+   представление и инфоблок бот добавит сам.
+6. Для lead_search / lead_question: предложи коротко описать ситуацию.
+7. Для partner_pitch: предложи профессиональный контакт/взаимные рекомендации; не дави и не спамь.
+8. Для skip reply_text должен быть пустой.
+9. Верни ответ строго в формате JSON.
+10. Только JSON object. Без markdown, без пояснений, без лишнего текста.
+
+Верни только JSON:
+{{
+  "action": "skip|lead_search_reply|lead_question_reply|partner_pitch",
+  "confidence": 0.0,
+  "language": "ru|uk|de|en",
+  "reason": "short reason",
+  "reply_text": "..."
+}}
+"""
+
+# With AI_REPLY_ASSEMBLY the model writes only the personalized body and
+# assemble_reply adds the intro and INFO_BLOCK, instead of the model copying
+# the whole block into every reply.
+AI_SYSTEM = AI_SYSTEM_BODY if AI_REPLY_ASSEMBLY else AI_SYSTEM_FULL
+
+
+def _normalize_ai_payload(
+    message_text: str,
+    parsed: Dict[str, Any],
+    analysis: MessageAnalysis = None,
+) -> Dict[str, Any]:
     parsed = parsed or {}
 
     action = str(parsed.get("action", "skip") or "skip").strip()
@@ -598,10 +2006,12 @@ def _normalize_ai_payload(message_text: str, parsed: Dict[str, Any]) -> Dict[str
 
     language = str(parsed.get("language", "") or "").strip().lower()
     if language not in {"ru", "uk", "de", "en"}:
-        language = detect_language(message_text)
+        language = analysis.language if analysis is not None else detect_language(message_text)
 
     reason = str(parsed.get("reason", "no_reason") or "no_reason").strip()
     reply_text = str(parsed.get("reply_text", "") or "").strip()
+    if AI_REPLY_ASSEMBLY and reply_text and action != "skip":
+        reply_text = assemble_reply(language, reply_text)
 
     return {
         "action": action,
@@ -612,16 +2022,357 @@ def _normalize_ai_payload(message_text: str, parsed: Dict[str, Any]) -> Dict[str
     }
 
 
+class OpenAIGateway:
+    """Latency- and error-aware wrapper around openai_client.responses.create.
+
+    - Circuit breaker: once AI_BREAKER_ERROR_RATE of the calls within
+      AI_BREAKER_WINDOW_SEC failed (with at least AI_BREAKER_MIN_CALLS
+      samples), calls are refused for AI_BREAKER_COOLDOWN_SEC; then a single
+      probe decides whether to close again.
+    - Mode selector: when json_object format fails but the plain call
+      works, json mode is skipped for AI_JSON_MODE_RETRY_SEC.
+    - Hedging: a call still running after the recent p95 latency (clamped to
+      AI_HEDGE_MIN_SEC..OPENAI_TIMEOUT_SEC, AI_HEDGE_AFTER_SEC until enough
+      samples) gets a second identical request; the first success wins.
+    """
+
+    def __init__(self):
+        self.outcomes = deque()
+        self.latencies = deque(maxlen=100)
+        self.opened_at = 0.0
+        self.state = "closed"
+        self.probe_inflight = False
+        self.probe_started_at = 0.0
+        self.json_mode_disabled_until = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    # --- circuit breaker -----------------------------------------------------
+
+    def _trim(self, now: float):
+        while self.outcomes and now - self.outcomes[0][0] > AI_BREAKER_WINDOW_SEC:
+            self.outcomes.popleft()
+
+    def allow(self) -> bool:
+        now = time.time()
+        if self.state == "open":
+            if now - self.opened_at < AI_BREAKER_COOLDOWN_SEC:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            # A probe that never reported back (e.g. cancelled) must not wedge the breaker.
+            if self.probe_inflight and now - self.probe_started_at < 3 * OPENAI_TIMEOUT_SEC:
+                self.rejected += 1
+                return False
+            self.probe_inflight = True
+            self.probe_started_at = now
+        return True
+
+    def record(self, ok: bool):
+        now = time.time()
+        self.calls += 1
+        if not ok:
+            self.failures += 1
+        if self.state == "half_open":
+            self.probe_inflight = False
+            if ok:
+                self.state = "closed"
+                self.outcomes.clear()
+            else:
+                self.state = "open"
+                self.opened_at = now
+            return
+
+        self.outcomes.append((now, ok))
+        self._trim(now)
+        if len(self.outcomes) >= AI_BREAKER_MIN_CALLS:
+            errors = sum(1 for _, good in self.outcomes if not good)
+            if errors / len(self.outcomes) >= AI_BREAKER_ERROR_RATE:
+                self.state = "open"
+                self.opened_at = now
+                logging.warning("OpenAI circuit opened: %s/%s recent calls failed", errors, len(self.outcomes))
+
+    # --- mode selector -------------------------------------------------------
+
+    def modes(self) -> List[str]:
+        if time.time() < self.json_mode_disabled_until:
+            return ["plain"]
+        return ["json", "plain"]
+
+    def json_mode_failed(self):
+        self.json_mode_disabled_until = time.time() + AI_JSON_MODE_RETRY_SEC
+        logging.warning("OpenAI json_object mode disabled for %ss", int(AI_JSON_MODE_RETRY_SEC))
+
+    # --- hedging -------------------------------------------------------------
+
+    def hedge_delay(self) -> Optional[float]:
+        if not AI_HEDGE:
+            return None
+        if len(self.latencies) < 20:
+            return AI_HEDGE_AFTER_SEC
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return max(AI_HEDGE_MIN_SEC, min(p95, float(OPENAI_TIMEOUT_SEC)))
+
+    async def _timed_create(self, **kwargs):
+        started = time.monotonic()
+        resp = await asyncio.wait_for(openai_client.responses.create(**kwargs), timeout=OPENAI_TIMEOUT_SEC)
+        self.latencies.append(time.monotonic() - started)
+        return resp
+
+    async def create(self, **kwargs):
+        first = asyncio.ensure_future(self._timed_create(**kwargs))
+        pending = {first}
+        try:
+            delay = self.hedge_delay()
+            if delay is None or delay >= OPENAI_TIMEOUT_SEC:
+                return await first
+
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            self.hedged += 1
+            second = asyncio.ensure_future(self._timed_create(**kwargs))
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # also runs when the caller is cancelled (queue shedding, shutdown)
+            for task in pending:
+                task.cancel()
+
+    # --- startup / stats -----------------------------------------------------
+
+    async def prewarm(self):
+        """Open the HTTP connection pool (DNS + TLS) before the first lead."""
+        if not openai_client:
+            return
+        try:
+            await asyncio.wait_for(openai_client.models.list(), timeout=OPENAI_TIMEOUT_SEC)
+            logging.info("OpenAI connection pool warmed")
+        except Exception as e:
+            logging.warning("OpenAI prewarm failed: %s", e)
+
+    def stats_line(self) -> str:
+        ordered = sorted(self.latencies)
+        p50 = ordered[len(ordered) // 2] if ordered else 0.0
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+        json_mode = "off" if time.time() < self.json_mode_disabled_until else "on"
+        return (
+            f"OpenAI: circuit {self.state}, json mode {json_mode}, "
+            f"{self.failures}/{self.calls} failed, {self.rejected} rejected, "
+            f"hedged {self.hedged} (won {self.hedge_wins}), p50 {p50:.1f}s p95 {p95:.1f}s"
+        )
+
+
+AI_GATEWAY = OpenAIGateway()
+
+SCENARIO_REPLY_ACTIONS = {
+    "lead_search": "lead_search_reply",
+    "lead_question": "lead_question_reply",
+    "partner_services": "partner_pitch",
+}
+
+
+def rule_based_verdict(scenario_hint: str, analysis: "MessageAnalysis", reason: str) -> Dict[str, Any]:
+    """Verdict used when OpenAI is not consulted: template draft, zero confidence."""
+    action = SCENARIO_REPLY_ACTIONS.get(scenario_hint, "skip")
+    language = analysis.language
+    return {
+        "action": action,
+        "confidence": 0.0,
+        "language": language,
+        "reason": reason,
+        "reply_text": fallback_reply(scenario_hint, language) if action != "skip" else "",
+    }
+
+
+class AICache:
+    """Content-addressed LRU cache of AI results with TTL, persisted as a sidecar.
+
+    Keys hash the normalized message text with the scenario hint and
+    language, so cross-posted copies of one ad share a single result
+    regardless of sender or formatting. Like GroupActivityTracker, the
+    compact snapshot is written at most every AI_CACHE_SNAPSHOT_SEC
+    (0 disables it) rather than after every put.
+    """
+
+    def __init__(self, path: str, max_size: int, ttl_sec: float, snapshot_every: float):
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.ttl_sec = ttl_sec
+        self.snapshot_every = snapshot_every
+        self.entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._changed = False
+        self._written_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(normalized_text: str, scenario_hint: str, language: str) -> str:
+        raw = f"{scenario_hint}|{language}|{normalized_text}".encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    @property
+    def dirty(self) -> bool:
+        return (
+            self.snapshot_every > 0
+            and self._changed
+            and time.time() - self._written_at >= self.snapshot_every
+        )
+
+    @dirty.setter
+    def dirty(self, value: bool):
+        self._changed = value
+        if not value:
+            self._written_at = time.time()
+
+    def load(self):
+        if self.snapshot_every <= 0:
+            return
+        now = time.time()
+        rows = load_json(self.path, [])
+        for row in rows if isinstance(rows, list) else ():
+            try:
+                key, expires_at, result = row
+                expires_at = float(expires_at)
+            except (TypeError, ValueError):
+                continue
+            if expires_at > now and isinstance(key, str) and isinstance(result, dict):
+                self.entries[key] = (expires_at, result)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str):
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, result = item
+        if expires_at <= time.time():
+            del self.entries[key]
+            self.dirty = True
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]):
+        self.entries[key] = (time.time() + self.ttl_sec, dict(result))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def snapshot(self):
+        now = time.time()
+        return [
+            [key, expires_at, dict(result)] for key, (expires_at, result) in self.entries.items() if expires_at > now
+        ]
+
+    def write(self, payload):
+        save_json(self.path, payload, compact=True)
+
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100.0) if total else 0.0
+        return (
+            f"AI cache: {self.hits} hits / {self.misses} misses ({rate:.0f}%), "
+            f"{self.coalesced} coalesced, {len(self.entries)} entries"
+        )
+
+
+AI_CACHE = AICache(AI_CACHE_FILE, AI_CACHE_SIZE, AI_CACHE_TTL_HOURS * 3600, AI_CACHE_SNAPSHOT_SEC)
+AI_CACHE.load()
+PERSIST.register_sidecar(AI_CACHE)
+
+AI_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+
 async def ai_generate_reply(
     scenario_hint: str,
     message_text: str,
     group_title: str,
     sender_name: str,
+    analysis: MessageAnalysis = None,
+    use_cache: bool = True,
 ) -> Dict[str, Any]:
+    """Cached, single-flight front of _ai_generate_reply_uncached.
+
+    Concurrent calls for the same content await one OpenAI request. With
+    use_cache=False the cache is not read (e.g. /regen), but the fresh
+    result still replaces the cached one.
+    """
     if not openai_client:
         return AI_JSON_FALLBACK
 
-    compact_text = truncate((message_text or "").strip(), MAX_AI_INPUT_CHARS)
+    if analysis is None:
+        analysis = MessageAnalysis(message_text)
+    key = AICache.make_key(analysis.normalized, scenario_hint, analysis.language)
+
+    if use_cache:
+        cached = AI_CACHE.get(key)
+        if cached is not None:
+            return dict(cached)
+
+    task = AI_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_ai_generate_reply_uncached(AIRequest(
+            key, scenario_hint, message_text, group_title, sender_name, analysis,
+        )))
+        AI_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: AI_INFLIGHT.pop(key, None))
+    else:
+        AI_CACHE.coalesced += 1
+
+    return dict(await asyncio.shield(task))
+
+
+class AIRequest:
+    __slots__ = ("cache_key", "scenario_hint", "message_text", "group_title", "sender_name", "analysis")
+
+    def __init__(self, cache_key, scenario_hint, message_text, group_title, sender_name, analysis):
+        self.cache_key = cache_key
+        self.scenario_hint = scenario_hint
+        self.message_text = message_text
+        self.group_title = group_title
+        self.sender_name = sender_name
+        self.analysis = analysis
+
+
+AI_SKIP_GUIDANCE = (
+    "Сначала оцени, стоит ли писать этому человеку. "
+    "Если сообщение явно нецелевое, рискованное, похоже на спам, на обычное групповое обсуждение "
+    "или не требует личного контакта — action=skip."
+)
+
+
+def _prompt_text(req: AIRequest) -> str:
+    compact = req.analysis.compact_text
+    if not req.analysis.prompted:
+        # a batched request that falls back to a single call is counted once
+        AI_INPUT_STATS.record(req.message_text or "", compact)
+        req.analysis.prompted = True
+    return truncate(compact, MAX_AI_INPUT_CHARS)
+
+
+def _single_prompt(req: AIRequest) -> str:
+    compact_text = _prompt_text(req)
 
     json_instruction = (
         "Return valid JSON only. "
@@ -630,199 +2381,713 @@ async def ai_generate_reply(
         "No markdown, no comments, no extra text."
     )
 
-    user_prompt = (
-        f"scenario_hint={scenario_hint}\n"
-        f"group_title={group_title}\n"
-        f"sender_name={sender_name}\n"
+    return (
+        f"scenario_hint={req.scenario_hint}\n"
+        f"group_title={req.group_title}\n"
+        f"sender_name={req.sender_name}\n"
         f"{json_instruction}\n"
         f"message_text:\n{compact_text}\n\n"
-        "Сначала оцени, стоит ли писать этому человеку. "
-        "Если сообщение явно нецелевое, рискованное, похоже на спам, на обычное групповое обсуждение "
-        "или не требует личного контакта — action=skip."
+        f"{AI_SKIP_GUIDANCE}"
     )
 
-    try:
-        resp = await asyncio.wait_for(
-            openai_client.responses.create(
-                model=OPENAI_MODEL,
-                instructions=AI_SYSTEM + "\nReturn JSON only.",
-                input=user_prompt,
-                store=False,
-                text={"format": {"type": "json_object"}},
-            ),
-            timeout=OPENAI_TIMEOUT_SEC,
-        )
-        parsed = safe_json_loads(getattr(resp, "output_text", "") or "", AI_JSON_FALLBACK)
-        return _normalize_ai_payload(message_text, parsed)
 
-    except Exception as e:
-        logging.warning("OpenAI json_object failed: %s", e)
+async def _ai_request(user_prompt: str, plain_instructions: str) -> Optional[str]:
+    """One logical OpenAI request through AI_GATEWAY; output text or None on failure."""
+    request_modes = {
+        "json": dict(
+            instructions=AI_SYSTEM + "\nReturn JSON only.",
+            text={"format": {"type": "json_object"}},
+        ),
+        "plain": dict(
+            instructions=AI_SYSTEM + plain_instructions,
+        ),
+    }
 
-    try:
-        resp = await asyncio.wait_for(
-            openai_client.responses.create(
+    json_failed = False
+    for mode in AI_GATEWAY.modes():
+        started = time.perf_counter()
+        try:
+            resp = await AI_GATEWAY.create(
                 model=OPENAI_MODEL,
-                instructions=AI_SYSTEM + "\nReturn JSON only. Return a single JSON object only.",
                 input=user_prompt,
                 store=False,
-            ),
-            timeout=OPENAI_TIMEOUT_SEC,
-        )
-        parsed = safe_json_loads(getattr(resp, "output_text", "") or "", AI_JSON_FALLBACK)
-        return _normalize_ai_payload(message_text, parsed)
-
-    except Exception as e:
-        logging.warning("OpenAI plain json failed: %s", e)
+                **request_modes[mode],
+            )
+        except Exception as e:
+            logging.warning("OpenAI %s failed: %s", "json_object" if mode == "json" else "plain json", e)
+            M_AI_SEC.observe(time.perf_counter() - started, mode, "error")
+            M_AI_FAILURES.inc(mode)
+            json_failed = json_failed or mode == "json"
+            continue
+        M_AI_SEC.observe(time.perf_counter() - started, mode, "ok")
+
+        if json_failed:
+            AI_GATEWAY.json_mode_failed()
+        AI_GATEWAY.record(True)
+        return getattr(resp, "output_text", "") or ""
+
+    AI_GATEWAY.record(False)
+    return None
+
+
+async def _ai_single(req: AIRequest) -> Dict[str, Any]:
+    output = await _ai_request(
+        _single_prompt(req),
+        "\nReturn JSON only. Return a single JSON object only.",
+    )
+    if output is None:
         return AI_JSON_FALLBACK
+    parsed = safe_json_loads(output, AI_JSON_FALLBACK)
+    ai = _normalize_ai_payload(req.message_text, parsed, req.analysis)
+    AI_CACHE.put(req.cache_key, ai)
+    return ai
 
 
-def fallback_reply(category: str, language: str) -> str:
-    intro = localized_intro(language)
+async def _ai_generate_reply_uncached(req: AIRequest) -> Dict[str, Any]:
+    if not AI_GATEWAY.allow():
+        return rule_based_verdict(req.scenario_hint, req.analysis, "circuit_open")
+    if AI_BATCH:
+        return await AI_BATCHER.submit(req)
+    return await _ai_single(req)
 
+
+def fallback_reply(category: str, language: str) -> str:
     if category in ("lead_search", "lead_question"):
         if language == "uk":
-            return (
-                f"{intro}\n"
-                "Побачив Ваше повідомлення. Якщо питання ще актуальне, можете коротко описати ситуацію тут у приватних повідомленнях.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "Побачив Ваше повідомлення. Якщо питання ще актуальне, можете коротко описати ситуацію тут у приватних повідомленнях.",
             )
 
         if language == "de":
-            return (
-                f"{intro}\n"
-                "Ich habe Ihre Nachricht gesehen. Wenn Ihr Anliegen noch aktuell ist, können Sie die Situation kurz hier in einer privaten Nachricht schildern.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "Ich habe Ihre Nachricht gesehen. Wenn Ihr Anliegen noch aktuell ist, können Sie die Situation kurz hier in einer privaten Nachricht schildern.",
             )
 
         if language == "en":
-            return (
-                f"{intro}\n"
-                "I saw your message. If your issue is still relevant, feel free to briefly describe the situation here in a private message.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "I saw your message. If your issue is still relevant, feel free to briefly describe the situation here in a private message.",
             )
 
-        return (
-            f"{intro}\n"
-            "Увидел ваше сообщение. Если вопрос еще актуален, можете коротко описать ситуацию здесь в личных сообщениях.\n\n"
-            f"{INFO_BLOCK}"
+        return assemble_reply(
+            language,
+            "Увидел ваше сообщение. Если вопрос еще актуален, можете коротко описать ситуацию здесь в личных сообщениях.",
         )
 
     if category == "partner_services":
         if language == "uk":
-            return (
-                f"{intro}\n"
-                "Побачив Ваше повідомлення. Якщо Вам цікаві професійні контакти та взаємні рекомендації для клієнтів у Німеччині, буду радий зв’язку.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "Побачив Ваше повідомлення. Якщо Вам цікаві професійні контакти та взаємні рекомендації для клієнтів у Німеччині, буду радий зв’язку.",
             )
 
         if language == "de":
-            return (
-                f"{intro}\n"
-                "Ich habe Ihren Beitrag gesehen. Falls beruflicher Austausch oder gegenseitige Empfehlungen für Mandanten in Deutschland interessant sind, freue ich mich über Kontakt.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "Ich habe Ihren Beitrag gesehen. Falls beruflicher Austausch oder gegenseitige Empfehlungen für Mandanten in Deutschland interessant sind, freue ich mich über Kontakt.",
             )
 
         if language == "en":
-            return (
-                f"{intro}\n"
-                "I saw your message. If professional cooperation or mutual client referrals in Germany are relevant, I would be glad to stay in touch.\n\n"
-                f"{INFO_BLOCK}"
+            return assemble_reply(
+                language,
+                "I saw your message. If professional cooperation or mutual client referrals in Germany are relevant, I would be glad to stay in touch.",
             )
 
-        return (
-            f"{intro}\n"
-            "Увидел ваше сообщение. Если вам интересны профессиональные контакты и взаимные рекомендации клиентов в Германии, буду рад связи.\n\n"
-            f"{INFO_BLOCK}"
+        return assemble_reply(
+            language,
+            "Увидел ваше сообщение. Если вам интересны профессиональные контакты и взаимные рекомендации клиентов в Германии, буду рад связи.",
         )
 
     return ""
 
 
 # =============================================================================
-# ENTITY CACHE
+# AI BATCHING
 # =============================================================================
 
-async def load_or_fetch_entities(client: TelegramClient, group_usernames: List[str]):
-    import pickle
+def _batch_prompt(reqs: List[AIRequest]) -> str:
+    blocks = []
+    for index, req in enumerate(reqs):
+        compact_text = _prompt_text(req)
+        blocks.append(
+            f"### index={index}\n"
+            f"scenario_hint={req.scenario_hint}\n"
+            f"group_title={req.group_title}\n"
+            f"sender_name={req.sender_name}\n"
+            f"message_text:\n{compact_text}"
+        )
+    return (
+        f"Batch of {len(reqs)} independent messages. Evaluate each one on its own.\n"
+        "Return valid JSON only: a single object {\"results\": [...]} whose array has one "
+        "element per message with keys index, action, confidence, language, reason, reply_text. "
+        "No markdown, no comments, no extra text.\n"
+        f"{AI_SKIP_GUIDANCE}\n\n"
+        + "\n\n".join(blocks)
+    )
+
 
-    entities = []
-    for username in sorted(set(group_usernames)):
+def _batch_results(output: str) -> Dict[int, Dict[str, Any]]:
+    data = None
+    try:
+        data = json.loads(output)
+    except Exception:
+        data = safe_json_loads(output, {})
+    if isinstance(data, dict):
+        data = data.get("results")
+    if not isinstance(data, list):
+        return {}
+
+    out = {}
+    for position, elem in enumerate(data):
+        if not isinstance(elem, dict):
+            continue
         try:
-            filename = f"{username.strip('@')}.pkl"
-            path = os.path.join(CACHE_DIR, filename)
-            if os.path.exists(path):
-                with open(path, "rb") as f:
-                    ent = pickle.load(f)
-                entities.append(ent)
-                logging.info("✅ cache entity: %s", username)
-            else:
-                entity = await client.get_entity(username)
-                with open(path, "wb") as f:
-                    pickle.dump(entity, f)
-                entities.append(entity)
-                logging.info("📥 fetched entity: %s", username)
-        except Exception as e:
-            logging.error("❌ failed entity %s: %s", username, e)
-    return entities
+            index = int(elem.get("index", position))
+        except Exception:
+            continue
+        if "action" in elem:
+            out[index] = elem
+    return out
+
+
+class AIBatcher:
+    """Micro-batches concurrent AI requests into one OpenAI call.
+
+    Requests arriving within AI_BATCH_WINDOW_SEC share one call carrying
+    AI_SYSTEM once. The model returns a results array; each element goes
+    through _normalize_ai_payload, and any element that is missing or
+    unparseable is retried as a single request. Each AI_QUEUE worker waits
+    on one request at a time, so max_items is capped at AI_WORKERS, and a
+    batch goes out early once every busy worker is waiting on it.
+    """
+
+    def __init__(self, window: float, max_items: int, workers: int):
+        self.window = max(0.0, window)
+        self.max_items = max(1, min(max_items, workers))
+        self.pending: List[Tuple[AIRequest, asyncio.Future]] = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.batched = 0
+        self.element_fallbacks = 0
+
+    async def submit(self, req: AIRequest) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((req, fut))
+        if len(self.pending) >= min(self.max_items, max(1, AI_QUEUE.busy)):
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self.pending = self.pending, []
+        if not items:
+            return
+        task = asyncio.ensure_future(self._run(items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items: List[Tuple[AIRequest, asyncio.Future]]):
+        try:
+            if len(items) == 1:
+                req, fut = items[0]
+                if not fut.done():
+                    fut.set_result(await _ai_single(req))
+                return
+
+            self.batches += 1
+            self.batched += len(items)
+            reqs = [req for req, _ in items]
+            output = await _ai_request(
+                _batch_prompt(reqs),
+                "\nReturn JSON only. Return a single JSON object with a results array only.",
+            )
+            if output is None:
+                for _, fut in items:
+                    if not fut.done():
+                        fut.set_result(AI_JSON_FALLBACK)
+                return
+
+            results = _batch_results(output)
+            retry = []
+            for index, (req, fut) in enumerate(items):
+                elem = results.get(index)
+                if elem is None:
+                    retry.append((req, fut))
+                    continue
+                ai = _normalize_ai_payload(req.message_text, elem, req.analysis)
+                AI_CACHE.put(req.cache_key, ai)
+                if not fut.done():
+                    fut.set_result(ai)
+
+            self.element_fallbacks += len(retry)
+            singles = await asyncio.gather(*(_ai_single(req) for req, _ in retry), return_exceptions=True)
+            for (req, fut), ai in zip(retry, singles):
+                if not fut.done():
+                    fut.set_result(AI_JSON_FALLBACK if isinstance(ai, BaseException) else ai)
+        except Exception:
+            logging.exception("AI batch failed")
+        finally:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_result(AI_JSON_FALLBACK)
+
+    def stats_line(self) -> str:
+        avg = self.batched / self.batches if self.batches else 0.0
+        return (
+            f"AI batching: {'on' if AI_BATCH else 'off'}, {self.batches} batches, "
+            f"avg size {avg:.1f}, {self.element_fallbacks} element fallbacks"
+        )
+
+
+AI_BATCHER = AIBatcher(AI_BATCH_WINDOW_SEC, AI_BATCH_MAX, AI_WORKERS)
+
+
+# =============================================================================
+# ENTITY CACHE
+# =============================================================================
+
+class EntityIndex:
+    """Per-session index of monitored chats: username -> id/access_hash/title.
+
+    Access hashes are only valid for the account that obtained them, so each
+    session keeps its own file (CACHE_DIR/<session>.entities.json). Entries
+    are served straight from the index; misses are resolved concurrently
+    (ENTITY_RESOLVE_CONCURRENCY) and entries older than ENTITY_TTL_HOURS are
+    revalidated in the background while the client stays connected. A
+    FloodWait pauses every resolver of the session, not just the one that
+    hit it. Persisted as a PERSIST sidecar.
+    """
+
+    PEERS = {
+        "channel": lambda e: InputPeerChannel(e["id"], e["access_hash"]),
+        "chat": lambda e: InputPeerChat(e["id"]),
+        "user": lambda e: InputPeerUser(e["id"], e["access_hash"]),
+    }
+
+    def __init__(self, session_name: str, path: str, ttl_sec: float, concurrency: int):
+        self.session_name = session_name
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.concurrency = max(1, concurrency)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        self.paused_until = 0.0
+        self.revalidate_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key(username: str) -> str:
+        return username.strip().lstrip("@").lower()
+
+    def load(self):
+        data = load_json(self.path, {})
+        self.entries = {k: v for k, v in data.items() if v.get("type") in self.PEERS}
+
+    def snapshot(self):
+        return {k: dict(v) for k, v in self.entries.items()}
+
+    def write(self, payload):
+        save_json(self.path, payload)
+
+    def peer(self, username: str):
+        entry = self.entries.get(self.key(username))
+        return self.PEERS[entry["type"]](entry) if entry else None
+
+    def is_stale(self, username: str) -> bool:
+        entry = self.entries.get(self.key(username))
+        return entry is None or time.time() - entry.get("fetched_at", 0) > self.ttl_sec
+
+    def _store(self, username: str, entity) -> Dict[str, Any]:
+        peer = get_input_peer(entity)
+        if isinstance(peer, InputPeerChannel):
+            entry = {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+        elif isinstance(peer, InputPeerChat):
+            entry = {"type": "chat", "id": peer.chat_id, "access_hash": None}
+        else:
+            entry = {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+        entry.update(
+            username=getattr(entity, "username", None) or self.key(username),
+            title=getattr(entity, "title", None) or getattr(entity, "first_name", None) or "",
+            fetched_at=time.time(),
+        )
+        self.entries[self.key(username)] = entry
+        self.dirty = True
+        return entry
+
+    async def _resolve_one(self, client: TelegramClient, username: str, sem: asyncio.Semaphore) -> bool:
+        async with sem:
+            for _ in range(2):
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    entity = await client.get_entity(username)
+                except FloodWaitError as e:
+                    if e.seconds > ENTITY_FLOOD_MAX_WAIT_SEC:
+                        logging.warning("[%s] FloodWait %ss resolving %s, giving up for now", self.session_name, e.seconds, username)
+                        return False
+                    logging.warning("[%s] FloodWait %ss resolving %s", self.session_name, e.seconds, username)
+                    SESSION_HEALTH.record_flood(self.session_name, e.seconds)
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.seconds)
+                    continue
+                except Exception as e:
+                    logging.error("❌ failed entity %s: %s", username, e)
+                    return False
+                self._store(username, entity)
+                return True
+        return False
+
+    async def resolve(self, client: TelegramClient, usernames: List[str]) -> int:
+        sem = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._resolve_one(client, u, sem) for u in usernames))
+        return sum(1 for ok in results if ok)
+
+    async def _revalidate_loop(self, client: TelegramClient, usernames: List[str]):
+        while not shutdown.is_set():
+            stale = [u for u in usernames if self.is_stale(u)]
+            if stale:
+                refreshed = await self.resolve(client, stale)
+                logging.info("[%s] revalidated %s/%s stale entities", self.session_name, refreshed, len(stale))
+            await asyncio.sleep(max(60.0, self.ttl_sec / 4))
+
+    def start_revalidation(self, client: TelegramClient, usernames: List[str]):
+        self.stop_revalidation()
+        self.revalidate_task = asyncio.create_task(self._revalidate_loop(client, usernames))
+
+    def stop_revalidation(self):
+        if self.revalidate_task is not None:
+            self.revalidate_task.cancel()
+            self.revalidate_task = None
+
+
+ENTITY_INDEXES: Dict[str, EntityIndex] = {}
+
+
+def entity_index(session_name: str) -> EntityIndex:
+    index = ENTITY_INDEXES.get(session_name)
+    if index is None:
+        path = os.path.join(CACHE_DIR, f"{session_name}.entities.json")
+        index = EntityIndex(session_name, path, ENTITY_TTL_HOURS * 3600, ENTITY_RESOLVE_CONCURRENCY)
+        index.load()
+        ENTITY_INDEXES[session_name] = index
+        PERSIST.register_sidecar(index)
+    return index
+
+
+async def load_or_fetch_entities(client: TelegramClient, session_name: str, group_usernames: List[str]):
+    index = entity_index(session_name)
+    usernames = sorted({u.strip() for u in group_usernames if u.strip()})
+
+    missing = [u for u in usernames if index.peer(u) is None]
+    started = time.monotonic()
+    fetched = await index.resolve(client, missing) if missing else 0
+    logging.info(
+        "[%s] ✅ %s entities from index, 📥 %s/%s fetched in %.1fs",
+        session_name, len(usernames) - len(missing), fetched, len(missing), time.monotonic() - started,
+    )
+
+    index.start_revalidation(client, usernames)
+    return [peer for peer in (index.peer(u) for u in usernames) if peer is not None]
+
+
+# =============================================================================
+# GROUP SHARDING
+# =============================================================================
+
+class SessionHealth:
+    """Per-session weight from the account's configured weight and recent trouble.
+
+    FloodWait seconds and connection failures within SESSION_HEALTH_WINDOW_SEC
+    lower the weight: it halves for every SESSION_FLOOD_HALF_WEIGHT_SEC of
+    FloodWait and for every failure. Weights are rounded to one decimal so
+    small changes do not reshuffle group ownership.
+    """
+
+    def __init__(self, accounts: List[Dict[str, Any]]):
+        self.base = {cfg["session_name"]: max(0.0, float(cfg.get("weight", 1.0))) for cfg in accounts}
+        self.floods: Dict[str, deque] = {}
+        self.failures: Dict[str, deque] = {}
+
+    def _recent(self, events: Dict[str, deque], session_name: str, now: float) -> deque:
+        items = events.setdefault(session_name, deque())
+        while items and now - items[0][0] > SESSION_HEALTH_WINDOW_SEC:
+            items.popleft()
+        return items
+
+    def record_flood(self, session_name: str, seconds: float):
+        self._recent(self.floods, session_name, time.time()).append((time.time(), float(seconds)))
+
+    def record_failure(self, session_name: str):
+        self._recent(self.failures, session_name, time.time()).append((time.time(), 1.0))
+
+    def flood_seconds(self, session_name: str) -> float:
+        return sum(sec for _, sec in self._recent(self.floods, session_name, time.time()))
+
+    def weight(self, session_name: str) -> float:
+        now = time.time()
+        flood = sum(sec for _, sec in self._recent(self.floods, session_name, now))
+        failures = len(self._recent(self.failures, session_name, now))
+        w = self.base.get(session_name, 1.0) * 0.5 ** (flood / SESSION_FLOOD_HALF_WEIGHT_SEC + failures)
+        return max(0.1, round(w, 1)) if w > 0 else 0.0
+
+    def stats_line(self) -> str:
+        parts = [
+            f"{name} w={self.weight(name):.1f}{'' if name in CLIENTS else ' (offline)'}"
+            f" flood={int(self.flood_seconds(name))}s"
+            for name in sorted(self.base)
+        ]
+        return "Sessions: " + ", ".join(parts)
+
+
+SESSION_HEALTH = SessionHealth(ACCOUNTS)
+
+
+class GroupOwnership:
+    """Assigns every monitored chat to exactly one live session.
+
+    Ownership uses weighted rendezvous hashing over the sessions that are
+    connected and monitor the chat: each session's share of chats follows
+    its SESSION_HEALTH weight, and adding or losing a session only moves
+    that session's chats. All sessions keep their subscriptions; the others
+    simply drop the chat's messages until the owner disappears from CLIENTS,
+    at which point they take over. Weights are re-read every
+    WEIGHT_REFRESH_SEC.
+    """
+
+    WEIGHT_REFRESH_SEC = 300
+
+    def __init__(self):
+        self.monitored: Dict[str, set] = {}
+        self._owners: Dict[int, Optional[str]] = {}
+        self._weights: Dict[str, float] = {}
+        self._weights_at = 0.0
+
+    @staticmethod
+    def _score(session_name: str, chat_id: int, weight: float) -> float:
+        digest = hashlib.blake2b(f"{session_name}:{chat_id}".encode(), digest_size=8).digest()
+        u = (int.from_bytes(digest, "big") + 1) / float(2 ** 64 + 1)
+        return weight / -math.log(u) if weight > 0 else 0.0
+
+    def _refresh_weights(self):
+        now = time.time()
+        if now - self._weights_at < self.WEIGHT_REFRESH_SEC:
+            return
+        self._weights_at = now
+        weights = {name: SESSION_HEALTH.weight(name) for name in self.monitored}
+        if weights != self._weights:
+            self._weights = weights
+            self._owners.clear()
+
+    def register(self, session_name: str, chat_ids):
+        self.monitored[session_name] = set(chat_ids)
+        self._owners.clear()
+        self._weights_at = 0.0
+
+    def unregister(self, session_name: str):
+        if self.monitored.pop(session_name, None) is not None:
+            self._owners.clear()
+
+    def owner(self, chat_id: int) -> Optional[str]:
+        self._refresh_weights()
+        if chat_id in self._owners:
+            return self._owners[chat_id]
+        candidates = [
+            name for name, chats in self.monitored.items()
+            if chat_id in chats and name in CLIENTS
+        ]
+        owner = (
+            max(candidates, key=lambda name: self._score(name, chat_id, self._weights.get(name, 1.0)))
+            if candidates else None
+        )
+        self._owners[chat_id] = owner
+        return owner
+
+    def shares(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for chat_id in set().union(*self.monitored.values()) if self.monitored else ():
+            owner = self.owner(chat_id)
+            if owner is not None:
+                counts[owner] = counts.get(owner, 0) + 1
+        return counts
+
+    def owns(self, session_name: str, chat_id: int) -> bool:
+        owner = self.owner(chat_id)
+        return owner is None or owner == session_name
+
+
+GROUP_OWNERS = GroupOwnership()
 
 
 # =============================================================================
 # OUTBOUND LIMITS
 # =============================================================================
 
-def _day_key() -> str:
-    return datetime.now().strftime("%Y-%m-%d")
+def _day_key(ts: float = None) -> str:
+    return datetime.fromtimestamp(ts if ts is not None else time.time()).strftime("%Y-%m-%d")
+
+
+class SlidingWindow:
+    """At most `limit` events in any `window` seconds.
+
+    Keeps only the last `limit` timestamps, so the check is O(1) and memory
+    is bounded by the limit: once full, the next event is allowed when the
+    oldest kept one leaves the window.
+    """
+
+    __slots__ = ("limit", "window", "stamps")
+
+    def __init__(self, limit: int, window: float, stamps=()):
+        self.limit = limit
+        self.window = window
+        self.stamps = deque(sorted(stamps)[-limit:] if limit > 0 else (), maxlen=max(1, limit))
 
+    def wait(self, now: float) -> float:
+        if self.limit <= 0:
+            return float("inf")
+        if len(self.stamps) < self.limit:
+            return 0.0
+        return max(0.0, self.stamps[0] + self.window - now)
 
-def _hour_key() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H")
+    def count(self, now: float) -> int:
+        return sum(1 for ts in self.stamps if now - ts < self.window)
 
+    def add(self, ts: float):
+        self.stamps.append(ts)
 
-def _session_stats(session_name: str) -> Dict[str, Any]:
-    s = OUTBOUND_STATS.setdefault(session_name, {})
-    s.setdefault("dm_day", {})
-    s.setdefault("dm_hour", {})
-    s.setdefault("invite_day", {})
-    s.setdefault("last_dm_ts", 0.0)
-    return s
+
+class OutboundLimiter:
+    """Per-session DM/invite limits as sliding windows, persisted in OUTBOUND_STATS.
+
+    - dm: MIN_SECONDS_BETWEEN_DMS between DMs, OUTBOUND_DM_PER_HOUR per hour,
+      OUTBOUND_DM_PER_DAY per 24h;
+    - invite: INVITE_PER_DAY per 24h.
+
+    Past activity is kept only as per-day totals ("rollup") for the most
+    recent OUTBOUND_ROLLUP_DAYS days with activity. Stats written before the limiter (per-day and
+    per-hour buckets) are converted on first use: the buckets become the
+    rollup and the current day/hour counts seed the windows, so no
+    additional sends are allowed by the switch.
+    """
+
+    WINDOWS = {
+        "dm": (("dm_day", OUTBOUND_DM_PER_DAY, 86400.0), ("dm_hour", OUTBOUND_DM_PER_HOUR, 3600.0)),
+        "invite": (("invite_day", INVITE_PER_DAY, 86400.0),),
+    }
+
+    def __init__(self, stats: Dict[str, Any], rollup_days: int):
+        self.stats = stats
+        self.rollup_days = max(1, rollup_days)
+        self.windows: Dict[str, Dict[str, SlidingWindow]] = {}
+
+    def _windows(self, session_name: str) -> Dict[str, SlidingWindow]:
+        windows = self.windows.get(session_name)
+        if windows is not None:
+            return windows
+
+        s = self.stats.setdefault(session_name, {})
+        if "windows" not in s:
+            self._convert_legacy(session_name, s)
+        stored = s.get("windows") or {}
+        windows = self.windows[session_name] = {
+            name: SlidingWindow(limit, window, stored.get(name) or ())
+            for rules in self.WINDOWS.values()
+            for name, limit, window in rules
+        }
+        return windows
+
+    def _convert_legacy(self, session_name: str, s: Dict[str, Any]):
+        now = time.time()
+        last_dm = float(s.get("last_dm_ts", 0.0) or 0.0) or now
+        today = _day_key(now)
+        this_hour = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H")
+        dm_day = s.pop("dm_day", None) or {}
+        dm_hour = s.pop("dm_hour", None) or {}
+        invite_day = s.pop("invite_day", None) or {}
+        s["windows"] = {
+            "dm_day": [last_dm] * int(dm_day.get(today, 0)),
+            "dm_hour": [last_dm] * int(dm_hour.get(this_hour, 0)),
+            "invite_day": [now] * int(invite_day.get(today, 0)),
+        }
+        s["rollup"] = {
+            "dm": {k: int(v) for k, v in dm_day.items()},
+            "invite": {k: int(v) for k, v in invite_day.items()},
+        }
+        s.setdefault("last_dm_ts", 0.0)
+        self._trim_rollup(s)
+        PERSIST.mark("outbound", session_name)
+
+    def _trim_rollup(self, s: Dict[str, Any]):
+        for days in s["rollup"].values():
+            for day in sorted(days)[:-self.rollup_days]:
+                del days[day]
+
+    def time_until_allowed(self, session_name: str, action: str, now: float = None) -> Tuple[float, str]:
+        """Seconds until `action` is allowed for the session (0.0 if now) and the limiting rule."""
+        now = time.time() if now is None else now
+        windows = self._windows(session_name)
+        if action == "dm":
+            gap = MIN_SECONDS_BETWEEN_DMS - (now - float(self.stats[session_name].get("last_dm_ts", 0) or 0))
+            if gap > 0:
+                return gap, f"wait_{int(gap)}s"
+        for name, _, _ in self.WINDOWS[action]:
+            wait = windows[name].wait(now)
+            if wait > 0:
+                return wait, f"{name}_limit"
+        return 0.0, "ok"
+
+    def check(self, session_name: str, action: str) -> Tuple[bool, str]:
+        wait, reason = self.time_until_allowed(session_name, action)
+        return wait <= 0, reason
+
+    def record(self, session_name: str, action: str, now: float = None):
+        now = time.time() if now is None else now
+        windows = self._windows(session_name)
+        s = self.stats[session_name]
+        for name, _, _ in self.WINDOWS[action]:
+            windows[name].add(now)
+            s["windows"][name] = list(windows[name].stamps)
+        if action == "dm":
+            s["last_dm_ts"] = now
+        days = s["rollup"].setdefault(action, {})
+        day = _day_key(now)
+        days[day] = int(days.get(day, 0)) + 1
+        if len(days) > self.rollup_days:
+            self._trim_rollup(s)
+        PERSIST.mark("outbound", session_name)
+
+    def counts(self, session_name: str, now: float = None) -> Dict[str, int]:
+        now = time.time() if now is None else now
+        return {name: w.count(now) for name, w in self._windows(session_name).items()}
+
+
+OUTBOUND_LIMITER = OutboundLimiter(OUTBOUND_STATS, OUTBOUND_ROLLUP_DAYS)
 
 
 async def can_send_dm(session_name: str) -> Tuple[bool, str]:
     async with OUTBOUND_LOCK:
-        s = _session_stats(session_name)
-        now = time.time()
-        if now - float(s.get("last_dm_ts", 0)) < MIN_SECONDS_BETWEEN_DMS:
-            wait = int(MIN_SECONDS_BETWEEN_DMS - (now - float(s.get("last_dm_ts", 0))))
-            return False, f"wait_{wait}s"
-        if int(s["dm_day"].get(_day_key(), 0)) >= OUTBOUND_DM_PER_DAY:
-            return False, "dm_day_limit"
-        if int(s["dm_hour"].get(_hour_key(), 0)) >= OUTBOUND_DM_PER_HOUR:
-            return False, "dm_hour_limit"
-        return True, "ok"
+        return OUTBOUND_LIMITER.check(session_name, "dm")
 
 
 async def mark_dm_sent(session_name: str):
     async with OUTBOUND_LOCK:
-        s = _session_stats(session_name)
-        s["dm_day"][_day_key()] = int(s["dm_day"].get(_day_key(), 0)) + 1
-        s["dm_hour"][_hour_key()] = int(s["dm_hour"].get(_hour_key(), 0)) + 1
-        s["last_dm_ts"] = time.time()
-        save_json(OUTBOUND_FILE, OUTBOUND_STATS)
+        OUTBOUND_LIMITER.record(session_name, "dm")
 
 
 async def can_invite(session_name: str) -> Tuple[bool, str]:
     async with OUTBOUND_LOCK:
-        s = _session_stats(session_name)
-        if int(s["invite_day"].get(_day_key(), 0)) >= INVITE_PER_DAY:
-            return False, "invite_day_limit"
-        return True, "ok"
+        return OUTBOUND_LIMITER.check(session_name, "invite")
 
 
 async def mark_invite_sent(session_name: str):
     async with OUTBOUND_LOCK:
-        s = _session_stats(session_name)
-        s["invite_day"][_day_key()] = int(s["invite_day"].get(_day_key(), 0)) + 1
-        save_json(OUTBOUND_FILE, OUTBOUND_STATS)
+        OUTBOUND_LIMITER.record(session_name, "invite")
 
 
 # =============================================================================
@@ -830,13 +3095,12 @@ async def mark_invite_sent(session_name: str):
 # =============================================================================
 
 async def remember_lead(lead: Dict[str, Any]):
-    async with PERSIST_LOCK:
-        LEADS[lead["id"]] = lead
-        save_json(LEADS_FILE, LEADS)
+    LEADS[lead["id"]] = lead
+    PERSIST.mark("leads", lead["id"])
 
 
 async def remember_favorite(lead_id: str):
-    async with PERSIST_LOCK:
+    async with timed_lock(PERSIST_LOCK):
         lead = LEADS.get(lead_id)
         if not lead:
             return False
@@ -848,7 +3112,7 @@ async def remember_favorite(lead_id: str):
             "source_link": lead.get("message_link"),
             "text": lead.get("text"),
         }
-        save_json(FAVORITES_FILE, FAVORITES)
+        PERSIST.mark("favorites", lead_id)
         return True
 
 
@@ -881,9 +3145,12 @@ def render_lead_card(lead: Dict[str, Any]) -> str:
 async def send_admin_notice(client: TelegramClient, text: str):
     if not text:
         return
+    started = time.perf_counter()
     try:
         await client.send_message(ADMIN_NOTIFY_USERNAME, text)
+        M_ADMIN_NOTICE_SEC.observe(time.perf_counter() - started, "ok")
     except Exception as e:
+        M_ADMIN_NOTICE_SEC.observe(time.perf_counter() - started, "error")
         logging.error("Failed admin notice: %s", e)
 
 
@@ -906,12 +3173,21 @@ async def resolve_user_entity(client: TelegramClient, lead: Dict[str, Any]):
     raise ValueError("No sender entity data")
 
 
-async def send_dm_for_lead(client: TelegramClient, lead_id: str, force_regen: bool = False) -> str:
+async def send_dm_for_lead(
+    client: TelegramClient,
+    lead_id: str,
+    force_regen: bool = False,
+    session_name: str = None,
+) -> str:
+    """Send the lead's reply from `session_name` (default: the session that found it)."""
     lead = LEADS.get(lead_id)
     if not lead:
         return f"❌ Lead {lead_id} not found"
 
-    allowed, reason = await can_send_dm(lead["session_name"])
+    session_name = session_name or lead["session_name"]
+    allowed, reason = await can_send_dm(session_name)
+    if allowed:
+        allowed, reason = OUTBOUND_QUEUE.session_ready(session_name)
     if not allowed:
         return f"⛔ DM blocked: {reason}"
 
@@ -926,6 +3202,7 @@ async def send_dm_for_lead(client: TelegramClient, lead_id: str, force_regen: bo
             message_text=lead["text"],
             group_title=lead["chat_title"],
             sender_name=lead.get("sender_name") or lead.get("sender_username") or "unknown",
+            use_cache=not force_regen,
         )
 
         if ai_wants_reply(ai) and not ai.get("reply_text"):
@@ -947,9 +3224,11 @@ async def send_dm_for_lead(client: TelegramClient, lead_id: str, force_regen: bo
     try:
         entity = await resolve_user_entity(client, lead)
         await client.send_message(entity, text)
-        await mark_dm_sent(lead["session_name"])
+        await mark_dm_sent(session_name)
         lead["last_dm_at"] = now_iso()
         lead["status"] = "dm_sent"
+        if session_name != lead["session_name"]:
+            lead["dm_session_name"] = session_name
         await remember_lead(lead)
         return f"✅ DM sent for {lead_id}"
     except UserPrivacyRestrictedError:
@@ -957,8 +3236,10 @@ async def send_dm_for_lead(client: TelegramClient, lead_id: str, force_regen: bo
     except UserNotMutualContactError:
         return "⚠️ User is not mutual contact"
     except PeerFloodError:
+        OUTBOUND_QUEUE.pause_session(session_name, PEER_FLOOD_PAUSE_SEC, "PeerFlood")
         return "⚠️ PeerFlood"
     except FloodWaitError as e:
+        OUTBOUND_QUEUE.pause_session(session_name, e.seconds, "FloodWait")
         return f"⚠️ FloodWait {e.seconds}s"
     except ChatWriteForbiddenError:
         return "⚠️ ChatWriteForbidden"
@@ -968,12 +3249,15 @@ async def send_dm_for_lead(client: TelegramClient, lead_id: str, force_regen: bo
         return f"⚠️ Failed to send DM: {type(e).__name__}: {e}"
 
 
-async def invite_lead_to_group(client: TelegramClient, lead_id: str) -> str:
+async def invite_lead_to_group(client: TelegramClient, lead_id: str, session_name: str = None) -> str:
     lead = LEADS.get(lead_id)
     if not lead:
         return f"❌ Lead {lead_id} not found"
 
-    allowed, reason = await can_invite(lead["session_name"])
+    session_name = session_name or lead["session_name"]
+    allowed, reason = await can_invite(session_name)
+    if allowed:
+        allowed, reason = OUTBOUND_QUEUE.session_ready(session_name)
     if not allowed:
         return f"⛔ Invite blocked: {reason}"
 
@@ -981,7 +3265,7 @@ async def invite_lead_to_group(client: TelegramClient, lead_id: str) -> str:
         user_entity = await resolve_user_entity(client, lead)
         group_entity = await client.get_input_entity(TARGET_INVITE_GROUP)
         await client(InviteToChannelRequest(channel=group_entity, users=[user_entity]))
-        await mark_invite_sent(lead["session_name"])
+        await mark_invite_sent(session_name)
         lead["last_invite_at"] = now_iso()
         lead["status"] = "invited"
         await remember_lead(lead)
@@ -991,8 +3275,10 @@ async def invite_lead_to_group(client: TelegramClient, lead_id: str) -> str:
     except UserPrivacyRestrictedError:
         return "⚠️ UserPrivacyRestricted"
     except PeerFloodError:
+        OUTBOUND_QUEUE.pause_session(session_name, PEER_FLOOD_PAUSE_SEC, "PeerFlood")
         return "⚠️ PeerFlood"
     except FloodWaitError as e:
+        OUTBOUND_QUEUE.pause_session(session_name, e.seconds, "FloodWait")
         return f"⚠️ FloodWait {e.seconds}s"
     except RPCError as e:
         return f"⚠️ RPC error: {type(e).__name__}: {e}"
@@ -1000,127 +3286,509 @@ async def invite_lead_to_group(client: TelegramClient, lead_id: str) -> str:
         return f"⚠️ Invite failed: {type(e).__name__}: {e}"
 
 
+# =============================================================================
+# OUTBOUND QUEUE
+# =============================================================================
+
+# Results after which a job stays queued: limits, pauses and flood errors.
+OUTBOUND_RETRY_RESULTS = ("⛔ DM blocked", "⛔ Invite blocked", "⚠️ FloodWait", "⚠️ PeerFlood")
+
+_OUTBOUND_RESULT_LABELS = (
+    ("✅", "ok"),
+    ("⛔ DM blocked", "blocked"),
+    ("⛔ Invite blocked", "blocked"),
+    ("⛔ AI marked", "ai_skip"),
+    ("⛔ Empty", "empty_reply"),
+    ("❌", "lead_missing"),
+    ("⚠️ FloodWait", "FloodWaitError"),
+    ("⚠️ PeerFlood", "PeerFloodError"),
+    ("⚠️ User privacy", "UserPrivacyRestrictedError"),
+    ("⚠️ UserPrivacyRestricted", "UserPrivacyRestrictedError"),
+    ("⚠️ User is not mutual", "UserNotMutualContactError"),
+    ("⚠️ UserNotMutualContact", "UserNotMutualContactError"),
+    ("⚠️ ChatWriteForbidden", "ChatWriteForbiddenError"),
+)
+
+
+def outbound_result_label(result: str) -> str:
+    """Bounded metric label for a send_dm_for_lead / invite_lead_to_group result."""
+    for prefix, label in _OUTBOUND_RESULT_LABELS:
+        if result.startswith(prefix):
+            return label
+    m = re.match(r"⚠️ (?:RPC error|Failed to send DM|Invite failed): (\w+):", result)
+    return m.group(1) if m else "other"
+
+
+class OutboundQueue:
+    """Persistent FIFO of DM/invite jobs, dispatched as soon as limits allow.
+
+    Each job prefers the session that found the lead. A DM job whose lead
+    has a username may spill to another connected session with spare quota
+    (OUTBOUND_SPILL); access hashes and invite rights are per account, so
+    other jobs stay on their session. FloodWait/PeerFlood pause the session
+    (PEER_FLOOD_PAUSE_SEC for PeerFlood) and the job is retried later.
+    Jobs older than OUTBOUND_JOB_MAX_AGE_HOURS are dropped. Results go to
+    the admin as "📬 OUTBOUND" notices. Persisted as a PERSIST sidecar.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: List[Dict[str, Any]] = []
+        self.paused_until: Dict[str, float] = {}
+        self.dirty = False
+        self.sent = 0
+        self.dropped = 0
+        self._wake = asyncio.Event()
+
+    def load(self):
+        data = load_json(self.path, {})
+        self.jobs = list(data.get("jobs") or [])
+        self.paused_until = {k: float(v) for k, v in (data.get("paused_until") or {}).items()}
+
+    def snapshot(self):
+        return {"jobs": _snapshot(self.jobs), "paused_until": dict(self.paused_until)}
+
+    def write(self, payload):
+        save_json(self.path, payload)
+
+    def submit(self, kind: str, lead_id: str, source: str = "command") -> int:
+        """Queue a job (once per kind and lead); returns its 1-based position."""
+        job_id = f"{kind}:{lead_id}"
+        for i, job in enumerate(self.jobs):
+            if job["id"] == job_id:
+                return i + 1
+        lead = LEADS[lead_id]
+        self.jobs.append({
+            "id": job_id,
+            "kind": kind,
+            "lead_id": lead_id,
+            "session_name": lead["session_name"],
+            "source": source,
+            "created_at": time.time(),
+            "attempts": 0,
+        })
+        self.dirty = True
+        self._wake.set()
+        return len(self.jobs)
+
+    def position(self, lead_id: str) -> Optional[int]:
+        for i, job in enumerate(self.jobs):
+            if job["lead_id"] == lead_id:
+                return i + 1
+        return None
+
+    def pause_session(self, session_name: str, seconds: float, reason: str):
+        SESSION_HEALTH.record_flood(session_name, seconds)
+        until = time.time() + max(0.0, float(seconds))
+        if until > self.paused_until.get(session_name, 0.0):
+            self.paused_until[session_name] = until
+            self.dirty = True
+            logging.warning("[%s] outbound paused for %ss (%s)", session_name, int(seconds), reason)
+
+    def session_ready(self, session_name: str) -> Tuple[bool, str]:
+        wait = self.paused_until.get(session_name, 0.0) - time.time()
+        if wait > 0:
+            return False, f"paused_{int(wait)}s"
+        return True, "ok"
+
+    def _session_wait(self, session_name: str, kind: str, now: float) -> float:
+        if session_name not in CLIENTS:
+            return float("inf")
+        paused = self.paused_until.get(session_name, 0.0) - now
+        wait, _ = OUTBOUND_LIMITER.time_until_allowed(session_name, kind, now)
+        return max(paused, wait, 0.0)
+
+    @staticmethod
+    def _spill_key(session_name: str) -> Tuple[float, float]:
+        """Sort key for spill targets: share of the 24h DM quota used, then health."""
+        used = OUTBOUND_LIMITER.counts(session_name).get("dm_day", 0) / max(1, OUTBOUND_DM_PER_DAY)
+        return used, -SESSION_HEALTH.weight(session_name)
+
+    def _candidates(self, job: Dict[str, Any]) -> List[str]:
+        lead = LEADS.get(job["lead_id"]) or {}
+        if OUTBOUND_SPILL and job["kind"] == "dm" and lead.get("sender_username"):
+            # any session can reach a username: least-loaded healthy one first
+            return sorted(set(CLIENTS) | {job["session_name"]}, key=self._spill_key)
+        return [job["session_name"]]
+
+    def _next(self, now: float) -> Tuple[Optional[int], Optional[str], float]:
+        """First job that can go now (index, session); otherwise the shortest wait."""
+        best_wait = float("inf")
+        busy = set()
+        for i, job in enumerate(self.jobs):
+            candidates = self._candidates(job)
+            for session_name in candidates:
+                if (session_name, job["kind"]) in busy:
+                    continue
+                wait = self._session_wait(session_name, job["kind"], now)
+                if wait <= 0:
+                    return i, session_name, 0.0
+                best_wait = min(best_wait, wait)
+            # keep FIFO order per session and kind: a blocked job holds every
+            # session it could go out on, so later jobs cannot overtake it there
+            busy.update((session_name, job["kind"]) for session_name in candidates)
+        return None, None, best_wait
+
+    def _expire(self, now: float):
+        max_age = OUTBOUND_JOB_MAX_AGE_HOURS * 3600
+        keep = [j for j in self.jobs if now - j["created_at"] <= max_age and j["lead_id"] in LEADS]
+        if len(keep) != len(self.jobs):
+            self.dropped += len(self.jobs) - len(keep)
+            self.jobs = keep
+            self.dirty = True
+
+    async def _dispatch(self, job: Dict[str, Any], session_name: str):
+        client = CLIENTS[session_name]
+        job["attempts"] += 1
+        if job["kind"] == "dm":
+            result = await send_dm_for_lead(client, job["lead_id"], session_name=session_name)
+        else:
+            result = await invite_lead_to_group(client, job["lead_id"], session_name=session_name)
+        M_OUTBOUND.inc(job["kind"], outbound_result_label(result))
+
+        if result.startswith(OUTBOUND_RETRY_RESULTS):
+            logging.info(
+                "[%s] outbound %s deferred: %s", session_name, job["id"], result,
+                extra={"session": session_name, "lead_id": job["lead_id"]},
+            )
+            await asyncio.sleep(1)
+        else:
+            self.jobs.remove(job)
+            if result.startswith("✅"):
+                self.sent += 1
+            label = "AUTO_SEND" if job["kind"] == "dm" else "AUTO_INVITE"
+            prefix = f"🤖 {label}" if job["source"] == "auto" else f"📬 OUTBOUND {job['kind']}"
+            await send_admin_notice(client, f"{prefix} {job['lead_id']} [{session_name}]: {result}")
+            if (
+                job["kind"] == "dm" and job["source"] == "auto"
+                and AUTO_INVITE_AFTER_DM and result.startswith("✅")
+            ):
+                self.submit("invite", job["lead_id"], source="auto")
+        self.dirty = True
+
+    async def run(self):
+        while not shutdown.is_set():
+            now = time.time()
+            self._expire(now)
+            index, session_name, wait = self._next(now)
+            if index is not None:
+                try:
+                    await self._dispatch(self.jobs[index], session_name)
+                except Exception:
+                    logging.exception("Outbound dispatch failed")
+                    await asyncio.sleep(5)
+                continue
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=min(wait, 60.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats_lines(self, limit: int = 5) -> List[str]:
+        now = time.time()
+        lines = [f"Outbound queue: {len(self.jobs)} jobs, {self.sent} sent, {self.dropped} dropped"]
+        for session_name, until in sorted(self.paused_until.items()):
+            if until > now:
+                lines.append(f"  [{session_name}] paused {int(until - now)}s")
+        for i, job in enumerate(self.jobs[:limit]):
+            wait = min(self._session_wait(name, job["kind"], now) for name in self._candidates(job))
+            eta = "ready" if wait <= 0 else ("no session" if wait == float("inf") else f"~{int(wait)}s")
+            lines.append(f"  #{i + 1} {job['kind']} {job['lead_id']} [{job['session_name']}] {eta}")
+        return lines
+
+
+OUTBOUND_QUEUE = OutboundQueue(OUTBOUND_QUEUE_FILE)
+OUTBOUND_QUEUE.load()
+PERSIST.register_sidecar(OUTBOUND_QUEUE)
+
+
+# =============================================================================
+# AI WORK QUEUE
+# =============================================================================
+
+AI_PRIORITY = {"lead_search": 0, "lead_question": 1, "partner_services": 2}
+
+
+class CandidateJob:
+    __slots__ = (
+        "client", "config", "event", "sender", "text", "analysis", "category",
+        "rule_reason", "sender_username", "sender_name", "event_key", "dup_key",
+        "prescore", "enqueued_at",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def priority(self) -> int:
+        return AI_PRIORITY.get(self.category, len(AI_PRIORITY))
+
+
+class AIWorkQueue:
+    """Bounded priority queue in front of the AI step, drained by N workers.
+
+    lead_search jobs run before lead_question, which run before
+    partner_services; equal priorities keep arrival order. When the queue is
+    full, the lowest-priority, newest job is shed: it is recorded as a lead
+    with a "queue_overflow" skip verdict instead of an AI call, so the admin
+    still sees it and can /regen later.
+    """
+
+    def __init__(self, max_depth: int):
+        self.max_depth = max(1, max_depth)
+        self._heap: List[Tuple[int, int, CandidateJob]] = []
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._shed_tasks = set()
+        self.busy = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.shed = 0
+        self.max_seen_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def submit(self, job: CandidateJob):
+        self.enqueued += 1
+        entry = (job.priority, next(self._seq), job)
+        if len(self._heap) >= self.max_depth:
+            worst = max(self._heap)
+            if entry > worst:
+                self._shed(job)
+                return
+            self._heap.remove(worst)
+            heapq.heapify(self._heap)
+            self._shed(worst[2])
+        heapq.heappush(self._heap, entry)
+        self.max_seen_depth = max(self.max_seen_depth, len(self._heap))
+        self._ready.set()
+
+    def _shed(self, job: CandidateJob):
+        self.shed += 1
+        logging.warning("[%s] AI queue full, shedding %s job", job.config["session_name"], job.category)
+        ai = dict(AI_JSON_FALLBACK, reason="queue_overflow")
+        task = asyncio.ensure_future(process_candidate(job, ai=ai))
+        self._shed_tasks.add(task)
+        task.add_done_callback(self._shed_tasks.discard)
+
+    async def _worker(self):
+        while True:
+            while not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+            _, _, job = heapq.heappop(self._heap)
+            waited = time.monotonic() - job.enqueued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.busy += 1
+            try:
+                await process_candidate(job)
+            except Exception:
+                logging.exception("[%s] AI worker failed", job.config["session_name"])
+            finally:
+                self.busy -= 1
+                self.processed += 1
+
+    def start(self, workers: int):
+        for _ in range(max(1, workers)):
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats_line(self) -> str:
+        avg_wait = self.wait_total / self.processed if self.processed else 0.0
+        return (
+            f"AI queue: depth {len(self._heap)}/{self.max_depth} (max {self.max_seen_depth}), "
+            f"busy {self.busy}/{len(self._workers)}, shed {self.shed}, "
+            f"wait avg {avg_wait:.1f}s max {self.wait_max:.1f}s"
+        )
+
+
+AI_QUEUE = AIWorkQueue(AI_QUEUE_MAX)
+
+
 # =============================================================================
 # MESSAGE PROCESSING
 # =============================================================================
 
-async def handle_candidate_message(client: TelegramClient, config: Dict[str, Any], event):
+async def handle_candidate_message(client: TelegramClient, config: Dict[str, Any], event, sender=None):
     if not event.raw_text:
         return
 
+    if GROUP_SHARDING and not GROUP_OWNERS.owns(config["session_name"], event.chat_id):
+        return
+
     me_id = ME_IDS.get(config["session_name"])
-    sender = await event.get_sender()
-    if me_id and getattr(sender, "id", None) == me_id:
+    profile = await SENDER_CACHE.profile(event, sender)
+    sender = profile.sender
+    if me_id and profile.id == me_id:
         return
 
-    if known_internal_sender(sender):
+    if profile.internal:
         return
 
     # 1) Пропускаем неактивные / отсутствующие username
     #    Примеры: "Станислав", "unknown", пустой username
-    if not has_active_username(sender):
-        logging.info("[%s] Skip sender without active username", config["session_name"])
+    if not profile.active_username:
+        logging.info(
+            "[%s] Skip sender without active username", config["session_name"],
+            extra={"session": config["session_name"], "chat_id": event.chat_id, "skip": "no_username"},
+        )
         return
 
-    sender_key = make_sender_activity_key(sender)
+    sender_key = profile.activity_key
 
     # 2) Игнорируем пользователей, которые участвуют в групповом обсуждении
     if getattr(event, "is_reply", False) or sender_is_in_group_discussion(event.chat_id, sender_key):
         remember_group_activity(event.chat_id, sender_key)
-        logging.info("[%s] Skip discussion participant in chat %s", config["session_name"], event.chat_id)
+        logging.info(
+            "[%s] Skip discussion participant in chat %s", config["session_name"], event.chat_id,
+            extra={"session": config["session_name"], "chat_id": event.chat_id, "skip": "discussion"},
+        )
         return
 
     remember_group_activity(event.chat_id, sender_key)
 
     text = event.raw_text.strip()
-    category, rule_reason = classify_message(text)
+    sender_username = profile.username
+    analysis = MessageAnalysis(text, sender_username or "")
+    started = time.perf_counter()
+    category, rule_reason = classify_message(text, analysis)
+    M_CLASSIFY_SEC.observe(time.perf_counter() - started)
+    M_CLASSIFY.inc(category, rule_reason.split(":", 1)[0] if ":" in rule_reason else rule_reason)
     if category in ("ignore", "reject_spam"):
         return
 
-    sender_username = getattr(sender, "username", None)
-    sender_name = (
-        f"{(getattr(sender, 'first_name', '') or '').strip()} {(getattr(sender, 'last_name', '') or '').strip()}".strip()
-        or sender_username
-        or str(getattr(sender, "id", "unknown"))
-    )
+    sender_name = profile.display_name or sender_username or str(getattr(sender, "id", "unknown"))
 
     event_key = f"msg:{event.chat_id}:{event.id}"
+    dup_key = f"fp:{analysis.fingerprint}"
 
-    async with PERSIST_LOCK:
+    async with timed_lock(PERSIST_LOCK):
         purge_seen()
-        if event_key in SEEN or event_key in INFLIGHT:
+        if event_key in SEEN or event_key in INFLIGHT or dup_key in INFLIGHT or SEEN.is_fresh(dup_key):
             return
+        # the fingerprint is reserved too: SEEN only gets it after the AI step,
+        # and a queued cross-post must not pass the check in the meantime
         INFLIGHT.add(event_key)
+        INFLIGHT.add(dup_key)
+
+    job = CandidateJob(
+        client=client,
+        config=config,
+        event=event,
+        sender=sender,
+        text=text,
+        analysis=analysis,
+        category=category,
+        rule_reason=rule_reason,
+        sender_username=sender_username,
+        sender_name=sender_name,
+        event_key=event_key,
+        dup_key=dup_key,
+    )
 
-    try:
-        fp = hash_fingerprint(sender_username or "", text)
-        dup_key = f"fp:{fp}"
+    if PRESCORER is not None:
+        job.prescore = PRESCORER.score(analysis.normalized, category)
+        if job.prescore < PRESCORER_THRESHOLD:
+            ai = dict(AI_JSON_FALLBACK, reason=f"prescorer:{job.prescore:.2f}", language=analysis.language)
+            await process_candidate(job, ai=ai)
+            return
 
-        async with PERSIST_LOCK:
-            ts = float(SEEN.get(dup_key, 0.0) or 0.0)
-            if time.time() - ts < 12 * 3600:
-                return
+    AI_QUEUE.submit(job)
 
-        ai = await ai_generate_reply(
-            scenario_hint=category,
-            message_text=text,
-            group_title=getattr(event.chat, "title", "Unknown"),
-            sender_name=sender_name,
-        )
+
+async def process_candidate(job: "CandidateJob", ai: Dict[str, Any] = None):
+    """AI step and lead creation for a candidate that passed rules and dedup.
+
+    Runs on an AI_QUEUE worker. `ai` is given when the job is shed from a full
+    queue; the lead is then recorded without calling OpenAI.
+    """
+    event = job.event
+    category = job.category
+    analysis = job.analysis
+    try:
+        if ai is None:
+            ai = await ai_generate_reply(
+                scenario_hint=category,
+                message_text=job.text,
+                group_title=getattr(event.chat, "title", "Unknown"),
+                sender_name=job.sender_name,
+                analysis=analysis,
+            )
 
         if ai_wants_reply(ai) and not ai.get("reply_text"):
-            ai["reply_text"] = fallback_reply(category, ai.get("language") or detect_language(text))
-            ai["language"] = ai.get("language") or detect_language(text)
+            ai["reply_text"] = fallback_reply(category, ai.get("language") or analysis.language)
+            ai["language"] = ai.get("language") or analysis.language
 
         lead = {
             "id": make_lead_id(),
             "created_at": now_iso(),
-            "session_name": config["session_name"],
+            "session_name": job.config["session_name"],
             "chat_id": event.chat_id,
             "chat_title": getattr(event.chat, "title", "Unknown"),
             "message_id": event.id,
             "message_link": build_message_link(event.chat, event.id),
-            "sender_id": getattr(sender, "id", None),
-            "sender_access_hash": getattr(sender, "access_hash", None),
-            "sender_username": sender_username,
-            "sender_name": sender_name,
-            "text": text,
+            "sender_id": getattr(job.sender, "id", None),
+            "sender_access_hash": getattr(job.sender, "access_hash", None),
+            "sender_username": job.sender_username,
+            "sender_name": job.sender_name,
+            "text": job.text,
             "category": category,
-            "rule_reason": rule_reason,
+            "rule_reason": job.rule_reason,
             "ai": ai,
             "status": "new",
         }
+        if job.prescore is not None:
+            lead["prescore"] = round(job.prescore, 4)
+        if analysis.prompted:
+            lead["ai_input"] = ai_input_sizes(analysis)
 
         await remember_lead(lead)
+        logging.info(
+            "[%s] lead %s %s (%s) in chat %s",
+            lead["session_name"], lead["id"], category, ai.get("action"), event.chat_id,
+            extra={"session": lead["session_name"], "chat_id": event.chat_id, "lead_id": lead["id"]},
+        )
 
-        async with PERSIST_LOCK:
-            SEEN[event_key] = time.time()
-            SEEN[dup_key] = time.time()
-            save_json(SEEN_FILE, SEEN)
+        async with timed_lock(PERSIST_LOCK):
+            SEEN[job.event_key] = time.time()
+            SEEN[job.dup_key] = time.time()
+            PERSIST.mark("seen", job.event_key, job.dup_key)
 
             update_analytics_bucket(lead["chat_title"], category)
-            save_json(ANALYTICS_FILE, ANALYTICS)
+            PERSIST.mark("analytics", lead["chat_title"])
 
+        client = job.client
         card = render_lead_card(lead)
         await send_admin_notice(client, card)
 
         if AUTO_SEND_HIGH_CONFIDENCE and ai.get("action") != "skip" and float(ai.get("confidence", 0.0) or 0.0) >= AUTO_SEND_THRESHOLD:
-            result = await send_dm_for_lead(client, lead["id"])
-            await send_admin_notice(client, f"🤖 AUTO_SEND {lead['id']}: {result}")
-            if AUTO_INVITE_AFTER_DM and result.startswith("✅"):
-                inv = await invite_lead_to_group(client, lead["id"])
-                await send_admin_notice(client, f"🤖 AUTO_INVITE {lead['id']}: {inv}")
+            OUTBOUND_QUEUE.submit("dm", lead["id"], source="auto")
 
     finally:
-        async with PERSIST_LOCK:
-            INFLIGHT.discard(event_key)
+        async with timed_lock(PERSIST_LOCK):
+            INFLIGHT.discard(job.event_key)
+            INFLIGHT.discard(job.dup_key)
 
 
-async def handle_private_inbound(client: TelegramClient, config: Dict[str, Any], event):
+async def handle_private_inbound(client: TelegramClient, config: Dict[str, Any], event, sender=None):
     if not event.is_private or not event.raw_text:
         return
 
-    sender = await event.get_sender()
+    if sender is None:
+        sender = await event.get_sender()
     me_id = ME_IDS.get(config["session_name"])
     if getattr(sender, "id", None) == me_id:
         return
@@ -1159,8 +3827,9 @@ HELP_TEXT = (
 )
 
 
-async def is_authorized_command_sender(event, session_name: str) -> bool:
-    sender = await event.get_sender()
+async def is_authorized_command_sender(event, session_name: str, sender=None) -> bool:
+    if sender is None:
+        sender = await event.get_sender()
     me_id = ME_IDS.get(session_name)
 
     if getattr(sender, "id", None) == me_id:
@@ -1170,13 +3839,13 @@ async def is_authorized_command_sender(event, session_name: str) -> bool:
     if sender_username == ADMIN_NOTIFY_USERNAME.lower():
         return True
 
-    if getattr(sender, "id", None) in set(ME_IDS.values()):
+    if getattr(sender, "id", None) in ME_ID_SET:
         return True
 
     return False
 
 
-async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
+async def handle_command(client: TelegramClient, config: Dict[str, Any], event, sender=None):
     if not event.raw_text:
         return
 
@@ -1187,7 +3856,7 @@ async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
     if not event.is_private:
         return
 
-    if not await is_authorized_command_sender(event, config["session_name"]):
+    if not await is_authorized_command_sender(event, config["session_name"], sender):
         return
 
     parts = text.split(maxsplit=1)
@@ -1199,12 +3868,23 @@ async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
         return
 
     if cmd == "/stats":
-        s = OUTBOUND_STATS.get(config["session_name"], {})
+        counts = OUTBOUND_LIMITER.counts(config["session_name"])
+        dm_wait, dm_reason = OUTBOUND_LIMITER.time_until_allowed(config["session_name"], "dm")
         msg = (
             f"Stats [{config['session_name']}]\n"
-            f"DM day {_day_key()}: {int((s.get('dm_day') or {}).get(_day_key(), 0))}/{OUTBOUND_DM_PER_DAY}\n"
-            f"DM hour {_hour_key()}: {int((s.get('dm_hour') or {}).get(_hour_key(), 0))}/{OUTBOUND_DM_PER_HOUR}\n"
-            f"Invite day {_day_key()}: {int((s.get('invite_day') or {}).get(_day_key(), 0))}/{INVITE_PER_DAY}"
+            f"DM 24h: {counts['dm_day']}/{OUTBOUND_DM_PER_DAY}\n"
+            f"DM 1h: {counts['dm_hour']}/{OUTBOUND_DM_PER_HOUR}\n"
+            f"Invite 24h: {counts['invite_day']}/{INVITE_PER_DAY}\n"
+            f"Next DM: {'now' if dm_wait <= 0 else f'in {int(dm_wait)}s ({dm_reason})'}\n"
+            f"{AI_CACHE.stats_line()}\n"
+            f"{AI_QUEUE.stats_line()}\n"
+            f"{AI_GATEWAY.stats_line()}\n"
+            f"{AI_BATCHER.stats_line()}\n"
+            f"{AI_INPUT_STATS.stats_line()}\n"
+            f"{SENDER_CACHE.stats_line()}\n"
+            f"{SESSION_HEALTH.stats_line()}\n"
+            f"Group shares: {GROUP_OWNERS.shares()}\n"
+            + "\n".join(OUTBOUND_QUEUE.stats_lines())
         )
         await event.reply(msg)
         return
@@ -1233,6 +3913,7 @@ async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
             message_text=lead["text"],
             group_title=lead["chat_title"],
             sender_name=lead.get("sender_name") or lead.get("sender_username") or "unknown",
+            use_cache=False,
         )
         if ai_wants_reply(ai) and not ai.get("reply_text"):
             ai["reply_text"] = fallback_reply(
@@ -1245,13 +3926,13 @@ async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
         return
 
     if cmd in ("/dm", "/pitch"):
-        res = await send_dm_for_lead(target_client, arg, force_regen=False)
-        await event.reply(res)
+        position = OUTBOUND_QUEUE.submit("dm", arg)
+        await event.reply(f"📬 DM for {arg} queued (#{position}); the result follows as a notice")
         return
 
     if cmd == "/invite":
-        res = await invite_lead_to_group(target_client, arg)
-        await event.reply(res)
+        position = OUTBOUND_QUEUE.submit("invite", arg)
+        await event.reply(f"📬 Invite for {arg} queued (#{position}); the result follows as a notice")
         return
 
     if cmd == "/fav":
@@ -1277,6 +3958,46 @@ async def handle_command(client: TelegramClient, config: Dict[str, Any], event):
         return
 
 
+# =============================================================================
+# DISPATCH
+# =============================================================================
+
+async def dispatch_message(
+    client: TelegramClient, config: Dict[str, Any], monitored_ids: set, event, cells: List[CounterCell] = None,
+):
+    """Single NewMessage entry point per client.
+
+    Incoming messages from monitored chats go to handle_candidate_message;
+    private messages go to handle_private_inbound (incoming) and, for
+    "/..." texts, to handle_command (either direction). Everything else is
+    dropped after a set lookup. The sender is fetched at most once and
+    shared between the private handlers. `cells` are the session's
+    event_cells(), passed in so the per-update count is one increment.
+    """
+    if cells is None:
+        cells = event_cells(config["session_name"])
+    if event.is_private:
+        cells[0].value += 1
+        text = event.raw_text
+        if not text:
+            return
+        is_command = text.strip().startswith("/")
+        if event.out and not is_command:
+            return
+        sender = await event.get_sender()
+        if not event.out:
+            await handle_private_inbound(client, config, event, sender)
+        if is_command:
+            await handle_command(client, config, event, sender)
+        return
+
+    if event.out or event.chat_id not in monitored_ids:
+        cells[1].value += 1
+        return
+    cells[2].value += 1
+    await handle_candidate_message(client, config, event)
+
+
 # =============================================================================
 # LIFECYCLE
 # =============================================================================
@@ -1289,10 +4010,10 @@ async def run_client_forever(config: Dict[str, Any]):
     session_name = config["session_name"]
 
     if not config["api_id"]:
-        logging.error("[%s] Missing api_id. Set TG_API_ID_1 / TG_API_ID_2 env vars.", session_name)
+        logging.error("[%s] Missing api_id. Set TG_API_ID_<n> or ACCOUNTS_FILE.", session_name)
         return
     if not config["api_hash"]:
-        logging.error("[%s] Missing api_hash. Set TG_API_HASH_1 / TG_API_HASH_2 env vars.", session_name)
+        logging.error("[%s] Missing api_hash. Set TG_API_HASH_<n> or ACCOUNTS_FILE.", session_name)
         return
 
     backoff = 5
@@ -1311,42 +4032,38 @@ async def run_client_forever(config: Dict[str, Any]):
 
             me = await client.get_me()
             ME_IDS[session_name] = me.id
+            if me.id not in ME_ID_SET:
+                ME_ID_SET.add(me.id)
+                SENDER_CACHE.clear()
             CLIENTS[session_name] = client
             logging.info("[%s] Connected as @%s", session_name, getattr(me, "username", None))
 
-            entities = await load_or_fetch_entities(client, GROUPS_TO_MONITOR)
+            entities = await load_or_fetch_entities(client, session_name, GROUPS_TO_MONITOR)
             logging.info("[%s] Monitoring %s chats", session_name, len(entities))
-
-            @client.on(events.NewMessage(chats=entities, incoming=True))
-            async def group_handler(event):
-                try:
-                    await handle_candidate_message(client, config, event)
-                except Exception:
-                    logging.exception("[%s] group_handler failed", session_name)
-
-            @client.on(events.NewMessage(incoming=True))
-            async def private_inbound_handler(event):
-                try:
-                    await handle_private_inbound(client, config, event)
-                except Exception:
-                    logging.exception("[%s] private_inbound_handler failed", session_name)
+            monitored_ids = {get_peer_id(e) for e in entities}
+            GROUP_OWNERS.register(session_name, monitored_ids)
+            cells = event_cells(session_name)
 
             @client.on(events.NewMessage())
-            async def command_handler(event):
+            async def message_handler(event):
                 try:
-                    await handle_command(client, config, event)
+                    await dispatch_message(client, config, monitored_ids, event, cells)
                 except Exception:
-                    logging.exception("[%s] command_handler failed", session_name)
+                    logging.exception("[%s] message_handler failed", session_name)
 
             backoff = 5
             await client.run_until_disconnected()
 
         except Exception as e:
             logging.critical("[%s] Critical error: %s", session_name, e)
+            SESSION_HEALTH.record_failure(session_name)
             await asyncio.sleep(backoff)
             backoff = min(backoff * 2, 60)
         finally:
             CLIENTS.pop(session_name, None)
+            GROUP_OWNERS.unregister(session_name)
+            if session_name in ENTITY_INDEXES:
+                ENTITY_INDEXES[session_name].stop_revalidation()
             if client:
                 try:
                     await client.disconnect()
@@ -1374,13 +4091,32 @@ async def main():
         logging.critical("No valid Telegram accounts configured")
         return
 
+    metrics_server = await start_metrics_server()
+    persist_task = asyncio.create_task(PERSIST.run())
+    outbound_task = asyncio.create_task(OUTBOUND_QUEUE.run())
+    AI_QUEUE.start(AI_WORKERS)
+    prewarm_task = asyncio.create_task(AI_GATEWAY.prewarm())
     tasks = [asyncio.create_task(run_client_forever(cfg)) for cfg in valid_accounts]
     await shutdown.wait()
 
+    # outbound first, while its clients are still connected; a cancelled
+    # dispatch leaves its job queued for the final flush
+    outbound_task.cancel()
+    await asyncio.gather(outbound_task, return_exceptions=True)
+
     for t in tasks:
         t.cancel()
     await asyncio.gather(*tasks, return_exceptions=True)
 
+    prewarm_task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await AI_QUEUE.stop()
+    persist_task.cancel()
+    await asyncio.gather(prewarm_task, persist_task, return_exceptions=True)
+    await PERSIST.close()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
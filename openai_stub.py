@@ -0,0 +1,162 @@
+"""Local stand-in for the OpenAI Responses API.
+
+Usage:
+    python openai_stub.py [--port 8765] [--latency 0.5] [--jitter 0.2]
+                          [--error-rate 0.0] [--reject-json-mode]
+
+Then run the bot (or bench/replay tools) with
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+
+Serves POST /v1/responses and GET /v1/models with configurable latency and
+failures, so the circuit breaker, json-mode selector, hedging and prewarm in
+bot.OpenAIGateway can be exercised without network access.
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+def stub_verdict(prompt: str) -> dict:
+    hint = ""
+    for line in prompt.splitlines():
+        if line.startswith("scenario_hint="):
+            hint = line.split("=", 1)[1].strip()
+            break
+    action = {
+        "lead_search": "lead_search_reply",
+        "lead_question": "lead_question_reply",
+        "partner_services": "partner_pitch",
+    }.get(hint, "skip")
+    return {
+        "action": action,
+        "confidence": 0.8 if action != "skip" else 0.1,
+        "language": "ru",
+        "reason": f"stub:{hint or 'none'}",
+        "reply_text": "Добрый день! Опишите, пожалуйста, коротко ситуацию." if action != "skip" else "",
+    }
+
+
+def stub_output(payload: dict) -> dict:
+    prompt = str(payload.get("input") or "")
+    if "### index=" not in prompt:
+        return stub_verdict(prompt)
+    results = []
+    for block in prompt.split("### index=")[1:]:
+        index, _, rest = block.partition("\n")
+        results.append(dict(stub_verdict(rest), index=int(index)))
+    return {"results": results}
+
+
+def response_body(payload: dict) -> dict:
+    text = json.dumps(stub_output(payload), ensure_ascii=False)
+    now = int(time.time())
+    return {
+        "id": f"resp_stub_{now}",
+        "object": "response",
+        "created_at": now,
+        "model": payload.get("model") or "stub",
+        "status": "completed",
+        "output": [{
+            "type": "message",
+            "id": f"msg_stub_{now}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": len(str(payload.get("instructions") or "")) // 4 + len(str(payload.get("input") or "")) // 4,
+            "output_tokens": len(text) // 4,
+            "total_tokens": 0,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+class StubServer:
+    def __init__(self, latency: float, jitter: float, error_rate: float, reject_json_mode: bool):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reject_json_mode = reject_json_mode
+        self.requests = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+                status, out = await self.route(method, path, body)
+                data = json.dumps(out, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes):
+        self.requests += 1
+        if method == "GET" and path.rstrip("/").endswith("/models"):
+            return "200 OK", {"object": "list", "data": [{"id": "stub", "object": "model", "created": 0, "owned_by": "stub"}]}
+        if method != "POST" or not path.rstrip("/").endswith("/responses"):
+            return "404 Not Found", {"error": {"message": "not found", "type": "invalid_request_error"}}
+
+        payload = json.loads(body or b"{}")
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if self.reject_json_mode and (payload.get("text") or {}).get("format", {}).get("type") == "json_object":
+            return "400 Bad Request", {"error": {"message": "json_object not supported", "type": "invalid_request_error"}}
+        if random.random() < self.error_rate:
+            return "500 Internal Server Error", {"error": {"message": "stub failure", "type": "server_error"}}
+        return "200 OK", response_body(payload)
+
+
+async def serve(host: str, port: int, stub: StubServer):
+    server = await asyncio.start_server(stub.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reject-json-mode", action="store_true")
+    args = parser.parse_args(argv)
+
+    stub = StubServer(args.latency, args.jitter, args.error_rate, args.reject_json_mode)
+    print(f"OpenAI stub on http://{args.host}:{args.port}/v1")
+    try:
+        asyncio.run(serve(args.host, args.port, stub))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
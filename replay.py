@@ -0,0 +1,428 @@
+"""Replay recorded group messages through the candidate pipeline offline.
+
+Usage:
+    python replay.py MESSAGES.jsonl [--speed 0] [--ai-latency 0.2] [--ai-jitter 0.05]
+                                    [--workers N] [--limit N] [--verbose]
+    python replay.py --synthetic 5000 [--interval 2.0] ...
+
+Each JSONL line is one group message:
+
+    {"chat": {"id": -1001234567890, "title": "Ukrainians in Essen", "username": "ua_essen"},
+     "sender": {"id": 42, "username": "olena_k", "first_name": "Olena"},
+     "text": "Ищу адвоката по семейным делам", "timestamp": "2025-03-01T10:15:00",
+     "message_id": 1001, "is_reply": false}
+
+`chat` may also be a bare id or title, `sender` a bare id or username, and
+the timestamp may be an ISO string or epoch seconds (`timestamp`, `ts` or
+`date`). --synthetic N replays the bench.py corpus instead of a file.
+
+Messages go through handle_candidate_message with fake event/client objects,
+and bot.ai_generate_reply is replaced by a stub that sleeps --ai-latency
+(± --ai-jitter) and answers like openai_stub.py. The bot's clock follows the
+recorded timestamps, so discussion windows and dedup TTLs behave as they did
+live. --speed 0 dispatches as fast as possible; --speed N replays N times
+faster than recorded. DATA_DIR is always a fresh temporary directory, so
+the bot's real state is neither read nor written (set PRESCORER_FILE to
+replay with a trained pre-scorer).
+
+Reports throughput, p50/p95/p99 per-message latency (until the handler
+returns, or until the lead is recorded for messages that reach the AI
+step), and counts per classification and outcome.
+"""
+
+import os
+import sys
+import json
+import math
+import zlib
+import time
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+import contextvars
+from collections import Counter
+from datetime import datetime
+
+_TMP = tempfile.mkdtemp(prefix="replay_")
+os.environ["DATA_DIR"] = _TMP
+os.environ["LOG_PATH"] = os.path.join(_TMP, "bot.log")
+os.environ["SQLITE_PATH"] = os.path.join(_TMP, "bot.sqlite3")
+
+import bot  # noqa: E402
+import openai_stub  # noqa: E402
+
+
+# =============================================================================
+# FAKE TELEGRAM
+# =============================================================================
+
+class FakeChat:
+    def __init__(self, chat_id: int, title: str = "", username: str = None):
+        self.id = chat_id
+        self.title = title or str(chat_id)
+        self.username = username
+
+
+class FakeSender:
+    def __init__(self, sender_id: int, username: str = None, first_name: str = "", last_name: str = "", is_bot: bool = False):
+        self.id = sender_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.bot = is_bot
+        self.access_hash = sender_id * 7919
+
+
+class FakeEvent:
+    """The parts of a Telethon NewMessage event handle_candidate_message reads."""
+
+    def __init__(self, record: "ReplayRecord"):
+        self.chat = record.chat
+        self.chat_id = record.chat.id
+        self.id = record.message_id
+        self.raw_text = record.text
+        self.sender = record.sender
+        self.sender_id = record.sender.id
+        self.is_reply = record.is_reply
+        self.is_private = False
+        self.out = False
+        # filled in by the replay
+        self.category = None
+        self.queued = False
+        self.processed = False
+        self.done = None
+        self.started = 0.0
+        self.finished = 0.0
+
+    async def get_sender(self):
+        return self.sender
+
+
+class FakeClient:
+    def __init__(self):
+        self.notices = 0
+
+    async def send_message(self, entity, text, **kwargs):
+        self.notices += 1
+
+
+# =============================================================================
+# INPUT
+# =============================================================================
+
+class ReplayRecord:
+    __slots__ = ("chat", "sender", "text", "ts", "message_id", "is_reply")
+
+    def __init__(self, chat, sender, text, ts, message_id, is_reply=False):
+        self.chat = chat
+        self.sender = sender
+        self.text = text
+        self.ts = ts
+        self.message_id = message_id
+        self.is_reply = is_reply
+
+
+def _parse_ts(value) -> float:
+    if value is None or value == "":
+        return time.time()
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+
+def _parse_chat(raw, chats):
+    if isinstance(raw, dict):
+        chat_id = int(raw.get("id") or 0)
+        title, username = raw.get("title") or "", raw.get("username")
+    elif isinstance(raw, int) or (isinstance(raw, str) and raw.lstrip("-").isdigit()):
+        chat_id, title, username = int(raw), "", None
+    else:
+        title, username = str(raw or "unknown"), None
+        chat_id = -1000000000000 - zlib.crc32(title.encode())
+    if chat_id not in chats:
+        chats[chat_id] = FakeChat(chat_id, title, username)
+    return chats[chat_id]
+
+
+def _parse_sender(raw, senders):
+    if isinstance(raw, dict):
+        sender_id = int(raw.get("id") or 0) or zlib.crc32(str(raw.get("username")).encode())
+        fields = dict(
+            username=raw.get("username"),
+            first_name=raw.get("first_name") or raw.get("name") or "",
+            last_name=raw.get("last_name") or "",
+            is_bot=bool(raw.get("bot")),
+        )
+    elif isinstance(raw, int) or (isinstance(raw, str) and raw.isdigit()):
+        sender_id, fields = int(raw), {}
+    else:
+        username = str(raw or "").lstrip("@") or None
+        sender_id, fields = zlib.crc32(str(username).encode()), dict(username=username)
+    if sender_id not in senders:
+        senders[sender_id] = FakeSender(sender_id, **fields)
+    return senders[sender_id]
+
+
+def load_records(path: str, limit: int = 0):
+    chats, senders = {}, {}
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"line {n}: skipped ({e})")
+                continue
+            if not row.get("text"):
+                continue
+            records.append(ReplayRecord(
+                chat=_parse_chat(row.get("chat", row.get("chat_id")), chats),
+                sender=_parse_sender(row.get("sender", row.get("sender_username", row.get("sender_id"))), senders),
+                text=row["text"],
+                ts=_parse_ts(row.get("timestamp", row.get("ts", row.get("date")))),
+                message_id=int(row.get("message_id") or n),
+                is_reply=bool(row.get("is_reply")),
+            ))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda r: r.ts)
+    return records
+
+
+def synthetic_records(size: int, interval: float, seed: int = 7):
+    import bench
+
+    rnd = random.Random(seed)
+    chats = [FakeChat(-1001000000000 - i, f"{city} chat", None) for i, city in enumerate(bench.CITIES)]
+    senders = [FakeSender(100000 + i, f"user{i}", f"Name{i}") for i in range(max(1, size // 4))]
+    start = time.time() - size * interval
+    return [
+        ReplayRecord(rnd.choice(chats), rnd.choice(senders), text, start + i * interval, i + 1, rnd.random() < 0.1)
+        for i, text in enumerate(bench.build_corpus(size, seed))
+    ]
+
+
+# =============================================================================
+# CLOCK / STUBS
+# =============================================================================
+
+class ReplayClock:
+    """Stands in for the `time` module inside bot: time() follows the replay.
+
+    set(ts) moves the wall clock to a recorded timestamp (never backwards);
+    between calls it advances in real time. Everything else, perf_counter
+    and monotonic included, is the real `time` module.
+    """
+
+    def __init__(self, real=time):
+        self._real = real
+        self.offset = 0.0
+
+    def time(self) -> float:
+        return self._real.time() + self.offset
+
+    def set(self, ts: float):
+        self.offset = max(self.offset, ts - self._real.time())
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+
+CURRENT_EVENT: "contextvars.ContextVar[FakeEvent]" = contextvars.ContextVar("replay_event")
+
+
+def make_stub_ai(latency: float, jitter: float, seed: int = 11):
+    rnd = random.Random(seed)
+
+    async def stub_ai_generate_reply(scenario_hint, message_text, group_title, sender_name, analysis=None, use_cache=True):
+        await asyncio.sleep(max(0.0, latency + rnd.uniform(-jitter, jitter)))
+        verdict = openai_stub.stub_verdict(f"scenario_hint={scenario_hint}")
+        verdict["language"] = ""
+        return bot._normalize_ai_payload(message_text, verdict, analysis)
+
+    return stub_ai_generate_reply
+
+
+def install_hooks(latency: float, jitter: float, clock: ReplayClock):
+    """Patch bot for the replay and return a function that undoes it."""
+    originals = {
+        "time": bot.time,
+        "ai_generate_reply": bot.ai_generate_reply,
+        "classify_message": bot.classify_message,
+        "process_candidate": bot.process_candidate,
+    }
+    classify = bot.classify_message
+    process = bot.process_candidate
+    submit = bot.AI_QUEUE.submit
+
+    def classify_message(text, analysis=None):
+        result = classify(text, analysis)
+        event = CURRENT_EVENT.get(None)
+        if event is not None:
+            event.category = result[0]
+        return result
+
+    async def process_candidate(job, ai=None):
+        try:
+            await process(job, ai=ai)
+        finally:
+            event = job.event
+            event.processed = True
+            event.finished = time.perf_counter()
+            if event.done is not None and not event.done.done():
+                event.done.set_result(None)
+
+    def queue_submit(job):
+        job.event.queued = True
+        job.event.done = asyncio.get_running_loop().create_future()
+        submit(job)
+
+    bot.time = clock
+    bot.ai_generate_reply = make_stub_ai(latency, jitter)
+    bot.classify_message = classify_message
+    bot.process_candidate = process_candidate
+    bot.AI_QUEUE.submit = queue_submit
+
+    def restore():
+        for name, value in originals.items():
+            setattr(bot, name, value)
+        del bot.AI_QUEUE.submit
+
+    return restore
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+async def replay_one(client, config, event: FakeEvent):
+    CURRENT_EVENT.set(event)
+    event.started = time.perf_counter()
+    await bot.handle_candidate_message(client, config, event)
+    if not event.queued and not event.finished:
+        event.finished = time.perf_counter()
+
+
+async def replay(records, speed: float, workers: int, clock: ReplayClock):
+    client = FakeClient()
+    config = {"session_name": "replay"}
+    events = [FakeEvent(r) for r in records]
+    tasks = []
+
+    bot.AI_QUEUE.start(workers)
+    started = time.perf_counter()
+    first_ts = records[0].ts if records else 0.0
+    try:
+        for record, event in zip(records, events):
+            if speed > 0:
+                delay = (record.ts - first_ts) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            clock.set(record.ts)
+            task = asyncio.create_task(replay_one(client, config, event))
+            tasks.append(task)
+            if speed <= 0:
+                await task
+        await asyncio.gather(*tasks)
+        await asyncio.gather(*(e.done for e in events if e.done is not None))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.AI_QUEUE.stop()
+    return events, client, elapsed
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def outcome(event: FakeEvent) -> str:
+    if event.category is None:
+        return "filtered before rules"
+    if event.category in ("ignore", "reject_spam"):
+        return "rejected by rules"
+    if event.processed:
+        return "lead (AI queue)" if event.queued else "lead (pre-scorer)"
+    return "duplicate"
+
+
+def print_report(events, client, elapsed: float, new_leads, args):
+    latencies = sorted((e.finished - e.started) * 1000.0 for e in events if e.finished)
+    n = len(events)
+    print(
+        f"replayed {n} messages in {elapsed:.2f}s ({n / elapsed if elapsed else 0:,.0f} msg/s), "
+        f"AI stub {args.ai_latency:.2f}±{args.ai_jitter:.2f}s, {args.workers} workers"
+    )
+    print(
+        "latency ms: " + " ".join(
+            f"p{p}={percentile(latencies, p):.2f}" for p in (50, 95, 99)
+        ) + f" max={latencies[-1] if latencies else 0:.2f}"
+    )
+
+    print("classification:")
+    for category, count in Counter(e.category or "-" for e in events).most_common():
+        print(f"  {category:<24} {count:>8}")
+
+    print("outcome:")
+    for name, count in Counter(outcome(e) for e in events).most_common():
+        print(f"  {name:<24} {count:>8}")
+
+    print("AI verdicts:")
+    for action, count in Counter((lead.get("ai") or {}).get("action") for lead in new_leads).most_common():
+        print(f"  {action:<24} {count:>8}")
+
+    print(bot.AI_QUEUE.stats_line())
+    print(bot.SENDER_CACHE.stats_line())
+    print(f"admin notices sent: {client.notices}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", help="JSONL file of recorded messages")
+    parser.add_argument("--synthetic", type=int, default=0, help="replay N bench.py corpus messages instead")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between synthetic messages")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=0.0, help="0 = as fast as possible")
+    parser.add_argument("--ai-latency", type=float, default=0.2)
+    parser.add_argument("--ai-jitter", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=bot.AI_WORKERS)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO and WARNING log lines")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    if args.synthetic:
+        records = synthetic_records(args.synthetic, args.interval)
+    elif args.path:
+        records = load_records(args.path, args.limit)
+    else:
+        parser.error("give a JSONL path or --synthetic N")
+    if not records:
+        print("no messages to replay")
+        return 1
+
+    clock = ReplayClock()
+    known_leads = set(bot.LEADS)
+    restore = install_hooks(args.ai_latency, args.ai_jitter, clock)
+    try:
+        events, client, elapsed = asyncio.run(replay(records, args.speed, args.workers, clock))
+    finally:
+        restore()
+    new_leads = [lead for lead_id, lead in bot.LEADS.items() if lead_id not in known_leads]
+    print_report(events, client, elapsed, new_leads, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
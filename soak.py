@@ -0,0 +1,495 @@
+"""Soak test: weeks of simulated traffic against local Telegram/OpenAI stand-ins.
+
+Usage:
+    python soak.py [--days 28] [--per-hour 30] [--chats 40] [--new-senders 0.2]
+                   [--sample-hours 6] [--ai-latency 0.002] [--ai-error-rate 0.01]
+                   [--flood-rate 0.02] [--tolerance 0.1] [--max-rss-mb 0]
+                   [--new-chats-per-day 5] [--group-snapshots-off]
+                   [--allow LEADS] [--csv PATH] [--verbose]
+
+The bot's clock runs at simulated time: every message moves it to the
+message's timestamp, so TTLs, windows and expiry behave as they would over
+--days of uptime while the run takes minutes. Two sessions share --chats
+monitored groups (sharding on), and every simulated day
+--new-chats-per-day new groups join the monitored list while as many of the
+oldest leave it; messages go through handle_candidate_message
+for both sessions, AI calls go through the real OpenAIGateway to an
+in-process openai_stub server, and auto-send DMs/invites run through
+OUTBOUND_QUEUE against fake clients that raise PeerFlood at --flood-rate.
+Persistence flushes to a temporary DATA_DIR. --group-snapshots-off runs with
+GROUP_ACTIVITY_SNAPSHOT_SEC=0.
+
+Every --sample-hours the item count and deep size of each in-process
+structure, and the process RSS, are recorded (--csv writes them all). After
+a warm-up of the longest retention horizon, a structure fails the run when
+the mean of the second half of the samples exceeds the first half's by more
+than --tolerance. Caches are counted by live (unexpired) entries, and a
+structure that never goes above its cap (configured size, or the monitored
+chats for the per-chat discussion window) counts as bounded.
+
+--allow is a comma-separated list of structures whose growth is reported
+without failing the run. It defaults to LEADS: the lead history stays in
+memory for the life of the process by design, so the report shows its
+growth per day for capacity planning. --allow "" fails on it too.
+
+OUTBOUND_ROLLUP_DAYS defaults to 7 here (30 in production) so the rollup
+bound is reached inside a four-week run.
+"""
+
+import os
+import gc
+import sys
+import csv
+import time
+import types
+import zlib
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import deque
+
+_TMP = tempfile.mkdtemp(prefix="soak_")
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+STUB_PORT = _free_port()
+os.environ["DATA_DIR"] = _TMP
+os.environ["LOG_PATH"] = os.path.join(_TMP, "bot.log")
+os.environ["SQLITE_PATH"] = os.path.join(_TMP, "bot.sqlite3")
+os.environ["OPENAI_API_KEY"] = "stub"
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}/v1"
+os.environ.setdefault("OUTBOUND_ROLLUP_DAYS", "7")
+os.environ.setdefault("AUTO_SEND_HIGH_CONFIDENCE", "1")
+os.environ.setdefault("AUTO_SEND_THRESHOLD", "0.75")
+os.environ.setdefault("AUTO_INVITE_AFTER_DM", "1")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import bot  # noqa: E402
+import bench  # noqa: E402
+import replay  # noqa: E402
+import openai_stub  # noqa: E402
+from telethon.errors import PeerFloodError  # noqa: E402
+from telethon.tl.types import InputPeerUser  # noqa: E402
+
+SESSIONS = ("soak1", "soak2")
+TICK_SEC = 300.0
+TRAFFIC = None
+
+
+# =============================================================================
+# STAND-INS
+# =============================================================================
+
+class SoakClient(replay.FakeClient):
+    """FakeClient plus what the DM and invite paths call."""
+
+    def __init__(self, flood_rate: float, rnd: random.Random):
+        super().__init__()
+        self.flood_rate = flood_rate
+        self.rnd = rnd
+        self.sent = 0
+        self.floods = 0
+
+    async def get_input_entity(self, peer):
+        return InputPeerUser(user_id=zlib.crc32(str(peer).encode()), access_hash=1)
+
+    async def send_message(self, entity, text, **kwargs):
+        if isinstance(entity, InputPeerUser):
+            self._maybe_flood()
+            self.sent += 1
+        else:
+            self.notices += 1
+
+    async def __call__(self, request):
+        self._maybe_flood()
+        self.sent += 1
+
+    def _maybe_flood(self):
+        if self.rnd.random() < self.flood_rate:
+            self.floods += 1
+            raise PeerFloodError(request=None)
+
+
+class Traffic:
+    """Messages for one simulated hour: a rotating chat list, a slowly growing sender pool."""
+
+    def __init__(self, chats: int, new_senders: float, seed: int = 3):
+        self.rnd = random.Random(seed)
+        self.chats_seen = 0
+        self.chats = [self._new_chat() for _ in range(chats)]
+        self.new_senders = new_senders
+        self.senders = [replay.FakeSender(200000 + i, f"soak_user{i}", f"User{i}") for i in range(200)]
+        self.message_ids = {}
+
+    def _new_chat(self):
+        i = self.chats_seen
+        self.chats_seen += 1
+        return replay.FakeChat(-1001500000000 - i, f"{bench.CITIES[i % len(bench.CITIES)]} #{i}", f"soak_chat_{i}")
+
+    def rotate(self, count: int):
+        """Swap the count oldest chats for new ones, as when groups are joined and left."""
+        for _ in range(min(count, len(self.chats))):
+            self.message_ids.pop(self.chats.pop(0).id, None)
+            self.chats.append(self._new_chat())
+
+    def hour(self, start_ts: float, count: int, seed: int):
+        out = []
+        texts = bench.build_corpus(count, seed)
+        for text, offset in zip(texts, sorted(self.rnd.uniform(0, 3600) for _ in range(count))):
+            if self.rnd.random() < self.new_senders:
+                n = 200000 + len(self.senders)
+                self.senders.append(replay.FakeSender(n, f"soak_user{n}", f"User{n}"))
+                sender = self.senders[-1]
+            else:
+                sender = self.rnd.choice(self.senders)
+            chat = self.rnd.choice(self.chats)
+            self.message_ids[chat.id] = self.message_ids.get(chat.id, 0) + 1
+            out.append(replay.ReplayRecord(
+                chat, sender, text, start_ts + offset, self.message_ids[chat.id], self.rnd.random() < 0.1,
+            ))
+        return out
+
+
+# =============================================================================
+# MEASUREMENT
+# =============================================================================
+
+_OPAQUE = (type, types.ModuleType, types.FunctionType, types.MethodType, asyncio.Future, asyncio.Event)
+
+
+def deep_sizeof(*objs) -> int:
+    """Approximate bytes reachable from objs through containers and plain objects."""
+    seen = set()
+    stack = list(objs)
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _OPAQUE):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif isinstance(o, (str, bytes, int, float, bool)) or o is None:
+            continue
+        else:
+            if hasattr(o, "__dict__"):
+                stack.append(vars(o))
+            for slot in getattr(type(o), "__slots__", ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+    return total
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Structure:
+    def __init__(self, name: str, items, objects, cap=None):
+        self.name = name
+        self.items = items
+        self.objects = objects
+        self.cap = cap  # callable returning the configured size limit, or None
+
+
+def _live_ai_cache() -> int:
+    now = bot.time.time()
+    return sum(1 for expires_at, _ in bot.AI_CACHE.entries.values() if expires_at > now)
+
+
+def _live_senders() -> int:
+    now = bot.time.time()
+    return sum(1 for p in bot.SENDER_CACHE.entries.values() if now - p.cached_at <= bot.SENDER_CACHE_TTL_SEC)
+
+
+def _skip_filter():
+    return next((f for f in logging.getLogger().filters if isinstance(f, bot.SkipRateFilter)), None)
+
+
+STRUCTURES = (
+    Structure("SEEN", lambda: len(bot.SEEN), lambda: (bot.SEEN,)),
+    Structure("SEEN heap", lambda: len(bot.SEEN._heap), lambda: (bot.SEEN._heap,)),
+    Structure("LEADS", lambda: len(bot.LEADS), lambda: (bot.LEADS,)),
+    Structure("FAVORITES", lambda: len(bot.FAVORITES), lambda: (bot.FAVORITES,)),
+    # one entry per group ever monitored: bounded by configuration, not traffic
+    Structure("ANALYTICS", lambda: len(bot.ANALYTICS), lambda: (bot.ANALYTICS,), cap=lambda: TRAFFIC.chats_seen),
+    # a ring per chat active within DISCUSSION_WINDOW_SEC: at most the monitored chats
+    Structure(
+        "GROUP_ACTIVITY",
+        lambda: len(bot.GROUP_ACTIVITY.rings),
+        lambda: (bot.GROUP_ACTIVITY.rings,),
+        cap=lambda: len(TRAFFIC.chats),
+    ),
+    Structure(
+        "GROUP_ACTIVITY rec",
+        lambda: sum(len(r.records) for r in bot.GROUP_ACTIVITY.rings.values()),
+        lambda: tuple(r.records for r in bot.GROUP_ACTIVITY.rings.values()),
+        cap=lambda: len(TRAFFIC.chats) * bot.MAX_GROUP_ACTIVITY_RECORDS,
+    ),
+    Structure(
+        "OUTBOUND_STATS",
+        lambda: sum(
+            sum(len(v) for v in (s.get("windows") or {}).values())
+            + sum(len(v) for v in (s.get("rollup") or {}).values())
+            for s in bot.OUTBOUND_STATS.values()
+        ),
+        lambda: (bot.OUTBOUND_STATS, bot.OUTBOUND_LIMITER.windows),
+    ),
+    Structure("OUTBOUND_QUEUE", lambda: len(bot.OUTBOUND_QUEUE.jobs), lambda: (bot.OUTBOUND_QUEUE.jobs,)),
+    Structure("INFLIGHT", lambda: len(bot.INFLIGHT), lambda: (bot.INFLIGHT,)),
+    Structure("AI_CACHE", _live_ai_cache, lambda: (bot.AI_CACHE.entries,), cap=lambda: bot.AI_CACHE_SIZE),
+    Structure("AI_INFLIGHT", lambda: len(bot.AI_INFLIGHT), lambda: (bot.AI_INFLIGHT,)),
+    Structure("AI_QUEUE", lambda: len(bot.AI_QUEUE), lambda: (bot.AI_QUEUE._heap,)),
+    Structure("SENDER_CACHE", _live_senders, lambda: (bot.SENDER_CACHE.entries,), cap=lambda: bot.SENDER_CACHE_SIZE),
+    Structure(
+        "SESSION_HEALTH",
+        lambda: sum(len(d) for d in bot.SESSION_HEALTH.floods.values()),
+        lambda: (bot.SESSION_HEALTH.floods, bot.SESSION_HEALTH.failures),
+    ),
+    Structure("PERSIST dirty", lambda: sum(len(k) for k in bot.PERSIST.dirty.values()), lambda: (bot.PERSIST.dirty,)),
+    Structure(
+        "METRICS series",
+        lambda: sum(len(getattr(m, "values", None) or getattr(m, "series", None) or ()) for m in bot.METRICS),
+        lambda: tuple(getattr(m, "values", None) or getattr(m, "series", None) or {} for m in bot.METRICS),
+    ),
+    Structure(
+        "log skip state",
+        lambda: len(_skip_filter().state) if _skip_filter() else 0,
+        lambda: (_skip_filter().state,) if _skip_filter() else (),
+    ),
+)
+
+
+def take_sample(sim_day: float):
+    gc.collect()
+    row = {"day": round(sim_day, 3), "rss": rss_bytes()}
+    for s in STRUCTURES:
+        row[f"{s.name} items"] = s.items()
+        row[f"{s.name} bytes"] = deep_sizeof(*s.objects())
+    return row
+
+
+def warmup_days() -> float:
+    hours = max(
+        max(bot.SEEN_TTL_BY_PREFIX.values(), default=0) / 3600.0,
+        bot.SEEN_DEFAULT_TTL_SEC / 3600.0,
+        bot.AI_CACHE_TTL_HOURS,
+        bot.OUTBOUND_JOB_MAX_AGE_HOURS,
+        bot.SENDER_CACHE_TTL_SEC / 3600.0,
+        bot.OUTBOUND_ROLLUP_DAYS * 24.0,
+    )
+    return hours / 24.0
+
+
+def grows_without_bound(values, tolerance: float, slack: int = 4) -> bool:
+    """Mean of the second half above the first half's mean by more than tolerance.
+
+    Means rather than peaks, so a bounded count that swings between samples
+    does not read as growth.
+    """
+    if len(values) < 4:
+        return False
+    half = len(values) // 2
+    first, second = values[:half], values[half:]
+    return sum(second) / len(second) > sum(first) / len(first) * (1.0 + tolerance) + slack
+
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+async def drain():
+    while len(bot.AI_QUEUE) or bot.AI_QUEUE.busy or bot.AI_INFLIGHT:
+        await asyncio.sleep(0.001)
+
+
+async def outbound_tick(now: float):
+    queue = bot.OUTBOUND_QUEUE
+    queue._expire(now)
+    while True:
+        index, session_name, _ = queue._next(bot.time.time())
+        if index is None:
+            break
+        await queue._dispatch(queue.jobs[index], session_name)
+
+
+async def soak(args):
+    global TRAFFIC
+    rnd = random.Random(17)
+    clock = replay.ReplayClock()
+    bot.time = clock
+
+    stub = openai_stub.StubServer(args.ai_latency, args.ai_latency / 2, args.ai_error_rate, False)
+    server = await asyncio.start_server(stub.handle, "127.0.0.1", STUB_PORT)
+
+    clients = {name: SoakClient(args.flood_rate, rnd) for name in SESSIONS}
+    configs = {name: {"session_name": name} for name in SESSIONS}
+    traffic = TRAFFIC = Traffic(args.chats, args.new_senders)
+    for i, name in enumerate(SESSIONS):
+        bot.CLIENTS[name] = clients[name]
+        bot.ME_IDS[name] = 900000 + i
+        bot.GROUP_OWNERS.register(name, [chat.id for chat in traffic.chats])
+    bot.ME_ID_SET.update(bot.ME_IDS.values())
+    if args.group_snapshots_off:
+        bot.GROUP_ACTIVITY.snapshot_every = 0
+    bot.AI_QUEUE.start(bot.AI_WORKERS)
+
+    start_ts = time.time()
+    clock.set(start_ts)
+    samples = []
+    started = time.perf_counter()
+    next_tick = start_ts + TICK_SEC
+    next_sample = start_ts
+    messages = 0
+    try:
+        for hour in range(int(args.days * 24)):
+            hour_ts = start_ts + hour * 3600.0
+            if hour and hour % 24 == 0 and args.new_chats_per_day:
+                traffic.rotate(args.new_chats_per_day)
+                for name in SESSIONS:
+                    bot.GROUP_OWNERS.register(name, [chat.id for chat in traffic.chats])
+            count = max(0, int(rnd.gauss(args.per_hour, args.per_hour ** 0.5)))
+            for record in traffic.hour(hour_ts, count, seed=hour):
+                while record.ts >= next_tick:
+                    clock.set(next_tick)
+                    await drain()
+                    await outbound_tick(next_tick)
+                    await bot.PERSIST.flush()
+                    next_tick += TICK_SEC
+                if record.ts >= next_sample:
+                    samples.append(take_sample((record.ts - start_ts) / 86400.0))
+                    next_sample += args.sample_hours * 3600.0
+                    if len(samples) % max(1, int(24 / args.sample_hours)) == 1 or args.sample_hours >= 24:
+                        row = samples[-1]
+                        print(
+                            f"day {row['day']:>6.1f}: rss {row['rss'] / 2 ** 20:7.1f} MB, "
+                            f"{messages:,} messages, {row['LEADS items']:,} leads, "
+                            f"{row['SEEN items']:,} seen, {time.perf_counter() - started:.0f}s elapsed",
+                            flush=True,
+                        )
+                clock.set(record.ts)
+                event = replay.FakeEvent(record)
+                for name in SESSIONS:
+                    await bot.handle_candidate_message(clients[name], configs[name], event)
+                messages += 1
+        await drain()
+        samples.append(take_sample(args.days))
+    finally:
+        await bot.AI_QUEUE.stop()
+        await bot.PERSIST.close()
+        await bot.openai_client.close()
+        server.close()
+        await server.wait_closed()
+    return samples, clients, messages, time.perf_counter() - started
+
+
+def write_csv(path: str, samples):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(samples[0]))
+        writer.writeheader()
+        writer.writerows(samples)
+
+
+def report(samples, clients, messages: int, elapsed: float, args) -> int:
+    warm = warmup_days()
+    steady = [row for row in samples if row["day"] >= warm]
+    print(
+        f"\n{messages:,} messages over {args.days:g} simulated days in {elapsed:.0f}s; "
+        f"warm-up {warm:g} days, {len(steady)} steady-state samples"
+    )
+    print(
+        f"DMs/invites sent {sum(c.sent for c in clients.values())}, "
+        f"PeerFlood {sum(c.floods for c in clients.values())}, "
+        f"admin notices {sum(c.notices for c in clients.values())}"
+    )
+    if len(steady) < 4:
+        print(f"!! need --days well above the {warm:g}-day warm-up to judge growth")
+        return 1
+
+    failures = []
+    allowed = {name.strip() for name in args.allow.split(",") if name.strip()}
+    print(f"\n{'structure':<18} {'items start':>12} {'items end':>12} {'bytes end':>12}  verdict")
+    for s in STRUCTURES:
+        items = [row[f"{s.name} items"] for row in steady]
+        size = steady[-1][f"{s.name} bytes"]
+        cap = s.cap() if s.cap else None
+        span = max(steady[-1]["day"] - steady[0]["day"], 1e-9)
+        per_day = (size - steady[0][f"{s.name} bytes"]) / span
+        if s.name in allowed:
+            verdict = f"grows {per_day / 1024:.0f} KB/day (allowed)"
+        elif cap is not None and max(items) <= cap:
+            verdict = f"bounded (cap {cap:,})"
+        elif not grows_without_bound(items, args.tolerance):
+            verdict = "bounded"
+        else:
+            verdict = f"grows {per_day / 1024:.0f} KB/day  << UNBOUNDED"
+            failures.append(s.name)
+        print(f"{s.name:<18} {items[0]:>12,} {items[-1]:>12,} {size:>12,}  {verdict}")
+
+    rss = [row["rss"] for row in steady]
+    span = max(steady[-1]["day"] - steady[0]["day"], 1e-9)
+    print(
+        f"\nRSS {rss[0] / 2 ** 20:.1f} MB -> {rss[-1] / 2 ** 20:.1f} MB "
+        f"({(rss[-1] - rss[0]) / span / 2 ** 20:+.2f} MB/day over the steady state)"
+    )
+    if args.max_rss_mb and max(rss) > args.max_rss_mb * 2 ** 20:
+        failures.append(f"RSS above {args.max_rss_mb} MB")
+
+    if failures:
+        print("FAIL: " + ", ".join(failures))
+        return 1
+    print("OK: no unbounded growth")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=float, default=28)
+    parser.add_argument("--per-hour", type=int, default=30, help="group messages per simulated hour")
+    parser.add_argument("--chats", type=int, default=40, help="monitored groups at any time")
+    parser.add_argument("--new-chats-per-day", type=int, default=5, help="groups swapped for new ones each day")
+    parser.add_argument("--group-snapshots-off", action="store_true", help="run with GROUP_ACTIVITY_SNAPSHOT_SEC=0")
+    parser.add_argument("--new-senders", type=float, default=0.2, help="share of messages from first-time senders")
+    parser.add_argument("--sample-hours", type=float, default=6)
+    parser.add_argument("--ai-latency", type=float, default=0.002)
+    parser.add_argument("--ai-error-rate", type=float, default=0.01)
+    parser.add_argument("--flood-rate", type=float, default=0.02, help="PeerFlood share of DMs/invites")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--max-rss-mb", type=float, default=0, help="also fail above this RSS (0 = off)")
+    parser.add_argument("--csv", help="write every sample to this CSV file")
+    parser.add_argument(
+        "--allow", default="LEADS", metavar="NAMES",
+        help='comma-separated structures whose growth is reported without failing ("" = none)',
+    )
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's log output")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    samples, clients, messages, elapsed = asyncio.run(soak(args))
+    if args.csv:
+        write_csv(args.csv, samples)
+        print(f"samples written to {args.csv}")
+    return report(samples, clients, messages, elapsed, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
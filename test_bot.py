@@ -0,0 +1,54 @@
+"""Regression tests for the candidate pipeline, run offline against replay.py's fakes.
+
+    python -m pytest -q test_bot.py
+"""
+
+import asyncio
+import unittest
+
+import replay
+
+bot = replay.bot
+
+
+class CrossPostDedupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.release = asyncio.Event()
+        self.real_ai = bot.ai_generate_reply
+
+        async def slow_ai(**kwargs):
+            await self.release.wait()
+            return dict(bot.AI_JSON_FALLBACK, action="reply", reply_text="ok", confidence=0.9)
+
+        bot.ai_generate_reply = slow_ai
+        bot.LEADS.clear()
+        bot.INFLIGHT.clear()
+
+    async def asyncTearDown(self):
+        await bot.AI_QUEUE.stop()
+        bot.ai_generate_reply = self.real_ai
+
+    async def test_queued_cross_posts_make_one_lead(self):
+        client = replay.FakeClient()
+        config = {"session_name": "test"}
+        text = "Ищу адвоката по семейным делам в Эссене, подскажите контакты"
+        sender = replay.FakeSender(4242, "olena_k", "Olena")
+        for i, chat in enumerate((replay.FakeChat(-1001, "Essen"), replay.FakeChat(-1002, "Köln"))):
+            event = replay.FakeEvent(replay.ReplayRecord(chat, sender, text, bot.time.time(), 100 + i))
+            await bot.handle_candidate_message(client, config, event)
+
+        # the first copy is still waiting for its AI call
+        self.assertEqual(len(bot.AI_QUEUE), 1)
+
+        bot.AI_QUEUE.start(1)
+        self.release.set()
+        while len(bot.AI_QUEUE) or bot.AI_QUEUE.busy:
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(len(bot.LEADS), 1)
+        self.assertEqual(client.notices, 1)
+        self.assertFalse(bot.INFLIGHT)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+"""Train the local pre-scorer from lead history and report the AI calls it saves.
+
+Usage:
+    python train_prescorer.py [--out PATH] [--epochs 8] [--holdout 0.2]
+                              [--buckets 262144] [--dry-run]
+
+Leads are read through the configured storage backend (STORAGE_BACKEND,
+DATA_DIR), exactly as the bot loads them. A lead is positive when the AI
+wanted to reply and the admin did not ignore it, or when a DM/invite was
+sent. Leads whose verdict did not come from the model (fallback,
+circuit_open, queue_overflow, prescorer) are left out.
+"""
+
+import sys
+import math
+import zlib
+import random
+import argparse
+
+import bot
+
+NON_MODEL_REASONS = ("fallback", "circuit_open", "queue_overflow", "prescorer")
+
+
+def lead_label(lead):
+    ai = lead.get("ai") or {}
+    reason = str(ai.get("reason") or "")
+    if reason.startswith(NON_MODEL_REASONS):
+        return None
+    status = lead.get("status") or "new"
+    if status in ("dm_sent", "invited"):
+        return 1
+    if status == "ignored":
+        return 0
+    return 1 if ai.get("action") in bot.REPLY_ACTIONS else 0
+
+
+def build_dataset(leads, buckets: int):
+    rows = []
+    for lead in leads.values():
+        label = lead_label(lead)
+        if label is None or not lead.get("text"):
+            continue
+        normalized = bot.normalize(lead["text"])
+        feats = bot.PreScorer.features(normalized, lead.get("category") or "", buckets)
+        rows.append((lead["id"], feats, label))
+    return rows
+
+
+def train(rows, buckets: int, epochs: int, lr: float = 0.2, l2: float = 1e-5, seed: int = 13):
+    """Plain SGD logistic regression over sparse hashed features."""
+    weights = {}
+    positives = sum(label for _, _, label in rows) or 1
+    prior = min(max(positives / max(len(rows), 1), 1e-3), 1 - 1e-3)
+    bias = math.log(prior / (1 - prior))
+    rnd = random.Random(seed)
+    order = list(rows)
+    for epoch in range(epochs):
+        rnd.shuffle(order)
+        step = lr / (1 + epoch)
+        for _, feats, label in order:
+            z = bias + sum(weights.get(f, 0.0) for f in feats)
+            z = max(-30.0, min(30.0, z))
+            grad = 1.0 / (1.0 + math.exp(-z)) - label
+            bias -= step * grad
+            for f in feats:
+                w = weights.get(f, 0.0)
+                weights[f] = w - step * (grad + l2 * w)
+    return bot.PreScorer(weights, bias, buckets)
+
+
+def evaluate(model, rows, thresholds):
+    scored = [(model.raw_score(feats), label) for _, feats, label in rows]
+    total = len(scored)
+    positives = sum(label for _, label in scored)
+    report = []
+    for t in thresholds:
+        skipped = [(s, label) for s, label in scored if s < t]
+        lost = sum(label for _, label in skipped)
+        report.append({
+            "threshold": t,
+            "ai_calls_saved": len(skipped),
+            "saved_pct": (len(skipped) / total * 100.0) if total else 0.0,
+            "positives_lost": lost,
+            "recall": ((positives - lost) / positives * 100.0) if positives else 100.0,
+        })
+    return total, positives, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default=bot.PRESCORER_FILE)
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--buckets", type=int, default=1 << 18)
+    parser.add_argument("--dry-run", action="store_true", help="evaluate only, do not write the model")
+    args = parser.parse_args(argv)
+
+    rows = build_dataset(bot.LEADS, args.buckets)
+    if len(rows) < 20:
+        print(f"Only {len(rows)} labelled leads in history; need at least 20 to train.")
+        return 1
+
+    # Deterministic split by lead id so reruns evaluate on the same leads.
+    cut = int(args.holdout * 100)
+    test = [r for r in rows if zlib.crc32(r[0].encode()) % 100 < cut]
+    train_rows = [r for r in rows if zlib.crc32(r[0].encode()) % 100 >= cut] or rows
+
+    model = train(train_rows, args.buckets, args.epochs)
+    thresholds = [0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5]
+    total, positives, report = evaluate(model, test or train_rows, thresholds)
+
+    print(f"leads: {len(rows)} labelled, {len(train_rows)} train, {len(test)} holdout")
+    print(f"holdout: {total} leads, {positives} positive")
+    print(f"{'threshold':>9} {'AI calls saved':>15} {'saved %':>8} {'positives lost':>15} {'recall %':>9}")
+    for r in report:
+        print(
+            f"{r['threshold']:>9.2f} {r['ai_calls_saved']:>15} {r['saved_pct']:>8.1f} "
+            f"{r['positives_lost']:>15} {r['recall']:>9.1f}"
+        )
+
+    if args.dry_run:
+        return 0
+
+    model = train(rows, args.buckets, args.epochs)
+    model.meta = {
+        "trained_at": bot.now_iso(),
+        "leads": len(rows),
+        "positives": sum(label for _, _, label in rows),
+        "holdout_report": report,
+    }
+    bot.save_json(args.out, model.to_json())
+    print(f"model written to {args.out}; enable with PRESCORER_THRESHOLD=<threshold>")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())